@@ -1,9 +1,16 @@
 PORT = 22
 LOCAL_FIRMWARE_FILE_NAME = "firmware.py"
 REMOTE_FIRMWARE_PATH = "/home/root/firmware.py" # DO NOT CHANGE THIS
+LOCAL_RAW_DATA_FORMAT_FILE_NAME = "raw_data_format.py" # imported by the firmware, uploaded next to it
+REMOTE_RAW_DATA_FORMAT_PATH = "/home/root/raw_data_format.py" # same directory as REMOTE_FIRMWARE_PATH
 MAX_DOWNLOAD_WAIT_TIME = 120 # max wait time to download a file, in seconds. Note that the firmware file will gather data for 80 seconds or 80*ADC_SAMPLING_RATE = 80*250 iterations
 DOWNLOAD_DELAY = 10 # time to wait in between checking if the file is created, in seconds
 DOWNLOAD_STR = "No download directory selected."
+RAW_DATA_FORMAT = "CSV" # raw data file the firmware writes: "CSV" or "BINARY" (see raw_data_format.py)
+RAW_DATA_COMPRESS = False # gzip the raw data file on the device and decompress it while downloading
+DIRAC_SUMMARY_FILE_SUFFIX = "_DIRAC_SUMMARY.csv" # per sweep Dirac voltages written by the firmware, used in fast result mode
+USE_DAEMON = False # opt-in: run through a firmware daemon kept running on the device instead of starting firmware.py for every run
+RAW_DATA_CHUNK_FILE = False # same as RAW_DATA_CHUNK_FILE in firmware.py: follow the chunk file the firmware appends while it samples (daemon runs)
 
 HELP_STRING = f"""
 ==============================
@@ -22,6 +29,8 @@ Controls:
   seconds, or if the maximum timeout of {MAX_DOWNLOAD_WAIT_TIME} is reached the data collection stops and times out.
   Requires active SSH connection.
 - Sample: does the exact same thing as the Baseline button.
+- Fast result: with this box ticked, Baseline and Sample download only the per sweep Dirac
+  summary computed on the device instead of the raw data file. Q/C Test needs the raw data.
 - Baseline from file: opens a file selector popup, enabling you to load an existing CSV file
   to perform analysis on.
 - Sample from file: does the exact same thing as the Baseline from file button.
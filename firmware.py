@@ -1,7 +1,6 @@
 from genericpath import exists
 import time  # Time measureing and sleep
 import datetime  # For filename creation
-import spidev  # SPI interface
 import array as arr  # Used for commands
 import numpy  # Use this for data
 import csv  # Writing/Reading files
@@ -16,20 +15,65 @@ import re #Regression search
 import json
 from os import path
 import socket    
+import select  # Edge-triggered button waits on the sysfs GPIO value files
+import random  # Noise of the simulated ADC
+import socketserver  # Command socket of the daemon mode
+import atexit  # Flush the log file at exit
+import multiprocessing  # Acquisition process
+from multiprocessing import shared_memory  # Sample ring buffer between the acquisition and main process
+from collections import deque  # Rolling Dirac window of the monitor mode
+import raw_data_format  # Raw data file layouts - uploaded next to this file, also read by the host
 
 USE_FAKE_DATA = False # For generating fake Gate Voltages / Ids for testing without sensor
+ADC_SIMULATED = False # Use simulated_mcp3561 instead of /dev/spidev - runs anywhere, no device or sensor needed
 
 # SAMPLING PARAMETERS
 SEC = 80  # was 5 TODO: # HOW LONG TO SAMPLE FOR
-ADC_SAMPLING_RATE = 250  # DESIRED SAMPLING RATE FOR ADC
+ADC_SAMPLING_RATE = 250  # DESIRED SAMPLING RATE FOR ADC - PER DEVICE FROM calib.json (TUNE MODE)
+
+# SCHEDULER PARAMETERS
+SCHEDULER_SPIN_NS = 200000  # Busy-wait only for the last 0.2ms before a deadline, sleep before that
+SCHEDULER_MISSED_TOLERANCE = 0.5  # A sample later than this fraction of a period counts as a missed deadline
+ADC_POLL_SLEEP = 0.00005  # Sleep between DATA READY polls - releases the GIL for the LED and cancel threads
+ADC_SCAN_TIMEOUT = 0.5  # Seconds to wait for both results of a one-shot scan cycle before it is restarted
+ADC_SCAN_RETRIES = 3  # Restarts of one scan cycle before the sample fails (RuntimeError)
+
+# ACQUISITION PROCESS PARAMETERS - SAMPLING IN ITS OWN PROCESS, AWAY FROM THE GIL OF THE OTHER THREADS
+ACQUISITION_PROCESS = False  # True: SAMPLE IN A FORKED PROCESS (AcquisitionProcess) - OPT-IN, SEE THE NOTE THERE
+ACQUISITION_CPU = -1  # INDEX INTO THE ALLOWED CPUs THE SAMPLING PROCESS IS PINNED TO (-1: THE LAST ONE), None: NOT PINNED
+ACQUISITION_SCHED_FIFO = True  # REAL-TIME SCHEDULING FOR THE SAMPLING PROCESS (NEEDS ROOT, SKIPPED IF NOT ALLOWED)
+ACQUISITION_FIFO_PRIORITY = 50  # 1-99
+ACQUISITION_DRAIN_INTERVAL = 0.02  # SECONDS BETWEEN RING BUFFER READS IN THE MAIN PROCESS
+SAMPLE_RING_SIZE = 65536  # SAMPLES IN THE RING BUFFER - ABOUT A MINUTE AT 1kHz BEFORE THE SAMPLER HAS TO STOP
+
+# LOG FILE PARAMETERS
+LOG_FILENAME = "logfile.txt"
+LOG_MAX_BYTES = 1000000  # ROTATED TO logfile.txt.1 WHEN IT GROWS PAST THIS
+LOG_BACKUPS = 3  # ROTATED FILES KEPT: logfile.txt.1 .. logfile.txt.3
+LOG_FLUSH_INTERVAL = 0.5  # SECONDS - LINES QUEUED IN THIS TIME ARE WRITTEN AND FLUSHED TOGETHER
+
+# DAEMON PARAMETERS (python3 firmware.py DAEMON)
+DAEMON_HOST = "127.0.0.1"  # LOCAL ONLY - THE HOST CONNECTS THROUGH ITS SSH CONNECTION (direct-tcpip CHANNEL)
+DAEMON_PORT = 5025  # SAME AS DAEMON_PORT IN ssh_to_device.py
+DAEMON_PROGRESS_INTERVAL = 1.0  # SECONDS BETWEEN PROGRESS MESSAGES WHILE A RUN IS GOING
 
 
 # =================================================================================
 # THREAD VARIABLES
 # =================================================================================
-stop_data_collection_process = False
-running = True
-ready_for_data_collection = False
+# EVENTS INSTEAD OF POLLED FLAGS: WAITING THREADS WAKE UP AS SOON AS ONE IS SET
+cancel_event = threading.Event()  # TEST CANCELLED (BOTH BUTTONS) - SAMPLING THREAD STOPS AT ITS NEXT SAMPLE
+shutdown_event = threading.Event()  # DATA COLLECTION OVER - LED AND CANCEL THREADS EXIT
+sample_ready_event = threading.Event()  # SAMPLE INSERTED, STOP WAITING FOR IT
+THREAD_DATA_COLLECTION_MODE_BASELINE = 1
+THREAD_DATA_COLLECTION_MODE_SAMPLING = 2
+THREAD_SAMPLING_MODE_WAIT_FOR_SAMPLE = 3
+THREAD_DATA_COLLECTION_MODE_MONITOR = 4
+BUTTON_POLL_INTERVAL = 0.25  # CANCEL BUTTONS READ EVERY 0.25s (WAS 1s) WHEN THE GPIO edge INTERFACE IS NOT AVAILABLE
+stream_overruns = 0
+scan_restarts = 0  # SCAN CYCLES RESTARTED BY acquire_sample_scan BECAUSE A RESULT WAS LOST
+logger = None  # log_writer, STARTED BY THE FIRST log()
+logger_lock = threading.Lock()
 mean_dirac_forward_sweep = 0
 mean_dirac_reverse_sweep = 0
 
@@ -50,6 +94,20 @@ low_lim = -1.25
 slope_range = 25  # t-n / if errors try 35
 # WAS 8 #Number of sweeps to look for in each direction (MAX): 8 mean 16 intotal
 secs = 16
+MIN_SWEEP_SAMPLES = 500  # minimum range of sweeps - those that are under are dropped
+ONLINE_SEGMENTATION = True  # Segment the sweeps while sampling (sweep_segmenter) instead of after the run
+STOP_AT_SWEEPS = True  # End the run once secs sweeps of both types are captured, before SEC if they come sooner
+ADAPTIVE_STOP = False  # Opt-in: end the run once the mean forward sweep Dirac voltage has converged (adaptive_stop, needs ONLINE_SEGMENTATION)
+ADAPTIVE_SEM_TARGET = 0.001  # V - standard error of the mean of the forward sweep Min Ids Voltages, np.std / sqrt(n)
+ADAPTIVE_MIN_SWEEPS = 4  # Forward sweeps before the spread is trusted
+ADAPTIVE_MIN_SEC = 20  # Shortest adaptive run in seconds - SEC is the longest
+MONITOR_RING_SIZE = 65536  # Samples kept by the MONITOR mode - must hold the longest sweep (about 50 s at 1.2 kHz)
+MONITOR_UPDATE_SAMPLES = 64  # Samples between segmenter updates in the MONITOR mode
+MONITOR_WINDOW = 8  # Passed sweeps of one type in the rolling Dirac mean / std
+MONITOR_PERSIST_INTERVAL = 10  # Seconds between appends to the MONITOR file
+MONITOR_MAX_SEC = None  # Longest MONITOR run in seconds, None: until cancelled
+DIRAC_FIT_WINDOW = 0.25  # Parabola fitted over +/- this fraction of the sweep's gate range around the Ids minimum
+DIRAC_MIN_FIT_SAMPLES = 10  # Fewer samples in the fit window fails the sweep
 fig_time_max = 80  # sec time frame of data
 NN = 100000  # Array size for raw data
 
@@ -68,32 +126,99 @@ GPIO_CHAN_NUM_LED_RGB_GREEN = "148"     # RGB GREEN
 GPIO_CHAN_NUM_LED_RGB_BLUE = "147"      # RGB BLUE
 
 GPIO_CHAN_NUM_LED_GREEN = "143"         # GREEN
-GPIO_CHAN_NUM_LED_BLUE = "142"          # RED
-GPIO_CHAN_NUM_LED_BLUE = "146"          # AMBER
+GPIO_CHAN_NUM_LED_RED = "142"           # RED
+GPIO_CHAN_NUM_LED_AMBER = "146"         # AMBER
 
 # GPIO_CHAN_NUM_BUTTON1 = "48"           #BUTTON #1 !! DISABLED DUE TO CONFLICT IN DEVICE TREE!!
 GPIO_CHAN_NUM_BUTTON2 = "72"  # BUTTON #2 NOT USED AT THE MOMENT
 GPIO_CHAN_NUM_BUTTON3 = "106"  # BUTTON #3
+GPIO_BUTTON_PRESSED = "0"  # BUTTONS ARE ACTIVE LOW
+GPIO_EDGE_WAIT = True  # WAIT FOR BUTTON EDGES (sysfs edge + poll), FALLS BACK TO READING EVERY BUTTON_POLL_INTERVAL
 
 
 # STRUCTURE OF THE OUTPUT FILE - IF CHANGED: CHANGE THE WRITE_TO_FILE ORDER AS WELL
-raw_data_file_header = ['Time', 'd_time', 's_time', 'fs_time', 'Gate Voltage', 'Ids',
-                        'raw_adc_binary_ch1', 'raw_adc_binary_ch2', 'raw_adc_voltage_ch1', 'raw_adc_voltage_ch2', 'Slope', 'Peak']
-dirac_voltage_summary_file_header = ['Dirac Voltages', 'Sweep Type', 'Result']
+RAW_DATA_WRITE_CHUNK = 4096  # ROWS FORMATTED PER write() WHEN SAVING THE RAW DATA FILE
+raw_data_file_header = raw_data_format.COLUMNS
+# COLUMN TYPES IN THE BINARY RAW DATA FILE (LITTLE ENDIAN) - SAME ORDER AS raw_data_file_header
+raw_data_file_dtypes = raw_data_format.DTYPES
+# RAW DATA FILE FORMAT: "CSV" OR "BINARY" (SELF DESCRIBING COLUMNS, READ BY raw_data_format.py ON THE HOST)
+# "NONE" SKIPS THE RAW DATA FILE - ONLY THE DIRAC SUMMARY IS WRITTEN
+RAW_DATA_FORMAT = "CSV"
+RAW_DATA_FILE_EXTENSION = raw_data_format.EXTENSIONS
+# GZIP THE RAW DATA FILE FOR TRANSFER - THE HOST DECOMPRESSES WHILE DOWNLOADING (ssh_to_device.download_file)
+RAW_DATA_COMPRESS = False
+RAW_DATA_COMPRESSED_EXTENSION = raw_data_format.COMPRESSED_EXTENSION
+RAW_DATA_GZIP_LEVEL = 3  # LOW LEVEL: MOST OF THE SIZE REDUCTION FOR A FRACTION OF THE DEVICE CPU TIME
+RAW_DATA_PARTIAL_EXTENSION = ".part"  # WRITTEN UNDER THIS NAME, RENAMED WHEN COMPLETE SO THE HOST NEVER SEES HALF A FILE
+# ALSO APPEND RAW CODES AND TIMINGS TO <name>_RAW_CHUNKS.bin WHILE SAMPLING (WRITER THREAD, raw_chunk_writer)
+RAW_DATA_CHUNK_FILE = False
+RAW_CHUNK_SAMPLES = 1000  # SAMPLES PER CHUNK RECORD - 4 s AT 250 Hz
+RAW_CHUNK_FILE_SUFFIX = raw_data_format.CHUNK_SUFFIX
+raw_chunk_file_header = raw_data_format.CHUNK_COLUMNS
+dirac_voltage_summary_file_header = ['Dirac Voltages', 'Sweep Type', 'Result', 'Min Ids Voltage']
+DIRAC_SUMMARY_FILE_SUFFIX = "_DIRAC_SUMMARY.csv"  # PER SWEEP DIRAC VOLTAGES, A FEW kB - FETCHED BY THE GUI IN FAST RESULT MODE
+MONITOR_FILE_SUFFIX = "_MONITOR.csv"  # ROLLING DIRAC TIME SERIES OF THE MONITOR MODE, APPENDED WHILE IT RUNS
+monitor_file_header = ['Time', 'Clock', 'Sweep Type', 'Dirac Voltage', 'Result', 'Rolling Mean', 'Rolling Std', 'Rolling Sweeps']
+TIMING_REPORT_FILE_SUFFIX = "_TIMING.json"  # ACQUISITION TIMING TELEMETRY (timing_report)
+TIMING_JITTER_PERCENTILES = [50, 90, 99, 99.9]
+TIMING_HISTOGRAM_EDGES_US = [0, 250, 500, 1000, 2000, 4000, 8000, 16000]  # CONVERSION TIME (_s_time) BINS, LAST BIN IS OPEN
+TIMING_BEHIND_TOLERANCE = 0.02  # ACHIEVED RATE MORE THAN 2% UNDER THE TARGET IS FLAGGED AS FALLING BEHIND
 # config_string = "" #FOR SAVING CONFIG FILE
 
 
 # =================================================================================
-# Enable SPI: /dev/spidev<bus>.<device>
+# Enable SPI: /dev/spidev<bus>.<device> - OPENED BY Device.open(), NOT AT IMPORT
 # =================================================================================
-bus = 0
-device = 0
-spi = spidev.SpiDev()
-spi.open(bus, device)
+SPI_BUS = 0
+SPI_DEVICE = 0
 # SETTINGS
-spi.max_speed_hz = 10000000
-spi.mode = 0b00
-spi.cshigh = False
+SPI_MAX_SPEED_HZ = 10000000
+SPI_MODE = 0b00
+spi = None  # SPI BACKEND USED BY ALL ADC FUNCTIONS: spidev.SpiDev ON THE DEVICE, ANYTHING WITH xfer2() / close() ELSE
+
+
+# =================================================================================
+# CALIBRATION - calib.json IS READ BY Calibration.load(), THE DEFAULTS BELOW ARE USED UNTIL Calibration.apply()
+# =================================================================================
+CALIB_FILENAME = "calib.json"
+# DEFAULT VALUES TO ADD TO CALIB FILE IF IS DOESN'T EXISTS
+# NB: THESE WILL NOT OVERWRITE EXISTING VALUES IN CALIB.JSON IF IT ALREADY EXISTS!
+CALIB_DEFAULTS = {
+    "ADC_CALIBRATION_GAIN": 1.11262,
+    "ADC_CALIBRATION_OFFSET": -0.055756889,
+    "VOLTAGE_SCALE": 2.5,
+    "FULL_SCALE_RESOLUTION": 8388608.0,
+    "GATE_GAIN": (301 + 121)/301, #1.40199335548,
+    "CURRENT_GAIN": 4990,
+    "GATE_OFFSET": 0.019655897,
+    "TIA_GAIN_1": 0.1371184370,
+    "TIA_GAIN_2": -0.2656584491,
+    "TIA_GAIN_3": 1.1644372463,
+    "TIA_GAIN_4": -0.0359382272,
+    "DEVICE_ID": "PX_NA",
+    "CONFIG_OSR": 256,  # SET BY TUNE MODE
+    "ADC_SAMPLING_RATE": 250  # SET BY TUNE MODE
+}
+
+# CALIBRATION GAINS FOR ADC
+ADC_CALIBRATION_GAIN = CALIB_DEFAULTS["ADC_CALIBRATION_GAIN"]
+ADC_CALIBRATION_OFFSET = CALIB_DEFAULTS["ADC_CALIBRATION_OFFSET"]
+VOLTAGE_SCALE = CALIB_DEFAULTS["VOLTAGE_SCALE"]
+FULL_SCALE_RESOLUTION = CALIB_DEFAULTS["FULL_SCALE_RESOLUTION"]
+
+# SCALING FACTORs TO TRANSLATE CALIBRATED ADC VOLTAGE TO GATE VOLTAGE
+GATE_GAIN = CALIB_DEFAULTS["GATE_GAIN"]
+CURRENT_GAIN = CALIB_DEFAULTS["CURRENT_GAIN"]
+GATE_OFFSET = CALIB_DEFAULTS["GATE_OFFSET"]
+
+#CALIBRATION GAINS FOR TIA
+#y = 0.1371184370x3 - 0.2656584491x2 + 1.1644372463x - 0.0359382272
+TIA_GAIN_1 = CALIB_DEFAULTS["TIA_GAIN_1"]
+TIA_GAIN_2 = CALIB_DEFAULTS["TIA_GAIN_2"]
+TIA_GAIN_3 = CALIB_DEFAULTS["TIA_GAIN_3"]
+TIA_GAIN_4 = CALIB_DEFAULTS["TIA_GAIN_4"]
+
+DEVICE_ID = CALIB_DEFAULTS["DEVICE_ID"]  # Device specific id - written to the file names
 
 
 # =================================================================================
@@ -117,6 +242,15 @@ mcp3562_internal_device_addr = 0b01
 
 # SCAN MODE OR MUX MODE
 # Scan mode: select multiple channels for a scan-cycle, or mux-mode for manually switching between channels
+ADC_SCAN_MODE = False
+
+# CONTINUOUS STREAMING: THE ADC CYCLES CH1/CH2 IN CONTINUOUS SCAN MODE PACED BY THE TIMER REGISTER,
+# PYTHON ONLY READS THE TAGGED RESULTS IN BLOCKS - FORCES SCAN MODE
+ADC_STREAMING_MODE = False
+STREAM_BLOCK_SIZE = 64  # Conversions read per block before checking for cancel / end of run
+
+# ACQUISITION PATH IN USE: adc_scan_mode, conv_mode, adc_mode AND adc_output_size ARE SET FROM ADC_SCAN_MODE AND
+# ADC_STREAMING_MODE BY configure_acquisition_path() WHEN THE DEVICE IS CONFIGURED, NOT AT IMPORT
 adc_scan_mode = False
 
 # Scan mode: use continious, else one-shot
@@ -137,8 +271,8 @@ adc_mode = ADC_MODE_STANDBY_MODE
 
 # 24 or 32 bit output (32 for scan mode)
 ADC_OUTPUT_24bit = 0b00
-ADC_OUTPUT_32bit = 0b11
-adc_output_size = ADC_OUTPUT_24bit
+ADC_OUTPUT_32bit = 0b11  # 32 bit: CHANNEL ID [31:28] + SIGN EXTENSION [27:24] + 24 bit DATA
+adc_output_size = ADC_OUTPUT_24bit  # 32 BIT IN SCAN MODE, WHICH NEEDS THE CHANNEL ID TO TELL CH1 AND CH2 APART
 
 # SCAN MODE SETTINGS
 # DELAY BETWEEN CONVERSIONS
@@ -152,6 +286,29 @@ SCAN_MODE_DELAY_8 = 0b001  # 8 x DMCLK
 SCAN_MODE_DELAY_0 = 0b000  # NO DELAY
 
 scan_mode_delay = SCAN_MODE_DELAY_512
+SCAN_MODE_DELAY_DMCLK = [0, 8, 16, 32, 64, 128, 256, 512]  # DMCLK periods, indexed by scan_mode_delay
+
+# TIMER REG PACING FOR CONTINUOUS SCAN (STREAMING) MODE
+ADC_MCLK_HZ = 4915200  # NOMINAL INTERNAL OSCILLATOR (3.33-6.66MHz) - THE ACHIEVED RATE IS MEASURED EVERY RUN
+stream_rate = ADC_SAMPLING_RATE  # SCAN CYCLES PER SECOND, None = BACK TO BACK CYCLES
+
+# SCAN MODE CHANNEL IDS IN THE 32 bit OUTPUT - SAME CHANNELS AS mux_selection_1 / mux_selection_2
+SCAN_CHANNEL_ID_A = 0x1  # CH1 SINGLE ENDED
+SCAN_CHANNEL_ID_B = 0x2  # CH2 SINGLE ENDED
+
+# NUMBER OF UNTHROTTLED SAMPLES PER PATH WHEN RUNNING IN BENCHMARK MODE
+BENCHMARK_SAMPLES = 2000
+# NUMBER OF ROWS FOR THE RAW DATA FILE WRITE TIMING IN BENCHMARK MODE (ABOUT ONE FULL RUN)
+BENCHMARK_WRITE_SAMPLES = 20000
+
+# OSR TUNING (TUNE MODE) - THE SELECTED OSR AND SAMPLING RATE ARE STORED IN calib.json
+OSR_VALUES = [32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 20480, 24576, 40960, 49152, 81920, 98304]  # ALL OSRs set_config_bits SUPPORTS, FASTEST FIRST
+TUNE_NOISE_TARGET_UV = 10.0  # RMS NOISE FLOOR (uV AT THE ADC INPUT) THE SELECTED OSR MUST MEET
+TUNE_RATE_HEADROOM = 1.2  # THE SELECTED OSR MUST REACH THE SAMPLING RATE x THIS UNTHROTTLED (SCHEDULER / LOAD MARGIN)
+TUNE_MIN_RATE = 10  # SAMPLES/S - SLOWER OSRs ARE NOT MEASURED IN MAX MODE
+TUNE_CONVERSIONS = 256  # NOISE / CONVERSION TIME: TEMPERATURE DIODE CONVERSIONS PER OSR
+TUNE_SAMPLES = 64  # SAMPLE-RATE CEILING: UNTHROTTLED A+B SAMPLES PER OSR
+TUNE_REPORT_FILENAME = "OSR_TUNING.json"
 
 # ==========================================
 # MCP3561: ADC MUX MODES:
@@ -172,6 +329,7 @@ ADC_MUX_MODE9 = 8  # MUX Vref+ vs Vref-
 # SELECTED MODE - NOT USED IN SCAN MODE
 mux_selection_1 = ADC_MUX_MODE4
 mux_selection_2 = ADC_MUX_MODE5
+TUNE_MUX_SELECTION = ADC_MUX_MODE7  # NOISE FLOOR INPUT FOR OSR TUNING
 
 
 mux_commands_index = [0b00000001,  # MUX DIFF V+ vs V-: CH0 vs CH1
@@ -208,7 +366,7 @@ CONFIG_CLK_SEL = CONFIG_CLK_INT
 # CONFIG_OSR = 32
 # CONFIG_OSR = 64
 # CONFIG_OSR = 128
-CONFIG_OSR = 256  # DEFAULT
+CONFIG_OSR = CALIB_DEFAULTS["CONFIG_OSR"]  # DEFAULT 256, PER DEVICE FROM calib.json (TUNE MODE)
 # CONFIG_OSR = 512
 # CONFIG_OSR = 1024
 # CONFIG_OSR = 2048
@@ -264,6 +422,27 @@ mcp3562_reg_gaincal = 0xA  # ADC digital gain calibration value
 mcp3562_reg_lock = 0xD  # Password value for SPI Write mode locking
 mcp3562_reg_crccfg = 0xF  # CRC checksum for device configuration
 
+# REGISTER MAP FROM CONFIG0 TO CRCCFG IN ADDRESS ORDER: (NAME, ADDRESS, BYTES) - ONE INCREMENTAL READ
+REGISTER_MAP = [("CONFIG0", mcp3562_reg_config0, 1),
+                ("CONFIG1", mcp3562_reg_config1, 1),
+                ("CONFIG2", mcp3562_reg_config2, 1),
+                ("CONFIG3", mcp3562_reg_config3, 1),
+                ("IRQ-REG", mcp3562_reg_irq, 1),
+                ("MUX-REG", mcp3562_reg_mux, 1),
+                ("SCAN-REG", mcp3562_reg_scan, 3),
+                ("TIMER-REG", mcp3562_reg_timer, 3),
+                ("OFFSETCAL-REG", mcp3562_reg_offsetcal, 3),
+                ("GAINCAL-REG", mcp3562_reg_gaincal, 3),
+                ("RESERVED-B", 0xB, 3),
+                ("RESERVED-C", 0xC, 1),
+                ("LOCK-REG", mcp3562_reg_lock, 1),
+                ("RESERVED-E", 0xE, 2),  # DEVICE ID
+                ("CRCCFG-REG", mcp3562_reg_crccfg, 2),
+                ]
+REGISTER_MAP_BYTES = sum(size for name, address, size in REGISTER_MAP)  # 27
+# BITS COMPARED WHEN VERIFYING A WRITE - IRQ[6:4] ARE READ-ONLY STATUS BITS, IRQ[7] IS UNIMPLEMENTED
+REGISTER_COMPARE_MASKS = {"IRQ-REG": 0b00001111}
+
 
 # MESSAGES/COMMANDS
 # =========================================
@@ -290,12 +469,115 @@ if adc_output_size == ADC_OUTPUT_24bit:  # 24 bit
     msg_read_data = [msg1, 0b00000000, 0b00000000, 0b00000000] # [65, 0, 0, 0]
 else:  # 32 bit
     msg_read_data = [msg1, 0b00000000, 0b00000000, 0b00000000, 0b00000000]
+msg_read_data_32 = [msg1, 0b00000000, 0b00000000, 0b00000000, 0b00000000]
+
+# COMMAND TABLE: IMMUTABLE COMMAND BUFFERS FOR THE ACQUISITION HOT PATH, REBUILT BY write_init_config()
+cmd_table = {}
+# REGISTER MAP LAST READ BY write_init_config() (register_snapshot)
+config_snapshot = None
+
+# Write the MUX register and start the conversion in one transaction (incremental write CONFIG0..MUX
+# with ADC_MODE = 11). Relies on the MUX write restarting the conversion it lands in, which the
+# MCP3561 does for writes to CONFIG0..MUX - check with the BENCHMARK mode before enabling on a device.
+ADC_FUSED_MUX_START = False
+
+def get_time(t=None):
+    return time.strftime("%Y-%m-%dT%H-%M-%SZ%z", time.localtime(t))
+
+
+# ================================================================================
+# LOGGING : log() ONLY QUEUES THE LINE, log_writer APPENDS THE LINES IN BATCHES AND ROTATES THE FILE
+# ================================================================================
+class log_writer (threading.Thread):
+
+    def __init__(self, filename=None, max_bytes=None, backups=None):
+        threading.Thread.__init__(self, name="Thread-Log", daemon=True)
+        self.filename = filename if filename is not None else LOG_FILENAME
+        self.max_bytes = max_bytes if max_bytes is not None else LOG_MAX_BYTES
+        self.backups = backups if backups is not None else LOG_BACKUPS
+        self.queue = Queue()
+
+    # CALLED FROM ANY THREAD - ONLY QUEUES, THE TIME STAMP IS FORMATTED BY THE WRITER
+    def write(self, s):
+        self.queue.put((time.time(), s))
+
+    # WRITE WHAT IS QUEUED AND WAIT FOR THE WRITER
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+    # logfile.txt -> logfile.txt.1 -> ... -> logfile.txt.<backups>, the oldest one is dropped
+    def rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if path.exists(f"{self.filename}.{i}"):
+                os.replace(f"{self.filename}.{i}", f"{self.filename}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.filename, f"{self.filename}.1")
+        else:
+            os.remove(self.filename)
+
+    def run(self):
+
+        log_file = open(self.filename, "a")
+        try:
+            running = True
+            while running:
+                # BLOCK FOR THE FIRST LINE, THEN TAKE EVERYTHING THAT CAME IN UNTIL THE NEXT FLUSH
+                batch = [self.queue.get()]
+                if batch[0] is not None:
+                    time.sleep(LOG_FLUSH_INTERVAL)
+                while not self.queue.empty():
+                    batch.append(self.queue.get())
+
+                lines = []
+                for entry in batch:
+                    if entry is None:
+                        running = False
+                        continue
+                    t, s = entry
+                    lines.append(f"{get_time(t)} | {str(s).rstrip()}\n")
+                log_file.write("".join(lines))
+                log_file.flush()
+
+                if log_file.tell() >= self.max_bytes:
+                    log_file.close()
+                    self.rotate()
+                    log_file = open(self.filename, "a")
+        finally:
+            log_file.close()
+
+
+# Appends s to logfile.txt - the writer thread is started by the first call and flushed at exit
+
 
-def get_time():
-    return time.strftime("%Y-%m-%dT%H-%M-%SZ%z")
 def log(s):
-    with open("logfile.txt", "w+") as f:
-        f.write(f"{get_time()} | {s}")
+
+    global logger
+
+    if logger is None:
+        with logger_lock:
+            if logger is None:
+                writer = log_writer()
+                writer.start()
+                atexit.register(writer.close)
+                logger = writer
+    logger.write(s)
+
+# TIMER REG value for continuous SCAN mode: one CH1 + CH2 cycle every 1/stream_rate seconds
+
+
+def scan_timer_value():
+
+    if stream_rate is None:
+        return 0
+
+    dmclk_hz = ADC_MCLK_HZ / 4  # DMCLK = MCLK/4
+    # TWO CONVERSIONS PER CYCLE, EACH ~3 x OSR DMCLK (SINC3 SETTLING) PLUS THE SCAN DELAY
+    cycle_dmclk = 2 * (3 * CONFIG_OSR + SCAN_MODE_DELAY_DMCLK[scan_mode_delay])
+    timer = int(dmclk_hz / stream_rate) - cycle_dmclk
+
+    return min(max(timer, 0), 0xFFFFFF)
+
 
 def set_config_bits():
     _config = arr.array('i')  # create empty array
@@ -400,15 +682,34 @@ def set_config_bits():
     #_config.extend([0b00000000, 0b00001100, 0b10001000])
 
     # 5000 @ 20MHz = 0.001sec between reads
-    _config.extend([0b00000000, 0b00000000, 0b00000000])
+    if adc_scan_mode and conv_mode == CONV_MODE_CONTINIOUS:
+        # STREAMING: DELAY BETWEEN SCAN CYCLES SETS THE SAMPLING RATE
+        timer = scan_timer_value()
+        _config.extend([(timer >> 16) & 0xFF, (timer >> 8) & 0xFF, timer & 0xFF])
+    else:
+        _config.extend([0b00000000, 0b00000000, 0b00000000])
 
     #_config.extend([0b00001010, 0b00000110, 0b10000000])
 
     return _config
 
 
+# Writes set_config_bits() unless the ADC already holds it (one snapshot read), then reads it back -
+# returns 0, or 1 if a register did not take the written value
+
+
 def write_init_config():
 
+    global config_snapshot
+    global cmd_table
+
+    config_array = set_config_bits().tolist()
+    config_snapshot = register_snapshot.read()
+    if not config_snapshot.diff(config_array):
+        # COMMAND BUFFERS DEPEND ON THE CONFIG
+        cmd_table = build_command_table()
+        return 0
+
     config = arr.array('i')  # create empty array
 
     # Sets the first address to write to - the addres will automatically increment after being written
@@ -422,176 +723,143 @@ def write_init_config():
     #reply = spi.xfer2(config_commands_inc_write)
     config.append(msg)
 
-    config_array = set_config_bits().tolist()
     config.extend(config_array)
     # print(config.tolist())
     reply = spi.xfer2(config.tolist())
 
-    return 0
+    # COMMAND BUFFERS DEPEND ON THE CONFIG THAT WAS JUST WRITTEN
+    cmd_table = build_command_table()
 
+    # READ CONFIG BACK TO CHECK SETUP
+    config_snapshot = register_snapshot.read()
+    mismatches = config_snapshot.diff(config_array)
+    for name, expected, value in mismatches:
+        print(f"CONFIG ERROR: {name} WRITTEN AS {expected:#x}, READ BACK AS {value:#x}")
 
-def start_conversion():
-    msg = 0b00000000
-    msg |= mcp3562_internal_device_addr << 6
-    msg |= mcp3562_cmd_conversion_start << 2
-    msg |= mcp3562_cmd_type_fast_cmd
-    msg2 = [msg]
-    reply = spi.xfer2(msg2)
+    return 1 if mismatches else 0
 
-# READ CONFIG REGISTERS
 
+# Precompute every command the acquisition loop sends, as immutable byte buffers
 
-def read_config(do_print):
 
-    config_string = ""
+def build_command_table():
 
-    if do_print == True:
-        print("\n========================================================")
-        print("CONFIG")
-        print("========================================================")
-    config_string += ("CONFIG:\n")
+    addr = mcp3562_internal_device_addr << 6
+    config = set_config_bits()
 
-    # READ CONFIG0 REG
-    msg = 0b00000000
-    msg |= mcp3562_internal_device_addr << 6
-    msg |= mcp3562_reg_config0 << 2
-    msg |= mcp3562_cmd_type_static_read
-    msg2 = [msg, 0b00000000]
-    reply = spi.xfer2(msg2)
+    table = {}
+    table["start"] = bytes([addr | (mcp3562_cmd_conversion_start << 2) | mcp3562_cmd_type_fast_cmd])
+    table["standby"] = bytes([addr | (mcp3562_cmd_standby << 2) | mcp3562_cmd_type_fast_cmd])
+    table["status"] = bytes([addr | (mcp3562_reg_irq << 2) | mcp3562_cmd_type_static_read])
+    table["read_24"] = bytes([addr | (mcp3562_reg_adcdata << 2) | mcp3562_cmd_type_static_read, 0, 0, 0])
+    table["read_32"] = bytes([addr | (mcp3562_reg_adcdata << 2) | mcp3562_cmd_type_static_read, 0, 0, 0, 0])
 
-    if do_print == True:
-        print(" - CONFIG0:\t0b", format(reply[1], '08b'))
-    config_string += (" - CONFIG0:\t0b"+format(reply[1], '08b')+"\n")
+    # MUX WRITE PER MUX MODE
+    table["mux"] = tuple(bytes([addr | (mcp3562_reg_mux << 2) | mcp3562_cmd_type_inc_write, mux_command])
+                         for mux_command in mux_commands_index)
 
-    # READ CONFIG1 REG
-    msg = 0b00000000
-    msg |= mcp3562_internal_device_addr << 6
-    msg |= mcp3562_reg_config1 << 2
-    msg |= mcp3562_cmd_type_static_read
-    msg2 = [msg, 0b00000000]
-    reply = spi.xfer2(msg2)
-
-    if do_print == True:
-        print(" - CONFIG1:\t0b", format(reply[1], '08b'))
-    config_string += (" - CONFIG1:\t0b"+format(reply[1], '08b') + "\n")
-
-    # READ CONFIG2 REG
-    msg = 0b00000000
-    msg |= mcp3562_internal_device_addr << 6
-    msg |= mcp3562_reg_config2 << 2
-    msg |= mcp3562_cmd_type_static_read
-    msg2 = [msg, 0b00000000]
-    reply = spi.xfer2(msg2)
-
-    if do_print == True:
-        print(" - CONFIG2:\t0b", format(reply[1], '08b'))
-    config_string += (" - CONFIG2:\t0b"+format(reply[1], '08b') + "\n")
+    # FUSED MUX + START PER MUX MODE: CONFIG0 (ADC_MODE = CONVERSION), CONFIG1-3, IRQ, MUX
+    config0_start = (config[0] & 0b11111100) | ADC_MODE_CONVERSION_MODE
+    table["mux_start"] = tuple(bytes([addr | (mcp3562_reg_config0 << 2) | mcp3562_cmd_type_inc_write,
+                                      config0_start, config[1], config[2], config[3], config[4], mux_command])
+                               for mux_command in mux_commands_index)
 
-    # READ CONFIG3 REG
-    msg = 0b00000000
-    msg |= mcp3562_internal_device_addr << 6
-    msg |= mcp3562_reg_config3 << 2
-    msg |= mcp3562_cmd_type_static_read
-    msg2 = [msg, 0b00000000]
-    reply = spi.xfer2(msg2)
+    return table
 
-    if do_print == True:
-        print(" - CONFIG3:\t0b", format(reply[1], '08b'))
-    config_string += (" - CONFIG3:\t0b"+format(reply[1], '08b') + "\n")
 
-    # READ IRQ REG
-    msg = 0b00000000
-    msg |= mcp3562_internal_device_addr << 6
-    msg |= mcp3562_reg_irq << 2
-    msg |= mcp3562_cmd_type_static_read
-    msg2 = [msg, 0b00000000]
-    reply = spi.xfer2(msg2)
-
-    if do_print == True:
-        print(" - IRQ-REG:\t0b", format(reply[1], '08b'))
-    config_string += (" - IRQ-REG:\t0b"+format(reply[1], '08b') + "\n")
-
-    # READ MUX REG
-    msg = 0b00000000
-    msg |= mcp3562_internal_device_addr << 6
-    msg |= mcp3562_reg_mux << 2
-    msg |= mcp3562_cmd_type_static_read
-    msg2 = [msg, 0b00000000]
-    reply = spi.xfer2(msg2)
-
-    if do_print == True:
-        print(" - MUX-REG:\t0b", format(reply[1], '08b'))
-    config_string += (" - MUX-REG:\t0b"+format(reply[1], '08b') + "\n")
-
-    # READ SCAN REG
+def start_conversion():
     msg = 0b00000000
     msg |= mcp3562_internal_device_addr << 6
-    msg |= mcp3562_reg_scan << 2
-    msg |= mcp3562_cmd_type_static_read
-    msg2 = [msg, 0b00000000, 0b00000000, 0b00000000]
+    msg |= mcp3562_cmd_conversion_start << 2
+    msg |= mcp3562_cmd_type_fast_cmd
+    msg2 = [msg]
     reply = spi.xfer2(msg2)
 
-    if do_print == True:
-        print(" - SCAN-REG:\t[23:16] 0b", format(reply[1], '08b'), "\t[15:8] 0b",
-              format(reply[2], '08b'), "\t[7:0] 0b", format(reply[3], '08b'))
-    config_string += (" - SCAN-REG:\t[23:16] 0b"+format(reply[1], '08b')+"\t[15:8] 0b"+format(
-        reply[2], '08b')+"\t[7:0] 0b"+format(reply[3], '08b') + "\n")
 
-    # READ TIMER REG
+def standby_conversion():
     msg = 0b00000000
     msg |= mcp3562_internal_device_addr << 6
-    msg |= mcp3562_reg_timer << 2
-    msg |= mcp3562_cmd_type_static_read
-    msg2 = [msg, 0b00000000, 0b00000000, 0b00000000]
+    msg |= mcp3562_cmd_standby << 2
+    msg |= mcp3562_cmd_type_fast_cmd
+    msg2 = [msg]
     reply = spi.xfer2(msg2)
 
-    if do_print == True:
-        print(" - TIMER-REG:\t[23:16] 0b", format(reply[1], '08b'), "\t[15:8] 0b",
-              format(reply[2], '08b'), "\t[7:0] 0b", format(reply[3], '08b'))
-    config_string += (" - TIMER-REG:\t[23:16] 0b"+format(reply[1], '08b')+"\t[15:8] 0b"+format(
-        reply[2], '08b')+"\t[7:0] 0b"+format(reply[3], '08b') + "\n")
+# Registers CONFIG0..CRCCFG decoded from one incremental read - the same 27 bytes read_config used to
+# fetch with a transaction per register, and what write_init_config checks the written config against
+
+
+class register_snapshot:
+
+    def __init__(self, reply):
+        self.status = reply[0]
+        self.registers = {}
+        position = 1
+        for name, address, size in REGISTER_MAP:
+            value = 0
+            for byte in reply[position:position + size]:
+                value = (value << 8) | byte
+            self.registers[name] = value
+            position += size
+
+    # ONE SPI TRANSACTION, THE REGISTER ADDRESS AUTO INCREMENTS FROM CONFIG0 TO CRCCFG
+    @classmethod
+    def read(cls):
+        msg = 0b00000000
+        msg |= mcp3562_internal_device_addr << 6
+        msg |= mcp3562_reg_config0 << 2
+        msg |= mcp3562_cmd_type_inc_read
+        return cls(spi.xfer2([msg] + [0]*REGISTER_MAP_BYTES))
+
+    # Registers set_config_bits() would write (CONFIG0..TIMER) as {name: value}
+    @staticmethod
+    def expected(config):
+        registers = {}
+        position = 0
+        for name, address, size in REGISTER_MAP:
+            if position >= len(config):
+                break
+            value = 0
+            for byte in config[position:position + size]:
+                value = (value << 8) | byte
+            registers[name] = value
+            position += size
+        return registers
+
+    # [(name, expected, read)] for every written register that reads back different, read-only bits masked
+    def diff(self, config):
+        mismatches = []
+        for name, value in self.expected(config).items():
+            mask = REGISTER_COMPARE_MASKS.get(name, 0xFFFFFF)
+            if (value ^ self.registers[name]) & mask:
+                mismatches.append((name, value, self.registers[name]))
+        return mismatches
+
+    def format(self):
+        lines = ["CONFIG:"]
+        for name, address, size in REGISTER_MAP:
+            value = self.registers[name]
+            if size == 1:
+                lines.append(f" - {name}:\t0b{value:08b}")
+            else:
+                parts = [f"[{8*i + 7}:{8*i}] 0b{(value >> 8*i) & 0xFF:08b}" for i in reversed(range(size))]
+                lines.append(f" - {name}:\t" + "\t".join(parts))
+        return "\n".join(lines) + "\n"
 
-    # READ GAINCAL REG
-    msg = 0b00000000
-    msg |= mcp3562_internal_device_addr << 6
-    msg |= mcp3562_reg_gaincal << 2
-    msg |= mcp3562_cmd_type_static_read
-    msg2 = [msg, 0b00000000, 0b00000000, 0b00000000]
-    reply = spi.xfer2(msg2)
 
-    if do_print == True:
-        print(" - GAINCAL-REG:\t[23:16] 0b", format(reply[1], '08b'), "\t[15:8] 0b",
-              format(reply[2], '08b'), "\t[7:0] 0b", format(reply[3], '08b'))
-    config_string += (" - GAINCAL-REG:\t[23:16] 0b"+format(reply[1], '08b')+"\t[15:8] 0b"+format(
-        reply[2], '08b')+"\t[7:0] 0b"+format(reply[3], '08b') + "\n")
+# READ CONFIG REGISTERS - snapshot: an already read register_snapshot, else one is read
 
-    # READ LOCK REG
-    msg = 0b00000000
-    msg |= mcp3562_internal_device_addr << 6
-    msg |= mcp3562_reg_lock << 2
-    msg |= mcp3562_cmd_type_static_read
-    msg2 = [msg, 0b00000000]
-    reply = spi.xfer2(msg2)
 
-    if do_print == True:
-        print(" - LOCK-REG:\t0b", format(reply[1], '08b'))
-    config_string += (" - LOCK-REG:\t0b"+format(reply[1], '08b') + "\n")
+def read_config(do_print, snapshot=None):
 
-    # READ CRCCFG REG
-    msg = 0b00000000
-    msg |= mcp3562_internal_device_addr << 6
-    msg |= mcp3562_reg_crccfg << 2
-    msg |= mcp3562_cmd_type_static_read
-    msg2 = [msg, 0b00000000, 0b00000000]
-    reply = spi.xfer2(msg2)
+    if snapshot is None:
+        snapshot = register_snapshot.read()
+    config_string = snapshot.format()
 
     if do_print == True:
-        print(" - CRCCFG-REG:\t[15:8] 0b", format(reply[1],
-                                                  '08b'), "\t [7:0] 0b", format(reply[2], '08b'))
-    config_string += (" - CRCCFG-REG:\t[15:8] 0b"+format(
-        reply[1], '08b')+"\t [7:0] 0b"+format(reply[2], '08b') + "\n")
-
-    # time.sleep(2)
+        print("\n========================================================")
+        print("CONFIG")
+        print("========================================================")
+        print(config_string[len("CONFIG:\n"):], end="")
 
     return config_string
 
@@ -628,6 +896,15 @@ def wait_for_data():
         return False  # DATA READY
 
 
+# Block until the ADC reports DATA READY without spinning on the SPI bus
+
+
+def wait_for_data_ready():
+
+    while wait_for_data() == True:
+        time.sleep(ADC_POLL_SLEEP)
+
+
 def set_mux_mode(mux_selection):
 
     # Sets the first address to write to - the addres will automatically increment after being written
@@ -647,6 +924,287 @@ def set_mux_mode(mux_selection):
     return 0
 
 
+# Read ADC value with the SCAN channel ID (32 bit output) - DR status comes back in the same transaction
+
+
+def read_adc_tagged_32():
+
+    reply = spi.xfer2(cmd_table["read_32"])
+
+    if (reply[0] & 0b00000100) >> 2 == 1:
+        return None  # NO NEW DATA
+
+    channel_id = reply[1] >> 4
+    adc = (reply[2] << 16) + (reply[3] << 8) + (reply[4])
+
+    return channel_id, adc
+
+
+# ================================================================================
+# ACQUISITION PATHS : ONE SAMPLE = ONE CH1 (A) AND ONE CH2 (B) CONVERSION
+# Returns (adc_A, adc_B, time_sample1_end, time_sample2_end)
+# ================================================================================
+def acquire_sample_mux():
+
+    set_mux_mode(mux_selection_1)
+    start_conversion()
+    wait_for_data_ready()
+    time_sample1_end = time.perf_counter()  # END CONV
+    adc_a = read_adc_d_24()
+
+    set_mux_mode(mux_selection_2)
+    start_conversion()
+    wait_for_data_ready()
+    time_sample2_end = time.perf_counter()  # END CONV
+    adc_b = read_adc_d_24()
+
+    return adc_a, adc_b, time_sample1_end, time_sample2_end
+
+
+# Same as acquire_sample_mux, but every command comes from the command table and the
+# DR status is taken from the status byte of the data read itself (no separate poll)
+
+
+def acquire_sample_mux_table():
+
+    xfer2 = spi.xfer2
+    read_24 = cmd_table["read_24"]
+
+    if ADC_FUSED_MUX_START:
+        xfer2(cmd_table["mux_start"][mux_selection_1])
+    else:
+        xfer2(cmd_table["mux"][mux_selection_1])
+        xfer2(cmd_table["start"])
+    reply = xfer2(read_24)
+    while reply[0] & 0b00000100:
+        time.sleep(ADC_POLL_SLEEP)
+        reply = xfer2(read_24)
+    time_sample1_end = time.perf_counter()  # END CONV
+    adc_a = (reply[1] << 16) + (reply[2] << 8) + reply[3]
+
+    if ADC_FUSED_MUX_START:
+        xfer2(cmd_table["mux_start"][mux_selection_2])
+    else:
+        xfer2(cmd_table["mux"][mux_selection_2])
+        xfer2(cmd_table["start"])
+    reply = xfer2(read_24)
+    while reply[0] & 0b00000100:
+        time.sleep(ADC_POLL_SLEEP)
+        reply = xfer2(read_24)
+    time_sample2_end = time.perf_counter()  # END CONV
+    adc_b = (reply[1] << 16) + (reply[2] << 8) + reply[3]
+
+    return adc_a, adc_b, time_sample1_end, time_sample2_end
+
+
+# A result overwritten before it was read (slow poll) never comes back in one-shot scan mode: after
+# ADC_SCAN_TIMEOUT the cycle is started again, after ADC_SCAN_RETRIES restarts the sample fails.
+# Returns zeros if the test is cancelled while waiting - the caller drops the sample
+
+
+def acquire_sample_scan():
+
+    global scan_restarts
+
+    # ONE START COMMAND: THE ADC CONVERTS CH1 AND CH2 BY ITSELF, RESULTS ARE TAGGED WITH THE CHANNEL ID
+    spi.xfer2(cmd_table["start"])
+
+    adc_a = None
+    adc_b = None
+    time_sample1_end = 0
+    time_sample2_end = 0
+    restarts = 0
+    deadline = time.perf_counter() + ADC_SCAN_TIMEOUT
+    while adc_a is None or adc_b is None:
+        result = read_adc_tagged_32()
+        if result is None:
+            if cancel_event.is_set():
+                t_now = time.perf_counter()
+                return 0, 0, t_now, t_now
+            if time.perf_counter() > deadline:
+                if restarts == ADC_SCAN_RETRIES:
+                    raise RuntimeError(f"ADC scan cycle incomplete after {restarts} restarts")
+                restarts += 1
+                scan_restarts += 1
+                adc_a = None  # BOTH CHANNELS FROM THE SAME CYCLE
+                adc_b = None
+                spi.xfer2(cmd_table["start"])
+                deadline = time.perf_counter() + ADC_SCAN_TIMEOUT
+            time.sleep(ADC_POLL_SLEEP)
+            continue
+
+        if result[0] == SCAN_CHANNEL_ID_A:
+            adc_a = result[1]
+            time_sample1_end = time.perf_counter()  # END CONV
+        elif result[0] == SCAN_CHANNEL_ID_B:
+            adc_b = result[1]
+            time_sample2_end = time.perf_counter()  # END CONV
+
+    return adc_a, adc_b, time_sample1_end, time_sample2_end
+
+
+def acquire_sample():
+
+    if adc_scan_mode:
+        return acquire_sample_scan()
+    return acquire_sample_mux_table()
+
+
+# ================================================================================
+# STREAMING ACQUISITION : CONTINUOUS SCAN, HARDWARE PACED
+# The MCP3561 has no FIFO, so every conversion still has to be read before the next
+# one overwrites ADCDATA. The gain comes from dropping the per-sample start/standby
+# and scheduler, and from reading conversions in blocks with all lookups bound to
+# locals, storing straight into the acquisition buffers.
+# Runs for duration seconds (None: no time limit) and at most n_samples (NN by default).
+# Returns the number of samples captured, or -1 if the run was cancelled. Raises RuntimeError if
+# the ADC delivers nothing for ADC_SCAN_TIMEOUT (clock or configuration fault).
+# ================================================================================
+def acquire_stream(_adc_A, _adc_B, _time, _d_time, _s_time, _fs_time, n_samples=None, duration=None, chunk_writer=None,
+                   progress=None):
+
+    xfer2 = spi.xfer2
+    msg = cmd_table["read_32"]
+    perf_counter = time.perf_counter
+    sleep = time.sleep
+    poll_sleep = ADC_POLL_SLEEP
+    block_size = STREAM_BLOCK_SIZE
+    id_a = SCAN_CHANNEL_ID_A
+    id_b = SCAN_CHANNEL_ID_B
+
+    if n_samples is None:
+        n_samples = NN
+    else:
+        n_samples = min(n_samples, NN)
+
+    index_t = 0
+    overruns = 0
+    adc_a = None
+    t_a = 0.0
+    spi_time = 0.0
+    t_start = perf_counter()
+    t_stop = t_start + duration if duration is not None else None
+    t_last = t_start
+    t_data = t_start  # LAST REPLY WITH NEW DATA
+    stall_timeout = ADC_SCAN_TIMEOUT
+
+    xfer2(cmd_table["start"])
+    try:
+        while index_t < n_samples and (t_stop is None or perf_counter() < t_stop):
+
+            #TERMINATE EARLY IF TEST IS CANCELLED
+            if cancel_event.is_set():
+                return -1
+
+            if chunk_writer is not None and index_t >= chunk_writer.next_chunk:
+                chunk_writer.submit(index_t)
+
+            # ONLINE WORK ON THE LAST BLOCK (Acquisition.update) - BETWEEN BLOCKS, SO NO CONVERSION IS MISSED FOR IT
+            if progress is not None and progress(index_t):
+                break
+
+            conversions = 0
+            while conversions < block_size and index_t < n_samples:
+                t_read = perf_counter()
+                reply = xfer2(msg)
+                if reply[0] & 0b00000100:
+                    # NO NEW DATA - THE END OF THE RUN AND CANCEL ARE CHECKED HERE TOO, THE ADC MAY HAVE STOPPED
+                    if cancel_event.is_set():
+                        return -1
+                    if t_stop is not None and t_read >= t_stop:
+                        break
+                    if t_read - t_data > stall_timeout:
+                        raise RuntimeError(f"ADC stream stalled: no conversion for {t_read - t_data:.3f} s")
+                    sleep(poll_sleep)
+                    continue
+                t_now = perf_counter()
+                t_data = t_now
+                conversions += 1
+
+                channel_id = reply[1] >> 4
+                adc = (reply[2] << 16) + (reply[3] << 8) + reply[4]
+                if channel_id == id_a:
+                    if adc_a is not None:
+                        overruns += 1  # MISSED THE CH2 CONVERSION OF THE PREVIOUS CYCLE
+                    adc_a = adc
+                    t_a = t_now
+                    spi_time = t_now - t_read
+                elif channel_id == id_b:
+                    if adc_a is None:
+                        overruns += 1  # MISSED THE CH1 CONVERSION OF THIS CYCLE
+                        continue
+                    _adc_A[index_t] = adc_a
+                    _adc_B[index_t] = adc
+                    _time[index_t] = t_now - t_start
+                    _fs_time[index_t] = t_now - t_last
+                    _d_time[index_t] = t_now - t_a
+                    _s_time[index_t] = spi_time + (t_now - t_read)
+                    t_last = t_now
+                    adc_a = None
+                    index_t += 1
+    finally:
+        xfer2(cmd_table["standby"])
+
+    global stream_overruns
+    stream_overruns = overruns
+
+    return index_t
+
+
+# Scheduler-style report for a streamed run, computed from the recorded sample intervals
+
+
+def stream_report(_fs_time, n, rate):
+
+    if n < 2:
+        return {"target_rate": rate, "achieved_rate": 0.0, "ticks": n, "missed": stream_overruns,
+                "jitter_mean_us": 0.0, "jitter_rms_us": 0.0, "jitter_max_us": 0.0}
+
+    intervals = np.frombuffer(_fs_time, dtype=np.float64, count=n)[1:]
+    achieved_rate = 1.0 / intervals.mean()
+    dev = np.abs(intervals - 1.0 / (rate if rate else achieved_rate))
+
+    return {
+        "target_rate": rate,
+        "achieved_rate": achieved_rate,
+        "ticks": n,
+        "missed": stream_overruns,
+        "jitter_mean_us": float(dev.mean() * 1e6),
+        "jitter_rms_us": float(np.sqrt((dev * dev).mean()) * 1e6),
+        "jitter_max_us": float(dev.max() * 1e6),
+    }
+
+
+# Switch between SCAN and MUX acquisition and rewrite the ADC config to match
+
+
+def configure_acquisition_path(scan_mode, streaming=False):
+
+    global adc_scan_mode
+    global adc_output_size
+    global msg_read_data
+    global conv_mode
+    global adc_mode
+
+    if streaming:
+        conv_mode = CONV_MODE_CONTINIOUS
+        adc_mode = ADC_MODE_CONVERSION_MODE
+        scan_mode = True
+    else:
+        conv_mode = CONV_MODE_ONE_SHOT_STANDBY
+        adc_mode = ADC_MODE_STANDBY_MODE
+
+    adc_scan_mode = scan_mode
+    if adc_scan_mode:
+        adc_output_size = ADC_OUTPUT_32bit
+        msg_read_data = msg_read_data_32
+    else:
+        adc_output_size = ADC_OUTPUT_24bit
+        msg_read_data = msg_read_data_32[:4]
+
+    write_init_config()
+
+
 def conv_raw_adc_to_voltage(adc_value,channel_name):
 
     # CONVERT TO STRING
@@ -667,6 +1225,705 @@ def conv_raw_adc_to_voltage(adc_value,channel_name):
 
     return voltage
 
+# ================================================================================
+# POST PROCESSING : RAW ADC CODES TO PHYSICAL VALUES IN ONE NUMPY PASS
+# ================================================================================
+
+# 2'S COMPLEMENT OF 24 bit ADC CODES (ANY INTEGER ARRAY) AS int64
+
+
+def sign_extend_24(codes):
+
+    codes = np.asarray(codes, dtype=np.int64) & 0xFFFFFF
+    return codes - ((codes & 0x800000) << 1)
+
+
+# Calibration folded into polynomials of the signed raw code - same maths as conv_raw_adc_to_voltage
+# followed by the gate/current scaling, with every constant multiplied out once
+
+
+def fold_calibration_coefficients():
+
+    scale = VOLTAGE_SCALE / FULL_SCALE_RESOLUTION
+
+    # CH2 (B): voltage_B = b1*raw + b0, Vgate = g1*raw + g0
+    b1 = ADC_CALIBRATION_GAIN * scale
+    b0 = ADC_CALIBRATION_OFFSET
+    g1 = b1 * GATE_GAIN
+    g0 = 4.0496 + (b0 - 4.0496) * GATE_GAIN + GATE_OFFSET
+
+    # CH1 (A): voltage_A = a3*raw^3 + a2*raw^2 + a1*raw + a0 (TIA cubic), Ids = voltage_A / CURRENT_GAIN
+    a3 = TIA_GAIN_1 * scale ** 3
+    a2 = TIA_GAIN_2 * scale ** 2
+    a1 = TIA_GAIN_3 * scale
+    a0 = TIA_GAIN_4
+
+    return {
+        "voltage_B": (b1, b0),
+        "Vgate": (g1, g0),
+        "voltage_A": (a3, a2, a1, a0),
+    }
+
+
+# Returns (voltage_A, voltage_B, Vgate, Ids) as float64 arrays for the given raw codes
+
+
+def conv_raw_adc_to_physical(adc_A, adc_B):
+
+    coeffs = fold_calibration_coefficients()
+    raw_A = sign_extend_24(adc_A).astype(np.float64)
+    raw_B = sign_extend_24(adc_B).astype(np.float64)
+
+    b1, b0 = coeffs["voltage_B"]
+    voltage_B = b1 * raw_B + b0
+    g1, g0 = coeffs["Vgate"]
+    Vgate = g1 * raw_B + g0
+
+    a3, a2, a1, a0 = coeffs["voltage_A"]
+    voltage_A = ((a3 * raw_A + a2) * raw_A + a1) * raw_A + a0
+    Ids = voltage_A / CURRENT_GAIN
+
+    return voltage_A, voltage_B, Vgate, Ids
+
+# ================================================================================
+# POST PROCESSING : SLOPE AND PEAK DETECTION ON THE TRIANGLE (CH2) IN ONE NUMPY PASS
+# ================================================================================
+
+# Same columns as the per sample loop: slope is the sign of the lagged difference
+# (0 up to and including sample lag), peak marks where the slope flips (-1 NEGATIVE, 1 POSITIVE)
+
+
+def detect_slope_peak(voltage_B, lag=None):
+
+    if lag is None:
+        lag = slope_range
+    voltage_B = np.asarray(voltage_B, dtype=np.float64)
+    n = len(voltage_B)
+    slope = np.zeros(n, dtype=np.intc)
+    peak = np.zeros(n, dtype=np.intc)
+    if n <= lag + 1:
+        return slope, peak
+
+    # FALLING WHEN y[i-lag] - y[i] > 0 (DIVIDING BY lag NEVER CHANGES THE SIGN)
+    falling = voltage_B[1:n-lag] - voltage_B[lag+1:] > 0
+    slope[lag+1:] = np.where(falling, -1, 1)
+
+    # CHANGE POINTS ONLY COUNT AFTER SAMPLE lag, flips[j] IS SAMPLE j+1
+    flips = np.flatnonzero(np.diff(slope[lag:])) + lag + 1
+    peak[flips] = np.where(slope[flips] == 1, -1, 1)
+
+    return slope, peak
+
+# ================================================================================
+# POST PROCESSING : SWEEP SEGMENTATION AS A TABLE OF (start, end, sweep_type) INDEX RANGES
+# ================================================================================
+SWEEP_TABLE_DTYPE = np.dtype([("start", np.intp), ("end", np.intp), ("sweep_type", "U7")])
+
+# Each peak after the first one at time = 0 starts a sweep that runs up to the next peak (or the
+# last sample). Stops once secs sweeps of both types are found, drops the last (unused) sweep and
+# masks out sweeps shorter than min_samples. Slice the data with table["start"][k]:table["end"][k]
+
+
+def segment_sweeps(peak, n=None, lag=None, max_sweeps=None, min_samples=None):
+
+    peak = np.asarray(peak)
+    if n is None:
+        n = len(peak)
+    if lag is None:
+        lag = slope_range
+    if max_sweeps is None:
+        max_sweeps = secs
+    if min_samples is None:
+        min_samples = MIN_SWEEP_SAMPLES
+
+    peaks = np.flatnonzero(peak[lag+2:n]) + lag + 2
+    table = np.empty(len(peaks), dtype=SWEEP_TABLE_DTYPE)
+    table["start"] = peaks + 1
+    table["end"][:-1] = peaks[1:]
+    table["end"][-1:] = n
+    # POSITIVE PEAK STARTS A REVERSE SWEEP (POSITIVE TO NEGATIVE V IN TRIAGLE), NEGATIVE A FORWARD ONE
+    reverse = peak[peaks] == 1
+    table["sweep_type"] = np.where(reverse, "REVERSE", "FORWARD")
+
+    # STOP AT THE SWEEP THAT COMPLETES max_sweeps IN BOTH DIRECTIONS
+    done = np.flatnonzero((np.cumsum(reverse) >= max_sweeps) & (np.cumsum(~reverse) >= max_sweeps))
+    if len(done):
+        table = table[:done[0]+1]
+
+    # Remove last as it is not used
+    table = table[:-1]
+
+    return table[(table["end"] - table["start"]) >= min_samples]
+
+# ================================================================================
+# ONLINE SEGMENTATION : SLOPE, PEAKS AND SWEEPS WHILE THE SAMPLES ARRIVE
+# Same result as detect_slope_peak + segment_sweeps, worked out on the signed CH2 codes (voltage_B is
+# b1 * raw + b0 with b1 > 0, so the slope signs are the same) with the last lag codes as the only state.
+# The run can stop as soon as the table is complete - the samples after that would be cut off anyway.
+# ================================================================================
+class sweep_segmenter:
+
+    def __init__(self, adc_B, n_max=None, lag=None, max_sweeps=None, min_samples=None):
+        if n_max is None:
+            n_max = NN
+        self.adc_B = adc_B
+        self.lag = lag if lag is not None else slope_range
+        self.max_sweeps = max_sweeps if max_sweeps is not None else secs
+        self.min_samples = min_samples if min_samples is not None else MIN_SWEEP_SAMPLES
+        self.size = n_max  # SAMPLE i IS AT i % size - A RING BUFFER WHEN adc_B IS ONE (Monitor)
+        self.slope = arr.array("b", [0]*n_max)  # Slope / Peak COLUMNS OF THE RAW DATA FILE
+        self.peak = arr.array("b", [0]*n_max)
+        self.reset()
+
+    def reset(self):
+        self.history = [0]*self.lag  # CODE i-lag IS AT i % lag
+        self.n = 0  # SAMPLES SEGMENTED
+        self.last_slope = 0
+        self.sweep_start = None  # FIRST SAMPLE OF THE OPEN SWEEP
+        self.sweep_type = None
+        self.forward = 0  # SWEEPS STARTED PER TYPE
+        self.reverse = 0
+        self.sweeps = []  # CLOSED SWEEPS (start, end, sweep_type), SHORT ONES LEFT OUT
+        self.complete = False
+
+    # Segments the samples up to n, returns True once secs sweeps of both types have started
+    def update(self, n):
+
+        adc_B, history, lag, size = self.adc_B, self.history, self.lag, self.size
+        slope_column, peak_column = self.slope, self.peak
+        last_slope = self.last_slope
+
+        for i in range(self.n, n):
+            j = i % size
+            code = adc_B[j] & 0xFFFFFF
+            code -= (code & 0x800000) << 1
+            if i > lag:
+                slope = -1 if history[i % lag] > code else 1
+                slope_column[j] = slope
+                if slope != last_slope:
+                    peak = -1 if slope == 1 else 1
+                    peak_column[j] = peak
+                    if i > lag + 1 and not self.complete:
+                        self.sweep_boundary(i, peak)
+                last_slope = slope
+            history[i % lag] = code
+
+        self.n = max(self.n, n)
+        self.last_slope = last_slope
+        return self.complete
+
+    # Peak at sample i: closes the open sweep and starts the next, unless the table is complete
+    def sweep_boundary(self, i, peak):
+
+        if self.sweep_start is not None and i - self.sweep_start >= self.min_samples:
+            self.sweeps.append((self.sweep_start, i, self.sweep_type))
+
+        # POSITIVE PEAK STARTS A REVERSE SWEEP (POSITIVE TO NEGATIVE V IN TRIAGLE), NEGATIVE A FORWARD ONE
+        if peak == 1:
+            self.reverse += 1
+            self.sweep_type = "REVERSE"
+        else:
+            self.forward += 1
+            self.sweep_type = "FORWARD"
+        self.sweep_start = i + 1
+
+        # THE SWEEP STARTING HERE IS THE LAST (UNUSED) ONE
+        if self.reverse >= self.max_sweeps and self.forward >= self.max_sweeps:
+            self.complete = True
+
+    # Closed sweeps as a SWEEP_TABLE_DTYPE table, same as segment_sweeps
+    def table(self):
+        return np.array(self.sweeps, dtype=SWEEP_TABLE_DTYPE)
+
+# ================================================================================
+# POST PROCESSING : DIRAC VOLTAGE PER SWEEP
+# ================================================================================
+DIRAC_TABLE_DTYPE = np.dtype([("dirac", np.float64), ("sweep_type", "U7"), ("result", "U4"),
+                              ("min_ids_vgate", np.float64)])  # Vgate AT THE Ids MINIMUM - THE HOST'S sweepmean ESTIMATOR
+
+# Parabola Ids = a*Vgate^2 + b*Vgate + c fitted around the Ids minimum of every sweep, Dirac = -b / 2a.
+# The fit window is the same as before (Vgate at the minimum +/- DIRAC_FIT_WINDOW of the sweep's range);
+# the least squares sums for all windows come from one set of prefix sums and are solved in one batch.
+# A sweep fails when the window is too short or the parabola does not open upwards with its vertex inside
+# the window - its Dirac is then the Vgate of the Ids minimum
+
+
+def estimate_dirac(Vgate, Ids, sweeps):
+
+    n_sweeps = len(sweeps)
+    table = np.zeros(n_sweeps, dtype=DIRAC_TABLE_DTYPE)
+    table["sweep_type"] = sweeps["sweep_type"]
+    table["result"] = "FAIL"
+    if n_sweeps == 0:
+        return table
+
+    # FIT WINDOW [lo, hi) PER SWEEP
+    lo = np.empty(n_sweeps, dtype=np.intp)
+    hi = np.empty(n_sweeps, dtype=np.intp)
+    v_min = np.empty(n_sweeps)
+    for k, (sweep_start, sweep_end) in enumerate(zip(sweeps["start"], sweeps["end"])):
+        Vgate_prime = Vgate[sweep_start:sweep_end]
+        min_idx = np.argmin(Ids[sweep_start:sweep_end])
+        Vgate_range = Vgate_prime.max() - Vgate_prime.min()
+        idx_low = np.abs(Vgate_prime - (Vgate_prime[min_idx] - DIRAC_FIT_WINDOW*Vgate_range)).argmin()
+        idx_high = np.abs(Vgate_prime - (Vgate_prime[min_idx] + DIRAC_FIT_WINDOW*Vgate_range)).argmin()
+        lo[k] = sweep_start + min(idx_low, idx_high)
+        hi[k] = sweep_start + max(idx_low, idx_high) + 1
+        v_min[k] = Vgate_prime[min_idx]
+
+    # WINDOW SUMS OF Vgate^0..4 AND Vgate^0..2 * Ids FROM PREFIX SUMS
+    powers = Vgate[np.newaxis, :] ** np.arange(5)[:, np.newaxis]
+    prefix_v = np.zeros((5, len(Vgate) + 1))
+    np.cumsum(powers, axis=1, out=prefix_v[:, 1:])
+    prefix_vi = np.zeros((3, len(Vgate) + 1))
+    np.cumsum(powers[:3] * Ids, axis=1, out=prefix_vi[:, 1:])
+    S = prefix_v[:, hi] - prefix_v[:, lo]
+    T = prefix_vi[:, hi] - prefix_vi[:, lo]
+
+    # NORMAL EQUATIONS FOR (a, b, c)
+    M = np.stack([np.stack([S[4], S[3], S[2]], axis=-1),
+                  np.stack([S[3], S[2], S[1]], axis=-1),
+                  np.stack([S[2], S[1], S[0]], axis=-1)], axis=1)
+    rhs = np.stack([T[2], T[1], T[0]], axis=-1)
+    fit = (hi - lo >= DIRAC_MIN_FIT_SAMPLES) & (np.abs(np.linalg.det(M)) > 0)
+    coeffs = np.zeros((n_sweeps, 3))
+    if fit.any():
+        coeffs[fit] = np.linalg.solve(M[fit], rhs[fit][..., np.newaxis])[..., 0]
+    a, b = coeffs[:, 0], coeffs[:, 1]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        vertex = -b / (2*a)
+    v_lo = np.minimum(Vgate[lo], Vgate[hi - 1])
+    v_hi = np.maximum(Vgate[lo], Vgate[hi - 1])
+    passed = fit & (a > 0) & (vertex >= v_lo) & (vertex <= v_hi)
+
+    table["dirac"] = np.where(passed, vertex, v_min)
+    table["result"][passed] = "PASS"
+    table["min_ids_vgate"] = v_min
+    return table
+
+
+# Dirac summary: one row per sweep, dirac_voltage_summary_file_header columns
+
+
+def write_dirac_summary(filename, table):
+
+    with open(filename, "w") as csv_file:
+        csv_writer = csv.writer(csv_file, delimiter=',')
+        csv_writer.writerow(dirac_voltage_summary_file_header)
+        for row in table:
+            csv_writer.writerow([float(row["dirac"]), str(row["sweep_type"]), str(row["result"]),
+                                 float(row["min_ids_vgate"])])
+
+
+# ================================================================================
+# ADAPTIVE STOP : END THE RUN ONCE THE MEAN FORWARD SWEEP DIRAC VOLTAGE HAS CONVERGED
+# Every forward sweep the segmenter closes goes through estimate_dirac right away, on just that sweep.
+# Its min_ids_vgate (Vgate at the Ids minimum) is kept whether the fit passed or not - the estimator
+# and the sweeps helperfuncs.read_dirac_summary / sweepmean use for the mins the host reports. The run
+# ends when np.std of them over sqrt(n), the standard error of the mean, is within ADAPTIVE_SEM_TARGET,
+# not before ADAPTIVE_MIN_SWEEPS sweeps and ADAPTIVE_MIN_SEC seconds. The SEM shrinks as sweeps come
+# in, so a noisy chip runs longer rather than to the end. SEC stays the longest a run can take.
+# ================================================================================
+class adaptive_stop:
+
+    def __init__(self, acquisition, sem_target=None, min_sweeps=None, min_duration=None):
+        self.acquisition = acquisition
+        self.sem_target = sem_target if sem_target is not None else ADAPTIVE_SEM_TARGET
+        self.min_sweeps = min_sweeps if min_sweeps is not None else ADAPTIVE_MIN_SWEEPS
+        self.min_duration = min_duration if min_duration is not None else ADAPTIVE_MIN_SEC
+        self.reset()
+
+    def reset(self):
+        self.checked = 0  # SWEEPS OF THE SEGMENTER LOOKED AT
+        self.min_ids_vgate = []  # FORWARD SWEEPS, PASS OR FAIL
+        self.std = None
+        self.sem = None
+
+    # Dirac table row of the sweep start:end, from the raw codes captured so far
+    def sweep_dirac(self, start, end):
+        acquisition = self.acquisition
+        count = end - start
+        adc_A = np.frombuffer(acquisition.adc_A, dtype=np.intc, count=count, offset=start * acquisition.adc_A.itemsize)
+        adc_B = np.frombuffer(acquisition.adc_B, dtype=np.intc, count=count, offset=start * acquisition.adc_B.itemsize)
+        voltage_A, voltage_B, Vgate, Ids = conv_raw_adc_to_physical(adc_A, adc_B)
+        if USE_FAKE_DATA:
+            voltage_A = np.frombuffer(acquisition.voltage_A, dtype=np.float64, count=count,
+                                      offset=start * acquisition.voltage_A.itemsize)
+            Ids = voltage_A / CURRENT_GAIN
+        sweeps = np.array([(0, count, "FORWARD")], dtype=SWEEP_TABLE_DTYPE)
+        return estimate_dirac(Vgate, Ids, sweeps)[0]
+
+    # Call after the segmenter has seen the samples up to n, returns True when the run can end
+    def update(self, n):
+
+        sweeps = self.acquisition.segmenter.sweeps
+        if len(sweeps) == self.checked:
+            return False
+
+        for start, end, sweep_type in sweeps[self.checked:]:
+            if sweep_type == "FORWARD":
+                self.min_ids_vgate.append(float(self.sweep_dirac(start, end)["min_ids_vgate"]))
+        self.checked = len(sweeps)
+
+        if len(self.min_ids_vgate) < self.min_sweeps:
+            return False
+        self.std = float(np.std(self.min_ids_vgate))
+        self.sem = self.std / len(self.min_ids_vgate) ** 0.5
+        return self.sem <= self.sem_target and self.acquisition.time[n-1] >= self.min_duration
+
+# ================================================================================
+# RAW DATA FILE : BULK CSV WRITER
+# ================================================================================
+
+# Columns in raw_data_file_header order (array.array or numpy arrays), formatted a chunk of rows at
+# a time by raw_data_format.write_csv
+
+
+def write_raw_data_csv(filename, columns, n_samples, chunk=None, compress=False):
+
+    if chunk is None:
+        chunk = RAW_DATA_WRITE_CHUNK
+    raw_data_format.write_csv(filename, columns, n_samples, chunk, compress, RAW_DATA_GZIP_LEVEL)
+
+
+# Binary columnar file (raw_data_format.write_binary) - memory mapped by raw_data_format.read_binary on the host
+
+
+def write_raw_data_binary(filename, columns, n_samples, info, compress=False):
+
+    raw_data_format.write_binary(filename, columns, n_samples, info, compress, RAW_DATA_GZIP_LEVEL)
+
+
+# Calibration, device and rate information stored in the binary file header
+
+
+def raw_data_file_info(device_name, sample_rate, achieved_rate):
+
+    return {
+        "device_id": device_name,
+        "sample_rate": sample_rate,
+        "achieved_rate": achieved_rate,
+        "calibration": {
+            "ADC_CALIBRATION_GAIN": ADC_CALIBRATION_GAIN,
+            "ADC_CALIBRATION_OFFSET": ADC_CALIBRATION_OFFSET,
+            "VOLTAGE_SCALE": VOLTAGE_SCALE,
+            "FULL_SCALE_RESOLUTION": FULL_SCALE_RESOLUTION,
+            "GATE_GAIN": GATE_GAIN,
+            "CURRENT_GAIN": CURRENT_GAIN,
+            "GATE_OFFSET": GATE_OFFSET,
+            "TIA_GAIN_1": TIA_GAIN_1,
+            "TIA_GAIN_2": TIA_GAIN_2,
+            "TIA_GAIN_3": TIA_GAIN_3,
+            "TIA_GAIN_4": TIA_GAIN_4,
+        },
+    }
+
+
+# ================================================================================
+# RAW DATA FILE : CHUNKS APPENDED WHILE SAMPLING (LAYOUT IN raw_data_format.py, read_chunk_file ON THE HOST)
+# magic | uint32 header length | JSON header | records: uint32 first sample, uint32 n, then the
+# raw_chunk_file_header columns (n values each). A record with n = 0 marks a complete file
+# ================================================================================
+class raw_chunk_writer (threading.Thread):
+
+    def __init__(self, filename, columns, info):
+        threading.Thread.__init__(self, name="Thread-RawChunks", daemon=True)
+        self.filename = filename
+        self.columns = columns  # SAME ORDER AS raw_chunk_file_header
+        self.info = info
+        self.queue = Queue()
+        self.written = 0
+        self.next_chunk = RAW_CHUNK_SAMPLES
+
+    # CALLED FROM THE SAMPLING LOOP - ONLY QUEUES THE NEW END INDEX, THE WRITER THREAD COPIES AND WRITES
+    def submit(self, index_t):
+        self.next_chunk = index_t + RAW_CHUNK_SAMPLES
+        self.queue.put(index_t)
+
+    # WRITE WHATEVER IS LEFT, MARK THE FILE COMPLETE AND WAIT FOR THE WRITER
+    def close(self, index_t):
+        self.queue.put(index_t)
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+
+        with open(self.filename, "wb") as chunk_file:
+            raw_data_format.write_chunk_header(chunk_file, self.info, RAW_CHUNK_SAMPLES)
+            chunk_file.flush()
+
+            while True:
+                end = self.queue.get()
+                if end is None:
+                    raw_data_format.write_chunk_record(chunk_file, self.columns, self.written, self.written)
+                    chunk_file.flush()
+                    break
+                if end <= self.written:
+                    continue
+
+                # SAMPLES BEFORE end ARE NO LONGER WRITTEN BY THE SAMPLING LOOP
+                raw_data_format.write_chunk_record(chunk_file, self.columns, self.written, end)
+                chunk_file.flush()
+                os.fsync(chunk_file.fileno())
+                self.written = end
+
+
+# Previous row by row writer - kept as the reference for the benchmark
+
+
+def write_raw_data_csv_rows(filename, columns, n_samples):
+
+    with open(filename, "w") as csv_file:
+        csv_writer = csv.writer(csv_file, delimiter=',')
+        csv_writer.writerow(raw_data_file_header)
+
+        n = 0
+        while n < n_samples:
+            csv_writer.writerow([column[n] for column in columns])
+            n += 1
+
+# ================================================================================
+# TIMING TELEMETRY : COMPACT REPORT FROM THE PER SAMPLE _fs_time / _s_time / _d_time
+# ================================================================================
+
+# Percentiles of |interval - period| and of the channel to channel time in us, a histogram of the
+# conversion time and the scheduler / stream report counters. phases are wall times in seconds
+
+
+def timing_report(_fs_time, _s_time, _d_time, n, scheduler_report, phases):
+
+    target_rate = scheduler_report["target_rate"]
+    achieved_rate = scheduler_report["achieved_rate"]
+    fs_time = np.frombuffer(_fs_time, dtype=np.float64, count=n)
+    s_time = np.frombuffer(_s_time, dtype=np.float64, count=n) * 1e6
+    d_time = np.frombuffer(_d_time, dtype=np.float64, count=n) * 1e6
+
+    report = {
+        "samples": n,
+        "target_rate": target_rate,
+        "achieved_rate": achieved_rate,
+        "falling_behind": bool(target_rate) and bool(achieved_rate < target_rate * (1 - TIMING_BEHIND_TOLERANCE)),
+        "missed_deadlines": scheduler_report["missed"],
+        "phases_s": phases,
+    }
+
+    # THE FIRST INTERVAL IS FROM THE START OF THE RUN, NOT FROM A PREVIOUS SAMPLE
+    intervals = fs_time[1:]
+    period = 1.0 / (target_rate if target_rate else (achieved_rate if achieved_rate else 1.0))
+    jitter = np.abs(intervals - period) * 1e6
+    if len(jitter):
+        report["jitter_us"] = dict(zip([f"p{p:g}" for p in TIMING_JITTER_PERCENTILES],
+                                       np.percentile(jitter, TIMING_JITTER_PERCENTILES).tolist()))
+        report["jitter_us"]["max"] = float(jitter.max())
+        report["interval_us"] = {"mean": float(intervals.mean() * 1e6), "max": float(intervals.max() * 1e6)}
+    if n:
+        report["channel_delay_us"] = dict(zip([f"p{p:g}" for p in TIMING_JITTER_PERCENTILES],
+                                              np.percentile(d_time, TIMING_JITTER_PERCENTILES).tolist()))
+        counts, edges = np.histogram(s_time, bins=TIMING_HISTOGRAM_EDGES_US + [max(s_time.max(), TIMING_HISTOGRAM_EDGES_US[-1]) + 1])
+        report["conversion_time_us"] = {
+            "mean": float(s_time.mean()),
+            "max": float(s_time.max()),
+            "histogram_edges": TIMING_HISTOGRAM_EDGES_US + ["inf"],
+            "histogram_counts": counts.tolist(),
+        }
+
+    return report
+
+
+def write_timing_report(filename, report):
+
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=4)
+
+
+# ================================================================================
+# SAMPLING SCHEDULER : ABSOLUTE MONOTONIC DEADLINES, SLEEP + SHORT FINAL SPIN
+# ================================================================================
+class sample_scheduler:
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.period_ns = int(round(1e9 / rate))
+        self.t_start_ns = time.perf_counter_ns()
+        self.next_deadline_ns = self.t_start_ns + self.period_ns
+        self.last_tick_ns = self.t_start_ns
+
+        # STATISTICS - RUNNING SUMS SO THE SAMPLING LOOP DOES NOT ALLOCATE
+        self.ticks = 0
+        self.missed = 0
+        self.dev_sum_ns = 0
+        self.dev_sq_sum_ns = 0
+        self.dev_max_ns = 0
+
+    # Wait for the next deadline, returns the time since the previous sample in seconds
+    def wait(self):
+        deadline = self.next_deadline_ns
+
+        remaining = deadline - time.perf_counter_ns()
+        if remaining > SCHEDULER_SPIN_NS:
+            time.sleep((remaining - SCHEDULER_SPIN_NS) / 1e9)
+        while time.perf_counter_ns() < deadline:
+            pass
+
+        now = time.perf_counter_ns()
+        late = now - deadline
+        if late > self.period_ns * SCHEDULER_MISSED_TOLERANCE:
+            # FELL BEHIND: SKIP THE DEADLINES WE MISSED INSTEAD OF BURSTING TO CATCH UP
+            self.missed += 1
+            self.next_deadline_ns = deadline + self.period_ns * (late // self.period_ns + 1)
+        else:
+            self.next_deadline_ns = deadline + self.period_ns
+
+        interval = now - self.last_tick_ns
+        dev = abs(interval - self.period_ns)
+        self.dev_sum_ns += dev
+        self.dev_sq_sum_ns += dev * dev
+        if dev > self.dev_max_ns:
+            self.dev_max_ns = dev
+
+        self.last_tick_ns = now
+        self.ticks += 1
+
+        return interval / 1e9
+
+    # Time of the latest sample since the scheduler was created, in seconds
+    def elapsed(self):
+        return (self.last_tick_ns - self.t_start_ns) / 1e9
+
+    def report(self):
+        if self.ticks == 0:
+            return {"target_rate": self.rate, "achieved_rate": 0.0, "ticks": 0, "missed": 0,
+                    "jitter_mean_us": 0.0, "jitter_rms_us": 0.0, "jitter_max_us": 0.0}
+
+        return {
+            "target_rate": self.rate,
+            "achieved_rate": self.ticks / self.elapsed(),
+            "ticks": self.ticks,
+            "missed": self.missed,
+            "jitter_mean_us": self.dev_sum_ns / self.ticks / 1e3,
+            "jitter_rms_us": (self.dev_sq_sum_ns / self.ticks) ** 0.5 / 1e3,
+            "jitter_max_us": self.dev_max_ns / 1e3,
+        }
+
+# ================================================================================
+# THREAD WAKE-UP METER : HOW OFTEN THE WAITING (LED, CANCEL, MAIN) THREADS WAKE UP
+# ================================================================================
+class wakeup_meter:
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.t_start = time.perf_counter()
+        self.counts = {}
+
+    def tick(self, name):
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    # Wake-ups per second for every thread that ticked
+    def report(self):
+        elapsed = max(time.perf_counter() - self.t_start, 1e-9)
+        return {name: count / elapsed for name, count in self.counts.items()}
+
+
+wakeups = wakeup_meter()
+
+# ================================================================================
+# GPIO ACCESS : VALUE FILES STAY OPEN, NO SHELL PROCESSES
+# ================================================================================
+class gpio_bank:
+
+    # root IS THE sysfs GPIO DIRECTORY - POINT IT AT A TEMP DIRECTORY WITH gpioN/value FILES FOR TESTING
+    def __init__(self, root=None, edge_wait=None):
+        self.root = root if root is not None else GPIO_PATH
+        self.edge_wait = edge_wait if edge_wait is not None else GPIO_EDGE_WAIT
+        self.fds = {}
+        self.failed = set()
+        self.lock = threading.Lock()
+        # SELF-PIPE SO interrupt() CAN WAKE A THREAD BLOCKED IN wait_for_edge()
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+
+    def _fd(self, chan):
+        fd = self.fds.get(chan)
+        if fd is None:
+            with self.lock:
+                fd = self.fds.get(chan)
+                if fd is None:
+                    fd = os.open(self.root + '/gpio' + chan + '/value', os.O_RDWR)
+                    self.fds[chan] = fd
+        return fd
+
+    # LEDS ARE BEST EFFORT: A MISSING CHANNEL IS REPORTED ONCE AND IGNORED (LIKE THE OLD echo COMMANDS)
+    def write(self, chan, value):
+        try:
+            os.pwrite(self._fd(chan), value.encode(), 0)
+        except OSError as e:
+            if chan not in self.failed:
+                self.failed.add(chan)
+                print(f"GPIO {chan} not writable: {e}")
+
+    def read(self, chan):
+        return os.pread(self._fd(chan), 1, 0).decode()
+
+    # ENABLES EDGE INTERRUPTS ON THE CHANNELS, RETURNS FALSE IF THE edge INTERFACE IS NOT AVAILABLE
+    def enable_edges(self, chans, edge="both"):
+        if not self.edge_wait or not hasattr(select, "poll"):
+            return False
+        try:
+            for chan in chans:
+                edge_fd = os.open(self.root + '/gpio' + chan + '/edge', os.O_WRONLY)
+                try:
+                    os.write(edge_fd, edge.encode())
+                finally:
+                    os.close(edge_fd)
+        except OSError as e:
+            print(f"GPIO edge interface not available ({e}), polling buttons every {BUTTON_POLL_INTERVAL}s")
+            return False
+        return True
+
+    def poller(self, chans):
+        poller = select.poll()
+        poller.register(self.wake_r, select.POLLIN)
+        for chan in chans:
+            fd = self._fd(chan)
+            os.pread(fd, 1, 0)  # READING CLEARS A PENDING EDGE
+            poller.register(fd, select.POLLPRI | select.POLLERR)
+        return poller
+
+    # BLOCKS UNTIL AN EDGE ON ONE OF THE POLLED CHANNELS, interrupt() OR THE TIMEOUT (SECONDS, None = FOREVER)
+    def wait_for_edge(self, poller, timeout=None):
+        events = poller.poll(None if timeout is None else timeout * 1000)
+        for fd, event in events:
+            if fd == self.wake_r:
+                try:
+                    os.read(self.wake_r, 64)
+                except BlockingIOError:
+                    pass
+            else:
+                os.pread(fd, 1, 0)
+        return len(events) > 0
+
+    def interrupt(self):
+        with self.lock:
+            if self.wake_w is not None:
+                os.write(self.wake_w, b"x")
+
+    # CLOSES THE VALUE FILES AND THE SELF-PIPE - SAFE TO CALL AGAIN, A LATER write() REOPENS ITS CHANNEL
+    def close(self):
+        with self.lock:
+            for fd in self.fds.values():
+                os.close(fd)
+            self.fds = {}
+            if self.wake_r is not None:
+                os.close(self.wake_r)
+                os.close(self.wake_w)
+                self.wake_r = self.wake_w = None
+
+
+gpio = None  # GPIO BACKEND USED BY THE LED / CANCEL THREADS - A gpio_bank, SET BY Device.open()
+
 # ================================================================================
 # GPIO CONTROL : CANCEL THREAD, PRESS BUTTON #2 AND #3 when sampling to cancel
 # ================================================================================
@@ -679,23 +1936,26 @@ class cancel_thread (threading.Thread):
 
     def run(self):
 
-        global stop_data_collection_process
-
-        while True:
-            valueFile_button2 = open(GPIO_PATH+'/gpio'+GPIO_CHAN_NUM_BUTTON2+'/value', 'r')
-            button_pressed2 = valueFile_button2.read(1)
-            valueFile_button2.close()
+        buttons = [GPIO_CHAN_NUM_BUTTON2, GPIO_CHAN_NUM_BUTTON3]
+        try:
+            # WITH EDGES THE THREAD SLEEPS UNTIL A BUTTON CHANGES (OR gpio.interrupt() AT SHUTDOWN)
+            timeout = None if gpio.enable_edges(buttons) else BUTTON_POLL_INTERVAL
+            poller = gpio.poller(buttons)
+        except OSError as e:
+            print(f"Cancel buttons not available: {e}")
+            return
 
-            valueFile_button3 = open(GPIO_PATH+'/gpio'+GPIO_CHAN_NUM_BUTTON3+'/value', 'r')
-            button_pressed3 = valueFile_button3.read(1)
-            valueFile_button3.close()
+        # EXITS AS SOON AS THE DATA COLLECTION IS OVER
+        while not shutdown_event.is_set():
+            gpio.wait_for_edge(poller, timeout)
+            if shutdown_event.is_set():
+                break
+            wakeups.tick(self.name)
 
-            if(button_pressed2 == '0' and button_pressed3 == '0'):
+            if all(gpio.read(button) == GPIO_BUTTON_PRESSED for button in buttons):
                 print("BOTH BUTTONS PRESSED in cancelthread...\n")
-                stop_data_collection_process = True
+                cancel_event.set()
 
-            time.sleep(1)
-                
 
 
 # ================================================================================
@@ -711,166 +1971,553 @@ class led_thread (threading.Thread):
 
     def run(self):
 
-        global running
-        global ready_for_data_collection
-
-        while(running):
+        while not shutdown_event.is_set():
             if(self.data_collection_mode == THREAD_DATA_COLLECTION_MODE_BASELINE):#BASELINE
-                valueFile_LED_RGB_BLUE = open(GPIO_PATH+'/gpio'+GPIO_CHAN_NUM_LED_RGB_BLUE+'/value', 'w')
                 time_start = time.time()
-                while time.time()-time_start < SEC+2 and running:
-                    valueFile_LED_RGB_BLUE.write(GPIO_VAL_HI)
-                    valueFile_LED_RGB_BLUE.flush()
-                    time.sleep(0.5)
-                    valueFile_LED_RGB_BLUE.write(GPIO_VAL_LO)
-                    valueFile_LED_RGB_BLUE.flush()
-                    time.sleep(0.5)
-
-                valueFile_LED_RGB_BLUE.close()
+                while time.time()-time_start < SEC+2 and not shutdown_event.is_set():
+                    gpio.write(GPIO_CHAN_NUM_LED_RGB_BLUE, GPIO_VAL_HI)
+                    shutdown_event.wait(0.5)
+                    wakeups.tick(self.name)
+                    gpio.write(GPIO_CHAN_NUM_LED_RGB_BLUE, GPIO_VAL_LO)
+                    shutdown_event.wait(0.5)
+                    wakeups.tick(self.name)
 
                 #FINISHED SAMPLING OR CANCELLED BASELINE READ - EXIT THREAD
                 return
 
             elif(self.data_collection_mode == THREAD_SAMPLING_MODE_WAIT_FOR_SAMPLE):#SAMPLE
-                valueFile_LED_RGB_GREEN = open(GPIO_PATH+'/gpio'+GPIO_CHAN_NUM_LED_RGB_GREEN+'/value', 'w')
                 time_start = time.time()
                 
-                while running and not ready_for_data_collection: # time.time()-time_start < SEC+2: #TODO: HOW LONG TO WAIT FOR A SAMPLE???
+                while not shutdown_event.is_set() and not sample_ready_event.is_set(): # time.time()-time_start < SEC+2: #TODO: HOW LONG TO WAIT FOR A SAMPLE???
 
-                    valueFile_LED_RGB_GREEN.write(GPIO_VAL_HI)
-                    valueFile_LED_RGB_GREEN.flush()
-                    time.sleep(0.5)
-                    valueFile_LED_RGB_GREEN.write(GPIO_VAL_LO)
-                    valueFile_LED_RGB_GREEN.flush()
-                    time.sleep(0.5)
-
-                #TODO: MAKE SURE WE CLOSE THIS AGAIN
-                valueFile_LED_RGB_GREEN.close()
+                    gpio.write(GPIO_CHAN_NUM_LED_RGB_GREEN, GPIO_VAL_HI)
+                    shutdown_event.wait(0.5)
+                    wakeups.tick(self.name)
+                    gpio.write(GPIO_CHAN_NUM_LED_RGB_GREEN, GPIO_VAL_LO)
+                    shutdown_event.wait(0.5)
+                    wakeups.tick(self.name)
 
                 #FINISHED SAMPLING OR CANCELLED AFTER BASELINE READ - EXIT THREAD
                 return
 
+            elif(self.data_collection_mode == THREAD_DATA_COLLECTION_MODE_MONITOR):#MONITOR - UNTIL CANCELLED
+                while not shutdown_event.is_set():
+                    gpio.write(GPIO_CHAN_NUM_LED_RGB_BLUE, GPIO_VAL_HI)
+                    gpio.write(GPIO_CHAN_NUM_LED_RGB_GREEN, GPIO_VAL_HI)
+                    shutdown_event.wait(0.5)
+                    wakeups.tick(self.name)
+                    gpio.write(GPIO_CHAN_NUM_LED_RGB_BLUE, GPIO_VAL_LO)
+                    gpio.write(GPIO_CHAN_NUM_LED_RGB_GREEN, GPIO_VAL_LO)
+                    shutdown_event.wait(0.5)
+                    wakeups.tick(self.name)
+
+                #MONITORING CANCELLED - EXIT THREAD
+                return
+
             else:#SAMPLE
-                valueFile_LED_RGB_RED = open(GPIO_PATH+'/gpio'+GPIO_CHAN_NUM_LED_RGB_RED+'/value', 'w')
                 time_start = time.time()
-                while time.time()-time_start < SEC+2 and running:
-
-                    valueFile_LED_RGB_RED.write(GPIO_VAL_HI)
-                    valueFile_LED_RGB_RED.flush()
-                    time.sleep(0.5)
-                    valueFile_LED_RGB_RED.write(GPIO_VAL_LO)
-                    valueFile_LED_RGB_RED.flush()
-                    time.sleep(0.5)
+                while time.time()-time_start < SEC+2 and not shutdown_event.is_set():
 
-                valueFile_LED_RGB_RED.close()
+                    gpio.write(GPIO_CHAN_NUM_LED_RGB_RED, GPIO_VAL_HI)
+                    shutdown_event.wait(0.5)
+                    wakeups.tick(self.name)
+                    gpio.write(GPIO_CHAN_NUM_LED_RGB_RED, GPIO_VAL_LO)
+                    shutdown_event.wait(0.5)
+                    wakeups.tick(self.name)
 
                 #FINISHED SAMPLING OR CANCELLED BASELINE READ - EXIT THREAD
                 return
     
 
         #TERMINATE THIS THREAD EARLY
-        if not running:
+        if shutdown_event.is_set():
 
             #SHUT OFF LEDS IF THREAD IS NOT RUNNING
-            valueFile_LED_RGB_BLUE = open(GPIO_PATH+'/gpio'+GPIO_CHAN_NUM_LED_RGB_BLUE+'/value', 'w')
-            valueFile_LED_RGB_BLUE.write(GPIO_VAL_LO)
-            valueFile_LED_RGB_BLUE.flush()
-            valueFile_LED_RGB_BLUE.close()
-
-            valueFile_LED_RGB_GREEN = open(GPIO_PATH+'/gpio'+GPIO_CHAN_NUM_LED_RGB_GREEN+'/value', 'w')
-            valueFile_LED_RGB_GREEN.write(GPIO_VAL_LO)
-            valueFile_LED_RGB_GREEN.flush()
-            valueFile_LED_RGB_GREEN.close()
-
-            valueFile_LED_RGB_RED = open(GPIO_PATH+'/gpio'+GPIO_CHAN_NUM_LED_RGB_RED+'/value', 'w')
-            valueFile_LED_RGB_RED.write(GPIO_VAL_LO)
-            valueFile_LED_RGB_RED.flush()
-            valueFile_LED_RGB_RED.close()
+            gpio.write(GPIO_CHAN_NUM_LED_RGB_BLUE, GPIO_VAL_LO)
+            gpio.write(GPIO_CHAN_NUM_LED_RGB_GREEN, GPIO_VAL_LO)
+            gpio.write(GPIO_CHAN_NUM_LED_RGB_RED, GPIO_VAL_LO)
             return
 
 
 
 # ================================================================================
-# SAMPLING THREAD
+# SIMULATED MCP3561 : DROP-IN SPI BACKEND (xfer2 / close) - NO DEVICE NEEDED
+# Decodes the command bytes built from the mcp3562_* constants: fast commands, static and
+# incremental reads, incremental writes of the register map. Conversions are paced by
+# OSR / prescaler (CONFIG1), scan delay (SCAN) and TIMER, follow ADC_MODE / CONV_MODE and
+# report DR_STATUS in the status byte and the IRQ register like the real part.
+# CH1 (A) carries a Dirac-shaped drain current through the TIA, CH2 (B) the gate triangle,
+# both turned into raw codes with the inverse of the calibration in effect when it is reset.
 # ================================================================================
-class data_collection_thread (threading.Thread):
-
-    data_collection_mode = 0
-    filename_str = ""
+SIM_REGISTER_SIZES = [3, 1, 1, 1, 1, 1, 1, 3, 3, 3, 3, 3, 1, 1, 2, 2]  # BYTES OF REGISTERS 0x0..0xF
+SIM_REGISTER_DEFAULTS = [0x000000, 0xC0, 0x0C, 0x8B, 0x00, 0x73, 0x01, 0x000000,
+                         0x000000, 0x000000, 0x800000, 0x900000, 0x50, 0xA5, 0x000C, 0x0000]  # POR VALUES, 0xE: MCP3561 ID
+SIM_READ_ONLY_REGISTERS = [mcp3562_reg_adcdata, 0xE, mcp3562_reg_crccfg]
+SIM_OSR = [32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 20480, 24576, 40960, 49152, 81920, 98304]  # BY CONFIG1 OSR[3:0]
+SIM_CHANNEL_A = 0x1  # CH1: MUX VIN+ / SCAN CHANNEL ID
+SIM_CHANNEL_B = 0x2  # CH2
+SIM_CHANNEL_TEMP = [0xD, 0xE]  # INTERNAL TEMPERATURE DIODE M / P
+SIM_TEMP_DIODE_VOLTAGE = 0.6  # V
+SIM_NOISE_OSR = 256  # noise_lsb IS THE RMS NOISE AT THIS OSR, IT SCALES WITH 1/sqrt(OSR)
+
+
+class simulated_mcp3561:
+
+    # dirac_voltage: GATE VOLTAGE OF THE Ids MINIMUM, hysteresis: REVERSE MINUS FORWARD SWEEP DIRAC VOLTAGE
+    # sweep_period: SECONDS FOR ONE FORWARD + REVERSE SWEEP OF THE GATE BETWEEN low_lim AND upp_lim
+    # conversion_latency: SECONDS ADDED TO EVERY CONVERSION, xfer_time: SECONDS SLEPT IN EVERY xfer2()
+    def __init__(self, dirac_voltage=0.2, hysteresis=-0.02, sweep_period=10.0, i_min=4e-5, curvature=3e-5,
+                 noise_lsb=20.0, conversion_latency=0.0, xfer_time=0.0, seed=None):
+        self.dirac_voltage = dirac_voltage
+        self.hysteresis = hysteresis
+        self.sweep_period = sweep_period
+        self.i_min = i_min
+        self.curvature = curvature
+        self.noise_lsb = noise_lsb
+        self.conversion_latency = conversion_latency
+        self.xfer_time = xfer_time
+        self.random = random.Random(seed)
+        self.transactions = 0
+        self.reset()
+
+    def open(self, bus, device):
+        pass
+
+    def close(self):
+        pass
+
+    # FULL RESET: POR REGISTER VALUES, NO CONVERSION RUNNING, CALIBRATION RE-READ
+    def reset(self):
+        self.registers = list(SIM_REGISTER_DEFAULTS)
+        self.coefficients = fold_calibration_coefficients()
+        self.t0 = time.perf_counter()
+        self.data = 0
+        self.data_channel = 0
+        self.data_ready = False
+        self.cycle = []
+        self.position = 0
+        self.next_done = None
+
+    def field(self, register, shift, mask):
+        return (self.registers[register] >> shift) & mask
+
+    def osr(self):
+        return SIM_OSR[self.field(mcp3562_reg_config1, 2, 0xF)]
+
+    # DMCLK = MCLK / PRESCALER / 4, A CONVERSION TAKES 3 x OSR DMCLK (SINC3 SETTLING)
+    def conversion_time(self):
+        dmclk_hz = ADC_MCLK_HZ / (1 << self.field(mcp3562_reg_config1, 6, 0x3)) / 4
+        return 3 * self.osr() / dmclk_hz + self.conversion_latency
+
+    def start(self, now):
+        channels = self.registers[mcp3562_reg_scan] & 0xFFFF
+        self.cycle = [channel for channel in range(16) if channels >> channel & 1] or [None]  # None: MUX MODE
+        self.position = 0
+        self.data_ready = False  # A RESTART DISCARDS THE UNREAD RESULT
+        self.registers[mcp3562_reg_config0] |= 0b11  # ADC_MODE: CONVERSION
+        self.next_done = now + self.conversion_time()
+
+    def stop(self, adc_mode):
+        self.registers[mcp3562_reg_config0] = (self.registers[mcp3562_reg_config0] & ~0b11) | adc_mode
+        self.next_done = None
+
+    # Latches every conversion that finished by now (an unread result is overwritten, like the ADC does)
+    def advance(self, now):
+        while self.next_done is not None and self.next_done <= now:
+            done = self.next_done
+            self.data_channel = self.cycle[self.position]
+            self.data = self.sample(self.data_channel, done)
+            self.data_ready = True
+
+            scan_mode = self.cycle[0] is not None
+            self.position += 1
+            if self.position < len(self.cycle):
+                delay = SCAN_MODE_DELAY_DMCLK[self.field(mcp3562_reg_scan, 21, 0x7)] * 4 / ADC_MCLK_HZ
+                self.next_done = done + delay + self.conversion_time()
+            elif self.field(mcp3562_reg_config3, 6, 0x3) == CONV_MODE_CONTINIOUS:
+                self.position = 0
+                timer = self.registers[mcp3562_reg_timer] * 4 / ADC_MCLK_HZ if scan_mode else 0
+                self.next_done = done + timer + self.conversion_time()
+            elif self.field(mcp3562_reg_config3, 6, 0x3) == CONV_MODE_ONE_SHOT_STANDBY:
+                self.stop(ADC_MODE_STANDBY_MODE)
+            else:
+                self.stop(ADC_MODE_SHUTDOWN_MODE)
+
+    # Gate voltage at t seconds (triangle from low_lim to upp_lim and back) and whether it is rising
+    def gate_voltage(self, t):
+        phase = (t / self.sweep_period) % 1.0
+        forward = phase < 0.5
+        fraction = 2 * phase if forward else 2 - 2 * phase
+        return low_lim + (upp_lim - low_lim) * fraction, forward
+
+    # Signed raw code of a conversion of channel (None: the MUX VIN+ input) finishing at time now
+    def sample(self, channel, now):
+        if channel is None:
+            channel = self.field(mcp3562_reg_mux, 4, 0xF)
+        vgate, forward = self.gate_voltage(now - self.t0)
+
+        if channel == SIM_CHANNEL_A:
+            dirac = self.dirac_voltage + (0 if forward else self.hysteresis)
+            voltage_A = (self.i_min + self.curvature * (vgate - dirac) ** 2) * CURRENT_GAIN
+            # INVERT THE TIA CUBIC WITH A FEW NEWTON STEPS FROM THE LINEAR TERM
+            a3, a2, a1, a0 = self.coefficients["voltage_A"]
+            raw = (voltage_A - a0) / a1
+            for i in range(4):
+                raw -= (((a3 * raw + a2) * raw + a1) * raw + a0 - voltage_A) / ((3 * a3 * raw + 2 * a2) * raw + a1)
+        elif channel == SIM_CHANNEL_B:
+            g1, g0 = self.coefficients["Vgate"]
+            raw = (vgate - g0) / g1
+        elif channel in SIM_CHANNEL_TEMP:
+            raw = SIM_TEMP_DIODE_VOLTAGE * FULL_SCALE_RESOLUTION / VOLTAGE_SCALE
+        else:
+            raw = 0.0
+
+        raw += self.random.gauss(0.0, self.noise_lsb * (SIM_NOISE_OSR / self.osr()) ** 0.5)
+        return min(max(int(round(raw)), -0x800000), 0x7FFFFF)
+
+    # ADCDATA in the CONFIG3 DATA_FORMAT: 24 bit, 24 bit left justified, sign extended or channel id + sign
+    def adcdata_bytes(self):
+        code = self.data & 0xFFFFFF
+        data = [(code >> 16) & 0xFF, (code >> 8) & 0xFF, code & 0xFF]
+        data_format = self.field(mcp3562_reg_config3, 4, 0x3)
+        sign = 0xFF if self.data < 0 else 0x00
+        if data_format == 0b01:
+            return data + [0x00]
+        if data_format == 0b10:
+            return [sign] + data
+        if data_format == 0b11:
+            return [((self.data_channel or 0) << 4) | (sign & 0xF)] + data
+        return data
+
+    def register_bytes(self, register):
+        if register == mcp3562_reg_adcdata:
+            return self.adcdata_bytes()
+        value = self.registers[register]
+        if register == mcp3562_reg_irq:
+            # DR_STATUS (ACTIVE LOW), CRCCFG_STATUS AND POR_STATUS (NO ERROR) ARE LIVE
+            value = (value & 0b00001111) | ((not self.data_ready) << 6) | 0b00110000
+        size = SIM_REGISTER_SIZES[register]
+        return [(value >> (8 * (size - 1 - i))) & 0xFF for i in range(size)]
+
+    # STATUS BYTE CLOCKED OUT WITH THE COMMAND: DEVICE ADDRESS, DR_STATUS, CRCCFG_STATUS, POR_STATUS
+    def status_byte(self):
+        addr = mcp3562_internal_device_addr
+        return ((addr >> 1) << 5) | ((~addr & 1) << 4) | ((not self.data_ready) << 2) | 0b11
+
+    def write_registers(self, register, data, now):
+        while data:
+            size = SIM_REGISTER_SIZES[register]
+            value_bytes, data = data[:size], data[size:]
+            if register not in SIM_READ_ONLY_REGISTERS:
+                value = 0
+                for byte in value_bytes:
+                    value = (value << 8) | (byte & 0xFF)
+                value <<= 8 * (size - len(value_bytes))
+                if register == mcp3562_reg_irq:
+                    value = (self.registers[register] & ~0b00001111) | (value & 0b00001111)
+                self.registers[register] = value
+            register = (register + 1) & 0xF
+
+        # A WRITE TO CONFIG0..MUX RESTARTS A RUNNING CONVERSION, ADC_MODE STANDBY / SHUTDOWN STOPS IT
+        adc_mode = self.field(mcp3562_reg_config0, 0, 0x3)
+        if adc_mode == ADC_MODE_CONVERSION_MODE:
+            self.start(now)
+        else:
+            self.stop(adc_mode)
+
+    def fast_command(self, command, now):
+        if not self.field(mcp3562_reg_irq, 1, 0x1):  # EN_FASTCMD
+            return
+        if command == mcp3562_cmd_conversion_start:
+            self.start(now)
+        elif command == mcp3562_cmd_standby:
+            self.stop(ADC_MODE_STANDBY_MODE)
+        elif command in (mcp3562_cmd_shutdown, mcp3562_cmd_full_shutdown):
+            self.stop(ADC_MODE_SHUTDOWN_MODE)
+        elif command == mcp3562_cmd_full_reset:
+            self.reset()
+
+    def xfer2(self, msg):
+        self.transactions += 1
+        if self.xfer_time:
+            time.sleep(self.xfer_time)
+        now = time.perf_counter()
+        self.advance(now)
+
+        reply = [0] * len(msg)
+        command = msg[0]
+        if command >> 6 != mcp3562_internal_device_addr:
+            return reply  # NOT ADDRESSED
+
+        reply[0] = self.status_byte()
+        register = (command >> 2) & 0xF
+        command_type = command & 0b11
+
+        if command_type == mcp3562_cmd_type_fast_cmd:
+            self.fast_command(register, now)
+        elif command_type == mcp3562_cmd_type_static_read:
+            data = self.register_bytes(register)
+            for i in range(1, len(msg)):
+                reply[i] = data[(i - 1) % len(data)]
+            if register == mcp3562_reg_adcdata and len(msg) > 1:
+                self.data_ready = False
+        elif command_type == mcp3562_cmd_type_inc_read:
+            data = []
+            while len(data) < len(msg) - 1:
+                data += self.register_bytes(register)
+                if register == mcp3562_reg_adcdata:
+                    self.data_ready = False
+                register = (register + 1) & 0xF
+            reply[1:] = data[:len(msg) - 1]
+        elif command_type == mcp3562_cmd_type_inc_write:
+            self.write_registers(register, list(msg[1:]), now)
+
+        return reply
 
-    def __init__(self, threadID, name, mode, timestamp):
-        threading.Thread.__init__(self)
-        self.threadID = threadID
-        self.name = name
-        self.data_collection_mode = mode #BASELINE OR SAMPLING
-        self.filename_str = timestamp
 
-    def run(self):
+# ================================================================================
+# ENGINE : DEVICE, CALIBRATION, ACQUISITION AND POST PROCESSING OBJECTS
+# Nothing touches the hardware or calib.json at import time. The ADC functions above
+# use the module globals spi / gpio and the calibration globals - these objects set them,
+# so the hot paths can be run against any SPI / GPIO backend (benchmarks, host tests).
+# ================================================================================
+class Device:
+
+    # spi_backend: OBJECT WITH xfer2() / close(), DEFAULT spidev ON /dev/spidev<SPI_BUS>.<SPI_DEVICE>
+    #              (simulated_mcp3561 WITH ADC_SIMULATED)
+    # gpio_backend: gpio_bank, DEFAULT ON GPIO_PATH
+    def __init__(self, spi_backend=None, gpio_backend=None):
+        self.spi = spi_backend
+        self.gpio = gpio_backend
+
+    def open(self):
+
+        global spi
+        global gpio
+
+        if self.spi is None and ADC_SIMULATED:
+            self.spi = simulated_mcp3561()
+        if self.spi is None:
+            import spidev  # SPI interface - ONLY NEEDED ON THE DEVICE
+            self.spi = spidev.SpiDev()
+            self.spi.open(SPI_BUS, SPI_DEVICE)
+            self.spi.max_speed_hz = SPI_MAX_SPEED_HZ
+            self.spi.mode = SPI_MODE
+            self.spi.cshigh = False
+        if self.gpio is None:
+            self.gpio = gpio_bank()
+
+        spi = self.spi
+        gpio = self.gpio
+        return self
+
+    # Write ADC config for ADC_SCAN_MODE / ADC_STREAMING_MODE as they are now - REQUIRED BEFORE SAMPLING
+    def configure(self, do_print=True):
+        configure_acquisition_path(ADC_SCAN_MODE, ADC_STREAMING_MODE)
+        read_config(do_print, config_snapshot)
+
+    def leds_ready(self):
+        self.gpio.write(GPIO_CHAN_NUM_LED_RED, GPIO_VAL_LO)  # RED
+        self.gpio.write(GPIO_CHAN_NUM_LED_GREEN, GPIO_VAL_HI)  # GREEN - WIFI CONNECTED AND TIME UPDATED
+        self.gpio.write(GPIO_CHAN_NUM_LED_AMBER, GPIO_VAL_LO)  # AMBER
+
+        self.gpio.write(GPIO_CHAN_NUM_LED_RGB_RED, GPIO_VAL_LO)  # RGB RED
+        self.gpio.write(GPIO_CHAN_NUM_LED_RGB_GREEN, GPIO_VAL_LO)  # RGB GREEN
+        self.gpio.write(GPIO_CHAN_NUM_LED_RGB_BLUE, GPIO_VAL_LO)  # RGB BLUE
+
+    def leds_off(self):
+        self.gpio.write(GPIO_CHAN_NUM_LED_RED, GPIO_VAL_LO)  # RED
+        self.gpio.write(GPIO_CHAN_NUM_LED_GREEN, GPIO_VAL_LO)  # GREEN
+        self.gpio.write(GPIO_CHAN_NUM_LED_AMBER, GPIO_VAL_LO)  # AMBER
+
+        self.gpio.write(GPIO_CHAN_NUM_LED_RGB_RED, GPIO_VAL_LO)  # RGB RED
+        self.gpio.write(GPIO_CHAN_NUM_LED_RGB_GREEN, GPIO_VAL_LO)  # RGB GREEN
+        self.gpio.write(GPIO_CHAN_NUM_LED_RGB_BLUE, GPIO_VAL_LO)  # RGB BLUE
+
+    def close(self):
+        # CLOSE SPI ACCESS
+        self.spi.close()
+        self.leds_off()
+        self.gpio.close()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Calibration:
+
+    def __init__(self, values=None):
+        self.values = dict(CALIB_DEFAULTS)
+        if values is not None:
+            self.values.update(values)
+
+    # GET CALIB VALUES FROM FILE IF EXISTS, ELSE CREATE WITH DEFAULTS
+    @classmethod
+    def load(cls, filename=None, create=True):
+        if filename is None:
+            filename = CALIB_FILENAME
+        if path.exists(filename):
+            print("Calib file exists.")
+        elif create:
+            print("Calib file does not exists. Creating file with default values.")
+            with open(filename, 'w') as outfile:
+                json.dump({'ADC_CALIB': [CALIB_DEFAULTS]}, outfile)
+        else:
+            return cls()
+
+        with open(filename) as f:
+            data = json.load(f)
+        return cls(data["ADC_CALIB"][0])
+
+    # WRITES THE VALUES BACK, KEEPING ANYTHING ELSE IN THE FILE
+    def save(self, filename=None):
+        if filename is None:
+            filename = CALIB_FILENAME
+        data = {}
+        if path.exists(filename):
+            with open(filename) as f:
+                data = json.load(f)
+        data["ADC_CALIB"] = [self.values]
+        with open(filename, 'w') as outfile:
+            json.dump(data, outfile)
+
+    # Makes these values the ones used by the conversion functions and file headers
+    def apply(self):
+
+        global ADC_CALIBRATION_GAIN, ADC_CALIBRATION_OFFSET, VOLTAGE_SCALE, FULL_SCALE_RESOLUTION
+        global GATE_GAIN, CURRENT_GAIN, GATE_OFFSET
+        global TIA_GAIN_1, TIA_GAIN_2, TIA_GAIN_3, TIA_GAIN_4
+        global DEVICE_ID
+        global CONFIG_OSR, ADC_SAMPLING_RATE, stream_rate
+
+        ADC_CALIBRATION_GAIN = self.values["ADC_CALIBRATION_GAIN"]
+        ADC_CALIBRATION_OFFSET = self.values["ADC_CALIBRATION_OFFSET"]
+        VOLTAGE_SCALE = self.values["VOLTAGE_SCALE"]
+        FULL_SCALE_RESOLUTION = self.values["FULL_SCALE_RESOLUTION"]
+        GATE_GAIN = self.values["GATE_GAIN"]
+        CURRENT_GAIN = self.values["CURRENT_GAIN"]
+        GATE_OFFSET = self.values["GATE_OFFSET"]
+        TIA_GAIN_1 = self.values["TIA_GAIN_1"]
+        TIA_GAIN_2 = self.values["TIA_GAIN_2"]
+        TIA_GAIN_3 = self.values["TIA_GAIN_3"]
+        TIA_GAIN_4 = self.values["TIA_GAIN_4"]
+        DEVICE_ID = self.values["DEVICE_ID"]
+        CONFIG_OSR = self.values["CONFIG_OSR"]
+        ADC_SAMPLING_RATE = self.values["ADC_SAMPLING_RATE"]
+        if stream_rate is not None:
+            stream_rate = ADC_SAMPLING_RATE
+        return self
+
+
+class Acquisition:
+
+    def __init__(self, n_max=None):
+
+        if n_max is None:
+            n_max = NN
 
         # INITIATE ARRAYS
         # =============================================================
 
         # Required arrays:
-        _adc_A = arr.array("i", [0]*NN)  # Raw adc data ch1
-        _adc_B = arr.array("i", [0]*NN)  # raw ADC data ch2
+        self.adc_A = arr.array("i", [0]*n_max)  # Raw adc data ch1
+        self.adc_B = arr.array("i", [0]*n_max)  # raw ADC data ch2
 
-        _voltage_A = arr.array("d", [0]*NN)  # voltage data ch1
-        _voltage_B = arr.array("d", [0]*NN)  # voltage data ch2
+        self.voltage_A = arr.array("d", [0]*n_max)  # voltage data ch1 - ONLY FILLED HERE WHEN USING FAKE DATA
 
-        _time = arr.array("d", [0]*NN)  # Sys time - start_time
+        self.time = arr.array("d", [0]*n_max)  # Sys time - start_time
 
         # Delta time between sampling two data channels
-        _d_time = arr.array("d", [0]*NN)
+        self.d_time = arr.array("d", [0]*n_max)
 
         # total sampling time incluting mux config, sampling and read data for 2x channels
-        _s_time = arr.array("d", [0]*NN)
-
-        _fs_time = arr.array("d", [0]*NN)  # Sampling f - desired at sampling frequency
-
-        _slope = arr.array("i", [0]*NN)
-        _peak = arr.array("i", [0]*NN)
-
+        self.s_time = arr.array("d", [0]*n_max)
+
+        self.fs_time = arr.array("d", [0]*n_max)  # Sampling f - desired at sampling frequency
+
+        # SLOPE / PEAKS / SWEEPS OF adc_B WHILE SAMPLING
+        self.segmenter = sweep_segmenter(self.adc_B, n_max) if ONLINE_SEGMENTATION else None
+        self.stop_rule = adaptive_stop(self) if ADAPTIVE_STOP and ONLINE_SEGMENTATION else None
+
+        self.n = 0  # SAMPLES CAPTURED
+        self.scheduler_report = None
+        self.stop_reason = None  # "duration", "sweeps", "adaptive" OR "buffer full"
+        self.t_start = None
+        self.t_end = None
+
+    # Columns of the chunk file, in raw_chunk_file_header order
+    def raw_columns(self):
+        return [self.time, self.d_time, self.s_time, self.fs_time, self.adc_A, self.adc_B]
+
+    # Online work on the samples up to n, between samples / blocks - returns True when the run can end early
+    def update(self, n):
+        if self.segmenter is None:
+            return False
+        if self.segmenter.update(n) and STOP_AT_SWEEPS:
+            self.stop_reason = "sweeps"
+            return True
+        if self.stop_rule is not None and self.stop_rule.update(n):
+            self.stop_reason = "adaptive"
+            return True
+        return False
+
+    # Samples for duration seconds (and at least duration*ADC_SAMPLING_RATE samples) unless update()
+    # ends it sooner or the buffers are full, returns False if the test was cancelled
+    def run(self, chunk_writer=None, duration=None):
+
+        global scan_restarts
+
+        if duration is None:
+            duration = SEC
+        self.n = 0
+        self.t_start = time.time()
+        self.stop_reason = "duration"
+        scan_restarts = 0
+        update = self.update
+        if self.segmenter is not None:
+            self.segmenter.reset()
+        if self.stop_rule is not None:
+            self.stop_rule.reset()
+
+        if ADC_STREAMING_MODE:
+            # HARDWARE PACED: THE ADC RUNS THE SCAN CYCLES, WE ONLY COLLECT THE RESULTS
+            index_t = acquire_stream(self.adc_A, self.adc_B, self.time, self.d_time, self.s_time, self.fs_time,
+                                     duration=duration, chunk_writer=chunk_writer, progress=update)
+            self.t_end = time.time()
+            if index_t < 0:
+                return False
+            self.n = index_t
+            self.scheduler_report = stream_report(self.fs_time, index_t, stream_rate)
+            return True
+
+        _adc_A, _adc_B, _voltage_A = self.adc_A, self.adc_B, self.voltage_A
+        _time, _d_time, _s_time, _fs_time = self.time, self.d_time, self.s_time, self.fs_time
+        t_start = self.t_start
+        scheduler = sample_scheduler(ADC_SAMPLING_RATE)
+        n_max = len(_adc_A)
         index_t = 0
 
-        t_start = time.time()
-        last_conv_time = time.time()
-
-        global running
-        global mean_dirac_forward_sweep
-        global mean_dirac_reverse_sweep
-
-    
-        # START DATA COLLECTION LOOP
-        log("data_collection_thread: Starting data collection loop")
-        while (((t_start+SEC) > time.time()) or (index_t < SEC*ADC_SAMPLING_RATE)):  # Sample for x secs
-
-            #TERMINATE THIS THREAD EARLY IF TEST IS CANCELLED
-            if not running:
-                return
+        while ((t_start+duration) > time.time()) or (index_t < duration*ADC_SAMPLING_RATE):  # Sample for x secs
 
-            # WAIT TILL YOU ARE READY TO TAKE NEXT SAMPLE
-            while (time.time() - last_conv_time < (1.0/ADC_SAMPLING_RATE)):
-                m = 1
+            #TERMINATE EARLY IF TEST IS CANCELLED
+            if cancel_event.is_set():
+                self.n = index_t
+                return False
 
-            _fs_time[index_t] = time.time() - last_conv_time
-            last_conv_time = time.time()
+            # NN SAMPLES ARE ALL A RUN CAN HOLD - LONGER ONES NEED THE MONITOR MODE
+            if index_t >= n_max:
+                self.stop_reason = "buffer full"
+                break
 
-            _time[index_t] = time.time() - t_start
-            time_conv_start = time.time()  # START CONV
-            set_mux_mode(mux_selection_1)
-            start_conversion()
+            # WAIT TILL THE NEXT SAMPLING DEADLINE
+            _fs_time[index_t] = scheduler.wait()
 
-            while wait_for_data() == True:
-                m = 1
-            time_sample1_end = time.time()  # END CONV
-            _adc_A[index_t] = read_adc_d_24()
-
-            set_mux_mode(mux_selection_2)
-            start_conversion()
-            while wait_for_data() == True:
-                m = 1
-            time_sample2_end = time.time()  # END CONV
-            _adc_B[index_t] = read_adc_d_24()
+            _time[index_t] = scheduler.elapsed()
+            time_conv_start = time.perf_counter()  # START CONV
+            _adc_A[index_t], _adc_B[index_t], time_sample1_end, time_sample2_end = acquire_sample()
 
             if USE_FAKE_DATA:
                 # Change Ids data
@@ -888,208 +2535,586 @@ class data_collection_thread (threading.Thread):
                         _voltage_A[index_t] = (fake_voltage_channel2)
 
 
-            time_conv_end = time.time()  # END CONV
+            time_conv_end = time.perf_counter()  # END CONV
             _s_time[index_t] = time_conv_end - time_conv_start
 
             _d_time[index_t] = time_sample2_end - time_sample1_end
 
             index_t += 1
 
-        t_end = time.time()
-        log("data_collection_thread: post processing")
-
-        # =============================================================================
-        # POST PROCESSING - FIND SECTIONS BETWEEN PEAKS ON TRIAGLE
-        # =============================================================================
-
-        #TERMINATE THIS THREAD EARLY IF TEST IS CANCELLED
-        if not running:
-            return
-
-        os.system("echo 1 > /sys/class/gpio/gpio146/value")  # AMBER
-        print("PROCESSING DATA...\n")
-
-        forward_sections = [[0] * NN for i in range(secs)]
-        reverse_sections = [[0] * NN for i in range(secs)]
-        forward_sections_time = [[0] * NN for i in range(secs)]
-        reverse_sections_time = [[0] * NN for i in range(secs)]
-        forward_sections_used = [0]*secs
-        reverse_sections_used = [0]*secs
+            if chunk_writer is not None and index_t >= chunk_writer.next_chunk:
+                chunk_writer.submit(index_t)
 
-        sec_used_counter_forward = 0
-        sec_used_counter_reverse = 0
-        section_index_forward = 0
-        section_index_reverse = 0
-        sec_data_index = 0
-
-        # START AND END POINTS FOR SWEEPS
-        start = []
-        end = []
-        sweep_type = []
-
-        for i in range(index_t):
-
-            #TERMINATE THIS THREAD EARLY IF TEST IS CANCELLED
-            if not running:
-                return
+            if update(index_t):
+                break
 
-            # ALREADY POPULATED THIS DATA WHEN USING FAKE DATA
-            if not  USE_FAKE_DATA:
-                _voltage_A[i] = conv_raw_adc_to_voltage(_adc_A[i],'A')
+        self.t_end = time.time()
+        self.n = index_t
+        self.scheduler_report = scheduler.report()
+        return True
 
-            # CONVERT RAW ADC VALUES TO VOLTAGE
-            _voltage_B[i] = conv_raw_adc_to_voltage(_adc_B[i],'B')
 
-            # FIND SLOPE (+ or -) FOR TRIANGLE (CH2) (s =(y2-y1)/(x2-x1))
-            if(i > slope_range):
-                if (_voltage_B[i-slope_range] - _voltage_B[i]) / slope_range > 0:
-                    _slope[i] = -1
-                else:
-                    _slope[i] = 1
-            else:
-                _slope[i] = 0
-
-            # FIND PEAK
-            if(i > slope_range):
-                if((_slope[i] != _slope[i-1])):
-                    if(_slope[i] == 1):
-                        _peak[i] = -1  # NEGATIVE PEAK
-                    else:
-                        _peak[i] = 1  # POSITIVE PEAK
+# ================================================================================
+# ACQUISITION PROCESS : SAMPLING IN ITS OWN (FORKED) PROCESS, PINNED TO A CPU, SCHED_FIFO IF ALLOWED
+# The child runs the same sampling loops as Acquisition and publishes every sample to a shared memory
+# ring buffer through Acquisition.update(). The main process copies the ring into its own buffers and
+# does the online segmentation, adaptive stop and chunk file there, so the LED / cancel / post
+# processing threads never hold the GIL the sampling loop needs. The SPI device opened by Device is
+# inherited by the fork and only used by the child while it runs.
+# The fork happens while the log writer, LED / cancel and daemon threads run, so the child holds copies
+# of their locks (stdout, log queue) in whatever state they were: it must not print() or log() - its
+# messages go back to the main process with the result. Off by default (ACQUISITION_PROCESS).
+# ================================================================================
+SAMPLE_RING_HEADER = 64  # BYTES: int64 SLOTS BELOW, PADDED
+SAMPLE_RING_WRITTEN = 0  # SAMPLES PUBLISHED BY THE ACQUISITION PROCESS
+SAMPLE_RING_READ = 1  # SAMPLES COPIED OUT BY THE MAIN PROCESS
+SAMPLE_RING_COLUMNS = ["adc_A", "adc_B", "voltage_A", "time", "d_time", "s_time", "fs_time"]
+
+
+class sample_ring:
+
+    # Allocates one shared memory block: header, then size samples of every column (typecodes from arrays)
+    def __init__(self, arrays, size=None):
+        if size is None:
+            size = SAMPLE_RING_SIZE
+        self.size = size
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=SAMPLE_RING_HEADER + size * sum(array.itemsize for array in arrays))
+        self.header = self.shm.buf[:SAMPLE_RING_HEADER].cast("q")
+        self.header[SAMPLE_RING_WRITTEN] = 0
+        self.header[SAMPLE_RING_READ] = 0
+        self.columns = []
+        offset = SAMPLE_RING_HEADER
+        for array in arrays:
+            self.columns.append(self.shm.buf[offset:offset + size * array.itemsize].cast(array.format))
+            offset += size * array.itemsize
+
+    def written(self):
+        return self.header[SAMPLE_RING_WRITTEN]
+
+    # Copies samples start:end between the full length columns and the ring, split where it wraps
+    def copy(self, columns, start, end, to_ring):
+        size = self.size
+        while start < end:
+            j = start % size
+            stop = min(end, start + size - j)
+            for ring_column, column in zip(self.columns, columns):
+                if to_ring:
+                    ring_column[j:j + stop - start] = column[start:stop]
                 else:
-                    _peak[i] = 0
-            else:
-                _peak[i] = 0
+                    column[start:stop] = ring_column[j:j + stop - start]
+            start = stop
+
+    # ACQUISITION PROCESS: PUBLISH start:end - False IF THAT WOULD OVERWRITE SAMPLES NOT READ YET
+    def write(self, columns, start, end):
+        if end - self.header[SAMPLE_RING_READ] > self.size:
+            return False
+        self.copy(columns, start, end, True)
+        self.header[SAMPLE_RING_WRITTEN] = end
+        return True
+
+    # MAIN PROCESS: COPY OUT EVERYTHING PUBLISHED SINCE start, RETURNS THE NEW END
+    def read(self, columns, start):
+        end = self.header[SAMPLE_RING_WRITTEN]
+        self.copy(columns, start, end, False)
+        self.header[SAMPLE_RING_READ] = end
+        return end
+
+    def close(self):
+        self.header.release()
+        for column in self.columns:
+            column.release()
+        self.shm.close()
+        self.shm.unlink()
+
+
+# Pins the calling process to one CPU and gives it real-time priority, as far as it is allowed to.
+# Returns what could not be done as messages - it runs in the forked child, which must not print
+
+
+def set_acquisition_priority(cpu, fifo, priority):
+
+    messages = []
+    if cpu is not None:
+        try:
+            os.sched_setaffinity(0, {sorted(os.sched_getaffinity(0))[cpu]})
+        except (OSError, IndexError, AttributeError) as e:
+            messages.append(f"Acquisition process not pinned to CPU {cpu}: {e}")
+    if fifo:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        except (OSError, AttributeError) as e:
+            messages.append(f"Acquisition process not SCHED_FIFO: {e}")
+    return messages
+
+
+class AcquisitionProcess(Acquisition):
+
+    def __init__(self, n_max=None, ring_size=None):
+        super().__init__(n_max)
+        self.ring_size = ring_size if ring_size is not None else SAMPLE_RING_SIZE
+        self.ring = None
+        self.in_process = False  # True IN THE FORKED ACQUISITION PROCESS
+        self.stop_event = None
+        self.published = 0
+
+    def ring_columns(self):
+        return [memoryview(getattr(self, name)) for name in SAMPLE_RING_COLUMNS]
+
+    # IN THE ACQUISITION PROCESS: PUBLISH THE NEW SAMPLES, THE MAIN PROCESS DECIDES WHEN THE RUN ENDS
+    def update(self, n):
+        if not self.in_process:
+            return super().update(n)
+        if not self.ring.write(self.published_columns, self.published, n):
+            self.stop_reason = "ring full"
+            return True
+        self.published = n
+        return self.stop_event.is_set()
+
+    # Body of the acquisition process - the sampling loops check the module cancel_event
+    def sample(self, duration, stop_event, process_cancel_event, connection):
+
+        global cancel_event
+
+        cancel_event = process_cancel_event
+        self.in_process = True
+        self.stop_event = stop_event
+        self.published = 0
+        self.published_columns = self.ring_columns()
+        messages = set_acquisition_priority(ACQUISITION_CPU, ACQUISITION_SCHED_FIFO, ACQUISITION_FIFO_PRIORITY)
+        try:
+            completed = Acquisition.run(self, duration=duration)
+            self.update(self.n)
+            connection.send({"completed": completed, "n": self.n, "scheduler_report": self.scheduler_report,
+                             "t_start": self.t_start, "t_end": self.t_end, "stop_reason": self.stop_reason,
+                             "scan_restarts": scan_restarts, "messages": messages})
+        except Exception as e:
+            connection.send({"error": repr(e), "messages": messages})
+
+    # Same as Acquisition.run, with the sampling done by a new process for this run
+    def run(self, chunk_writer=None, duration=None):
+
+        global scan_restarts
+
+        if duration is None:
+            duration = SEC
+        self.n = 0
+        self.stop_reason = None
+        if self.segmenter is not None:
+            self.segmenter.reset()
+        if self.stop_rule is not None:
+            self.stop_rule.reset()
+
+        context = multiprocessing.get_context("fork")  # THE CHILD USES THE SPI DEVICE OPENED HERE
+        stop_event = context.Event()
+        process_cancel_event = context.Event()
+        receiver, sender = context.Pipe(duplex=False)
+        self.ring = sample_ring(self.ring_columns(), self.ring_size)
+        process = context.Process(target=self.sample, args=(duration, stop_event, process_cancel_event, sender),
+                                  name="Process-Acquisition", daemon=True)
+        result = None
+        try:
+            process.start()
+            columns = self.ring_columns()
+            while result is None:
+                if receiver.poll(ACQUISITION_DRAIN_INTERVAL):
+                    result = receiver.recv()
+                elif not process.is_alive():
+                    result = {"error": f"acquisition process exited with code {process.exitcode}"}
+
+                n = self.ring.read(columns, self.n)
+                if n > self.n:
+                    self.n = n
+                    if chunk_writer is not None and n >= chunk_writer.next_chunk:
+                        chunk_writer.submit(n)
+                    if not stop_event.is_set() and super().update(n):
+                        stop_event.set()
+
+                if cancel_event.is_set():
+                    process_cancel_event.set()
+            process.join()
+        finally:
+            if process.is_alive():
+                process.kill()
+            self.ring.close()
+            self.ring = None
+
+        for message in result.get("messages", []):
+            print(message)
+        if "error" in result:
+            raise RuntimeError(result["error"])
+        scan_restarts = result["scan_restarts"]
+        self.t_start = result["t_start"]
+        self.t_end = result["t_end"]
+        self.scheduler_report = result["scheduler_report"]
+        if self.stop_reason is None:
+            self.stop_reason = result["stop_reason"]
+        return result["completed"]
+
+
+# Acquisition for one or more runs - in its own process with ACQUISITION_PROCESS
+
+
+def new_acquisition():
+
+    return AcquisitionProcess() if ACQUISITION_PROCESS else Acquisition()
 
-        for i in range(index_t):  # _peak:
 
-            #TERMINATE THIS THREAD EARLY IF TEST IS CANCELLED
-            if not running:
-                return
-
-            if(i > slope_range+1):  # Skip the first peak at time = 0
-
-                if(_peak[i] == 1):  # START OF REVERSE SWEEP (POSITIVE TO NEGATIVE V IN TRIAGLE)
-                    i += 1
-                    sec_data_index = 0
-                    start.append(i)
-                    sweep_type.append('REVERSE')
+# ================================================================================
+# MONITOR : UNATTENDED CONTINUOUS MONITORING WITH A ROLLING DIRAC TIME SERIES (BINDING KINETICS)
+# Samples until cancelled into MONITOR_RING_SIZE ring buffers (sample i at i % size) instead of NN
+# long arrays. The segmenter closes the sweeps while sampling and every closed sweep is fitted right
+# away (estimate_dirac on just that sweep). A passed Dirac updates the rolling mean / std of the last
+# MONITOR_WINDOW sweeps of its type from running sums, so the work per sweep does not grow with the run.
+# That fit runs in the sampling loop, between two samples, once per sweep (not a refit of the run): one
+# polyfit over a few hundred samples. When it runs past a sampling deadline the scheduler counts it as
+# missed and the next sample is taken late with its real time stamp.
+# The loop takes one scheduled conversion at a time (acquire_sample) in this thread, so the MONITOR mode
+# does not run with ADC_STREAMING_MODE or ACQUISITION_PROCESS - monitor_unsupported() says why.
+# The rows are appended to <name>_MONITOR.csv every MONITOR_PERSIST_INTERVAL seconds and dropped from
+# memory - a run of minutes and a run of days use the same memory.
+# ================================================================================
+class rolling_dirac:
+
+    def __init__(self, window=None):
+        self.values = deque(maxlen=window if window is not None else MONITOR_WINDOW)
+        self.sum = 0.0
+        self.sum_sq = 0.0
+
+    # Adds a Dirac voltage, the oldest one leaves the window
+    def add(self, value):
+        if len(self.values) == self.values.maxlen:
+            oldest = self.values[0]
+            self.sum -= oldest
+            self.sum_sq -= oldest * oldest
+        self.values.append(value)
+        self.sum += value
+        self.sum_sq += value * value
+
+    def mean(self):
+        return self.sum / len(self.values) if self.values else None
+
+    # Population std, same as np.std of the window
+    def std(self):
+        if not self.values:
+            return None
+        mean = self.sum / len(self.values)
+        return max(self.sum_sq / len(self.values) - mean * mean, 0.0) ** 0.5
+
+
+# Reason the MONITOR mode cannot run with the current configuration, None when it can
+
+
+def monitor_unsupported():
+    if ADC_STREAMING_MODE:
+        return "MONITOR samples one scheduled conversion at a time - set ADC_STREAMING_MODE = False"
+    if ACQUISITION_PROCESS:
+        return "MONITOR samples in the calling thread, not a forked process - set ACQUISITION_PROCESS = False"
+    return None
+
+
+class Monitor:
+
+    def __init__(self, filename, size=None):
+        if size is None:
+            size = MONITOR_RING_SIZE
+        self.filename = filename
+        self.size = size
+        self.adc_A = arr.array("i", [0]*size)  # RING BUFFERS - SAMPLE i AT i % size
+        self.adc_B = arr.array("i", [0]*size)
+        self.time = arr.array("d", [0]*size)
+        self.codes_A = np.frombuffer(self.adc_A, dtype=np.intc)
+        self.codes_B = np.frombuffer(self.adc_B, dtype=np.intc)
+        self.segmenter = sweep_segmenter(self.adc_B, size, max_sweeps=float("inf"))  # NEVER COMPLETE
+        self.n = 0  # SAMPLES CAPTURED
+        self.scheduler_report = None
+        self.t_start = None
+        self.t_end = None
+        self.reset()
+
+    def reset(self):
+        self.segmenter.reset()
+        self.rolling = {"FORWARD": rolling_dirac(), "REVERSE": rolling_dirac()}
+        self.pending = []  # ROWS NOT IN THE FILE YET
+        self.sweeps = 0
+        self.dropped = 0  # SWEEPS LONGER THAN THE RING
+
+    # Dirac table row of the sweep start:end, gathered out of the ring
+    def sweep_dirac(self, start, end):
+        index = np.arange(start, end) % self.size
+        voltage_A, voltage_B, Vgate, Ids = conv_raw_adc_to_physical(self.codes_A[index], self.codes_B[index])
+        sweeps = np.array([(0, end - start, "FORWARD")], dtype=SWEEP_TABLE_DTYPE)
+        return estimate_dirac(Vgate, Ids, sweeps)[0]
+
+    # Segments the samples up to n and fits the sweeps closed since the last call
+    def update(self, n):
+        segmenter = self.segmenter
+        segmenter.update(n)
+        if not segmenter.sweeps:
+            return
 
-                    while _slope[i] == -1:  # _peak[i] == 0:
-                        reverse_sections[section_index_reverse][sec_data_index] = _voltage_B[i]
-                        reverse_sections_time[section_index_reverse][sec_data_index] = _time[i]
-                        sec_data_index += 1
-                        i += 1
+        for start, end, sweep_type in segmenter.sweeps:
+            if n - start > self.size:
+                self.dropped += 1  # PARTLY OVERWRITTEN ALREADY
+                continue
+            row = self.sweep_dirac(start, end)
+            dirac = float(row["dirac"])
+            rolling = self.rolling[sweep_type]
+            if row["result"] == "PASS":
+                rolling.add(dirac)
+            t = self.time[(end - 1) % self.size]
+            mean, std = rolling.mean(), rolling.std()
+            self.pending.append([t, get_time(self.t_start + t), sweep_type, dirac, str(row["result"]),
+                                 "" if mean is None else mean, "" if std is None else std, len(rolling.values)])
+            self.sweeps += 1
+        segmenter.sweeps.clear()
+
+    # Appends the pending rows to the MONITOR file
+    def persist(self):
+        if not self.pending:
+            return
+        with open(self.filename, "a") as csv_file:
+            csv.writer(csv_file, delimiter=',').writerows(self.pending)
+        self.pending = []
+
+        for sweep_type, rolling in self.rolling.items():
+            if rolling.values:
+                print(f"MONITOR {get_time()} {sweep_type}: rolling Dirac mean {rolling.mean():.4f} V, "
+                      f"std {rolling.std():.5f} V over {len(rolling.values)} sweeps")
+        log(f"Monitor: {self.sweeps} sweeps, {self.n} samples")
+
+    # Samples until cancelled (or for duration seconds, e.g. MONITOR_MAX_SEC), returns the number of samples captured -
+    # RuntimeError if monitor_unsupported()
+    def run(self, duration=None):
+
+        reason = monitor_unsupported()
+        if reason is not None:
+            raise RuntimeError(reason)
+
+        self.reset()
+        with open(self.filename, "w") as csv_file:
+            csv.writer(csv_file, delimiter=',').writerow(monitor_file_header)
+
+        _adc_A, _adc_B, _time = self.adc_A, self.adc_B, self.time
+        size = self.size
+        update_samples = MONITOR_UPDATE_SAMPLES
+        persist_samples = int(MONITOR_PERSIST_INTERVAL * ADC_SAMPLING_RATE)
+        next_persist = persist_samples
+        self.t_start = time.time()
+        scheduler = sample_scheduler(ADC_SAMPLING_RATE)
+        index_t = 0
+        try:
+            while not cancel_event.is_set() and (duration is None or scheduler.elapsed() < duration):
+
+                # WAIT TILL THE NEXT SAMPLING DEADLINE
+                scheduler.wait()
+
+                j = index_t % size
+                _time[j] = scheduler.elapsed()
+                _adc_A[j], _adc_B[j], time_sample1_end, time_sample2_end = acquire_sample()
+                if cancel_event.is_set():
+                    break  # THE SAMPLE MAY BE INCOMPLETE
+                index_t += 1
+
+                if index_t % update_samples == 0:
+                    self.n = index_t
+                    self.update(index_t)
+                    if index_t >= next_persist:
+                        self.persist()
+                        next_persist += persist_samples
+        finally:
+            self.t_end = time.time()
+            self.n = index_t
+            self.update(index_t)
+            self.persist()
+            self.scheduler_report = scheduler.report()
+        return index_t
+
+
+class PostProcessor:
+
+    def __init__(self, acquisition):
+        self.acquisition = acquisition
+        self.n = acquisition.n
+
+    # Raw ADC codes to voltage, gate voltage and current - only the captured samples
+    def convert(self):
+        adc_A = np.frombuffer(self.acquisition.adc_A, dtype=np.intc, count=self.n)
+        adc_B = np.frombuffer(self.acquisition.adc_B, dtype=np.intc, count=self.n)
+        self.voltage_A, self.voltage_B, self.Vgate, self.Ids = conv_raw_adc_to_physical(adc_A, adc_B)
+
+        # ALREADY POPULATED THIS DATA WHEN USING FAKE DATA
+        if USE_FAKE_DATA:
+            self.voltage_A = np.frombuffer(self.acquisition.voltage_A, dtype=np.float64, count=self.n).copy()
+            self.Ids = self.voltage_A / CURRENT_GAIN
+
+    # Slope (+ or -) and peaks for triangle (CH2), then start and end points for sweeps -
+    # with the online segmenter only the last few samples are left to do
+    def segment(self):
+        segmenter = self.acquisition.segmenter
+        if segmenter is None:
+            self.slope, self.peak = detect_slope_peak(self.voltage_B)
+            self.sweeps = segment_sweeps(self.peak, self.n)
+            return
+        segmenter.update(self.n)
+        self.slope = np.frombuffer(segmenter.slope, dtype=np.int8, count=self.n)
+        self.peak = np.frombuffer(segmenter.peak, dtype=np.int8, count=self.n)
+        self.sweeps = segmenter.table()
+
+    # Dirac voltage for each individual sweep (DIRAC_TABLE_DTYPE)
+    def dirac(self):
+        self.dirac_table = estimate_dirac(self.Vgate, self.Ids, self.sweeps)
+        return self.dirac_table
+
+    # Mean Dirac voltage of the passed forward and reverse sweeps, 0 without any
+    def mean_dirac(self):
+        table = self.dirac_table
+        passed = table["result"] == "PASS"
+        forward = table["dirac"][passed & (table["sweep_type"] == "FORWARD")]
+        reverse = table["dirac"][passed & (table["sweep_type"] == "REVERSE")]
+        return (float(forward.mean()) if len(forward) else 0,
+                float(reverse.mean()) if len(reverse) else 0)
 
-                        if(i == NN):
-                            break
+    def run(self):
+        self.convert()
+        self.segment()
+        return self.dirac()
 
-                    end.append(i)
-                    section_index_reverse += 1
+    # Columns of the raw data file, in raw_data_file_header order
+    def raw_data_columns(self):
+        acquisition = self.acquisition
+        return [acquisition.time, acquisition.d_time, acquisition.s_time, acquisition.fs_time, self.Vgate, self.Ids,
+                acquisition.adc_A, acquisition.adc_B, self.voltage_A, self.voltage_B, self.slope, self.peak]
 
-                    if(i == NN):
-                        break
 
-                    # & sec_used_counter_reverse<4): #NEXT SECTION IS A FORWARD SWEEP, hence a full section has been captured
-                    if(_peak[i] == -1):
-                        reverse_sections_used[sec_used_counter_reverse] = 1
-                        sec_used_counter_reverse += 1
+# ================================================================================
+# SAMPLING THREAD
+# ================================================================================
+class data_collection_thread (threading.Thread):
 
-                    if(section_index_reverse == secs and section_index_forward == secs):
-                        break
+    data_collection_mode = 0
+    filename_str = ""
+    result_filename = None  # LAST FILE WRITTEN BY THE RUN (RAW DATA, OR THE DIRAC SUMMARY WITHOUT RAW DATA)
+    phase = "acquire"  # acquire, process, write, done - REPORTED BY THE DAEMON
+    dirac_table = None
+    scheduler_report = None
+    dirac_summary_filename = None
+    raw_data_filename = None
+    timing_report_filename = None
+
+    # acquisition: BUFFERS TO SAMPLE INTO, REUSED BY THE DAEMON - A NEW Acquisition BY DEFAULT
+    def __init__(self, threadID, name, mode, timestamp, acquisition=None):
+        threading.Thread.__init__(self)
+        self.threadID = threadID
+        self.name = name
+        self.data_collection_mode = mode #BASELINE OR SAMPLING
+        self.filename_str = timestamp
+        self.acquisition = acquisition
+
+    # MONITOR: SAMPLES UNTIL CANCELLED, THE ROLLING DIRAC FILE IS THE RESULT - NO RAW DATA
+    def run_monitor(self):
+
+        monitor = Monitor(self.filename_str + "_" + DEVICE_ID + MONITOR_FILE_SUFFIX)
+        self.result_filename = monitor.filename
+        log("data_collection_thread: Starting monitor loop")
+        monitor.run(MONITOR_MAX_SEC)
+        self.scheduler_report = monitor.scheduler_report
+        self.phase = "done"
+
+        print("Samples captured:\t\t", monitor.n)
+        print("Total time used:\t\t", monitor.t_end-monitor.t_start)
+        print("Sweeps fitted:\t\t\t", monitor.sweeps)
+        print("Sweeps longer than the ring:\t", monitor.dropped)
+        print("Achieved sampling rate:\t\t", self.scheduler_report["achieved_rate"])
+        print("Missed deadlines:\t\t", self.scheduler_report["missed"])
+        print("Monitor data stored to file:\t", monitor.filename)
 
-                elif(_peak[i] == -1):  # START OF FORWARD SWEEP (NEGATIVE TO POSITIVE V IN TRIAGLE)
-                    i += 1
-                    sec_data_index = 0
-                    start.append(i)
-                    sweep_type.append('FORWARD')
+    def run(self):
 
-                    while _slope[i] == 1:  # _peak[i] == 0:
-                        forward_sections[section_index_forward][sec_data_index] = _voltage_B[i]
-                        forward_sections_time[section_index_forward][sec_data_index] = _time[i]
-                        sec_data_index += 1
-                        i += 1
+        if self.data_collection_mode == THREAD_DATA_COLLECTION_MODE_MONITOR:
+            self.run_monitor()
+            return
 
-                        if(i == NN):
-                            break
+        acquisition = self.acquisition if self.acquisition is not None else new_acquisition()
 
-                    end.append(i)
-                    section_index_forward += 1
+        # FILE NAMES
+        device_name = DEVICE_ID # Device specific id stored in calib.json file - written to the file name
 
-                    if(i == NN):
-                        break
+        if self.data_collection_mode == THREAD_DATA_COLLECTION_MODE_BASELINE: #BASELINE
+            file_prefix = self.filename_str + "_" + device_name + "_BASELINE"
 
-                    # & sec_used_counter_forward<4): #NEXT SECTION IS A REVERSE SWEEP, hence a full section has been captured
-                    if(_peak[i] == 1):
-                        forward_sections_used[sec_used_counter_forward] = 1
-                        sec_used_counter_forward += 1
+        else: #SAMPLING
+            file_prefix = self.filename_str + "_" + device_name + "_SAMPLING"
 
-                    if(section_index_forward == secs and section_index_reverse == secs):
-                        break
+        # RAW CODES AND TIMINGS WRITTEN TO DISK IN CHUNKS WHILE SAMPLING
+        chunk_writer = None
+        if RAW_DATA_CHUNK_FILE:
+            chunk_writer = raw_chunk_writer(file_prefix + RAW_CHUNK_FILE_SUFFIX, acquisition.raw_columns(),
+                                            raw_data_file_info(device_name, stream_rate if ADC_STREAMING_MODE else ADC_SAMPLING_RATE, None))
+            chunk_writer.start()
 
-        # Remove last as it is not used
-        start.pop(len(start)-1)
-        end.pop(len(end)-1)
-        sweep_type.pop(len(sweep_type)-1)
+        t_phase = time.perf_counter()
+        phases = {}
 
-        c = 0  # counter
-        for i in range(len(start)-1-c):
-            # 500: minimum range of sweeps - removed those that are under
-            if (end[i-c] - start[i-c]) < 500:
-                start.pop(i-c)
-                end.pop(i-c)
-                sweep_type.pop(i-c)
-                c += 1
+        global mean_dirac_forward_sweep
+        global mean_dirac_reverse_sweep
 
-        # print("start", start)
-        # print("end", end)
+    
+        # START DATA COLLECTION LOOP
+        log("data_collection_thread: Starting data collection loop")
+        try:
+            completed = acquisition.run(chunk_writer)
+        finally:
+            # ALSO WHEN SAMPLING FAILS: THE SAMPLES SO FAR AND THE END RECORD REACH THE CHUNK FILE
+            if chunk_writer is not None:
+                chunk_writer.close(acquisition.n)
+        phases["acquire"] = time.perf_counter() - t_phase
+        if not completed:
+            return
+        index_t = acquisition.n
+        self.scheduler_report = acquisition.scheduler_report
+        log("data_collection_thread: post processing")
 
         # =============================================================================
-        # POST PROCESSING : FITTING CURVE TO DATA
+        # POST PROCESSING - FIND SECTIONS BETWEEN PEAKS ON TRIAGLE
         # =============================================================================
 
         #TERMINATE THIS THREAD EARLY IF TEST IS CANCELLED
-        if not running:
+        if cancel_event.is_set():
             return
 
-        Vgate = np.ndarray(shape=(NN), dtype=float, order='F')
-        Ids = np.ndarray(shape=(NN), dtype=float, order='F')
-
-        for i in range(len(Vgate)):
-            # CONVERT VOLTAGE AT ADC TO VOLTAGE AT GATE
-            Vgate[i] = 4.0496 + (_voltage_B[i]-4.0496)*GATE_GAIN + GATE_OFFSET
-            Ids[i] = _voltage_A[i]/CURRENT_GAIN  # Convert to current
-
-            # print("Vgate[i]", Vgate[i], "\tIds[i]", Ids[i])
-
-        Dirac = []
-        dirac_forward_sweep = []
-        dirac_reverse_sweep = []
-
-        # Start fitting for each individual sweep
-        for i in range(len(start)):
-
-            # print(i)
+        gpio.write(GPIO_CHAN_NUM_LED_AMBER, GPIO_VAL_HI)  # AMBER
+        print("PROCESSING DATA...\n")
+        self.phase = "process"
+        processor = PostProcessor(acquisition)
 
-            Vgate_prime = Vgate[start[i]:end[i]]
-            Ids_prime = Ids[start[i]:end[i]]
+        # CONVERT RAW ADC VALUES TO VOLTAGE, GATE VOLTAGE AND CURRENT - ONLY THE CAPTURED SAMPLES
+        t_phase = time.perf_counter()
+        processor.convert()
+        phases["convert"] = time.perf_counter() - t_phase
 
-            if not len(Vgate_prime):
-                continue
-            # Flip the data if its not monotonically increasing
-            if (Vgate_prime[0] - Vgate_prime[-1]) > 0:
-                Vgate_prime = np.flip(Vgate_prime)
-                Ids_prime = np.flip(Ids_prime)
+        # SLOPE (+ or -) AND PEAKS FOR TRIANGLE (CH2), THEN START AND END POINTS FOR SWEEPS
+        t_phase = time.perf_counter()
+        processor.segment()
+        phases["segment"] = time.perf_counter() - t_phase
 
-            Vgate_range = max(Vgate_prime) - min(Vgate_prime)
+        # print("sweeps", sweeps)
 
-            min_idx = np.argmin(Ids_prime)
+        # =============================================================================
+        # POST PROCESSING : FITTING CURVE TO DATA
+        # =============================================================================
 
-            fit_low = Vgate_prime[min_idx] - 0.25*Vgate_range
-            fit_high = Vgate_prime[min_idx] + 0.25*Vgate_range
+        #TERMINATE THIS THREAD EARLY IF TEST IS CANCELLED
+        if cancel_event.is_set():
+            return
 
-            idx_low = np.abs(Vgate_prime - fit_low).argmin()
-            idx_high = np.abs(Vgate_prime - fit_high).argmin()
+        # DIRAC VOLTAGE FOR EACH INDIVIDUAL SWEEP
+        t_phase = time.perf_counter()
+        dirac_table = processor.dirac()
+        self.dirac_table = dirac_table
+        phases["dirac"] = time.perf_counter() - t_phase
+        Dirac = dirac_table["dirac"].tolist()
+        mean_dirac_forward_sweep, mean_dirac_reverse_sweep = processor.mean_dirac()
 
         # =============================================================================
         # CREATE TIME STAMP FOR FILES
@@ -1097,51 +3122,79 @@ class data_collection_thread (threading.Thread):
         print("SAVING DATA...\n")
 
         #TERMINATE THIS THREAD EARLY IF TEST IS CANCELLED
-        if not running:
+        if cancel_event.is_set():
             return
 
-        raw_data_filename = ""
-        with open("calib.json") as f:
-            dev_file = json.load(f) # Device specific id stored in calib.json file
-        device_name = dev_file["ADC_CALIB"][0]["DEVICE_ID"] # Writes device ID to file name
-
-        if self.data_collection_mode == THREAD_DATA_COLLECTION_MODE_BASELINE: #BASELINE
-            raw_data_filename = self.filename_str + "_" + device_name + "_BASELINE_RAW_DATA.csv"
-
-        else: #SAMPLING
-            raw_data_filename = self.filename_str + "_" + device_name + "_SAMPLING_RAW_DATA.csv"
-
+        # DIRAC SUMMARY FIRST - IT IS ALL THE HOST NEEDS IN FAST RESULT MODE
+        self.phase = "write"
+        t_phase = time.perf_counter()
+        dirac_summary_filename = file_prefix + DIRAC_SUMMARY_FILE_SUFFIX
+        self.result_filename = dirac_summary_filename
+        self.dirac_summary_filename = dirac_summary_filename
+        write_dirac_summary(dirac_summary_filename + RAW_DATA_PARTIAL_EXTENSION, dirac_table)
+        os.replace(dirac_summary_filename + RAW_DATA_PARTIAL_EXTENSION, dirac_summary_filename)
 
         # ===========================================================
         # WRITE DATA TO FILE
         # ===========================================================
         log("data_collection_thread: writing data to file")
         #TERMINATE THIS THREAD EARLY IF TEST IS CANCELLED
-        if not running:
+        if cancel_event.is_set():
             return
 
-        print("STARTING RAW DATA CSV WRITE...\n")
-
-        with open(raw_data_filename, "w") as csv_file: #was 'append'
-            csv_writer = csv.writer(csv_file, delimiter=',')
-            csv_writer.writerow(raw_data_file_header)
-
-            n = 0
-            while n < index_t:
-                a = [_time[n], _d_time[n], _s_time[n], _fs_time[n], Vgate[n], Ids[n],
-                     _adc_A[n], _adc_B[n], _voltage_A[n], _voltage_B[n], _slope[n], _peak[n]]
-                n += 1
-                csv_writer.writerow(a)
-            
-            csv_file.close()
+        raw_data_filename = None
+        if RAW_DATA_FORMAT != "NONE":
+            raw_data_filename = file_prefix + "_RAW_DATA" + RAW_DATA_FILE_EXTENSION[RAW_DATA_FORMAT]
+            if RAW_DATA_COMPRESS:
+                raw_data_filename += RAW_DATA_COMPRESSED_EXTENSION
+            partial_filename = raw_data_filename + RAW_DATA_PARTIAL_EXTENSION
 
-        print("DONE CSV WRITE...\n")
+            print(f"STARTING RAW DATA {RAW_DATA_FORMAT} WRITE...\n")
 
-        os.system("echo 0 > /sys/class/gpio/gpio146/value")  # AMBER
-        os.system("echo 0 > /sys/class/gpio/gpio147/value")
+            raw_data_columns = processor.raw_data_columns()
+            if RAW_DATA_FORMAT == "BINARY":
+                info = raw_data_file_info(device_name, self.scheduler_report["target_rate"],
+                                          self.scheduler_report["achieved_rate"])
+                write_raw_data_binary(partial_filename, raw_data_columns, index_t, info, compress=RAW_DATA_COMPRESS)
+            else:
+                write_raw_data_csv(partial_filename, raw_data_columns, index_t, compress=RAW_DATA_COMPRESS)
+            os.replace(partial_filename, raw_data_filename)
+            self.result_filename = raw_data_filename
+            self.raw_data_filename = raw_data_filename
+
+            print(f"DONE {RAW_DATA_FORMAT} WRITE...\n")
+        phases["write"] = time.perf_counter() - t_phase
+
+        # TIMING TELEMETRY NEXT TO THE RAW FILE
+        timing_report_filename = file_prefix + TIMING_REPORT_FILE_SUFFIX
+        timing = timing_report(acquisition.fs_time, acquisition.s_time, acquisition.d_time, index_t,
+                               self.scheduler_report, phases)
+        timing["stop_reason"] = acquisition.stop_reason
+        timing["scan_restarts"] = scan_restarts
+        if acquisition.stop_rule is not None:
+            timing["forward_dirac_std"] = acquisition.stop_rule.std
+            timing["forward_dirac_sem"] = acquisition.stop_rule.sem
+        write_timing_report(timing_report_filename + RAW_DATA_PARTIAL_EXTENSION, timing)
+        os.replace(timing_report_filename + RAW_DATA_PARTIAL_EXTENSION, timing_report_filename)
+        self.timing_report_filename = timing_report_filename
+        self.phase = "done"
+
+        gpio.write(GPIO_CHAN_NUM_LED_AMBER, GPIO_VAL_LO)  # AMBER
+        gpio.write(GPIO_CHAN_NUM_LED_RGB_BLUE, GPIO_VAL_LO)
 
         print("Samples captured:\t\t", index_t)
-        print("Total time used:\t\t", t_end-t_start)
+        print("Total time used:\t\t", acquisition.t_end-acquisition.t_start)
+        print("Run ended by:\t\t\t", acquisition.stop_reason)
+        print("Target sampling rate:\t\t", self.scheduler_report["target_rate"])
+        print("Achieved sampling rate:\t\t", self.scheduler_report["achieved_rate"])
+        print("Jitter mean/rms/max [us]:\t", self.scheduler_report["jitter_mean_us"],
+              self.scheduler_report["jitter_rms_us"], self.scheduler_report["jitter_max_us"])
+        print("Missed deadlines:\t\t", self.scheduler_report["missed"])
+        print("Phases [s]:\t\t\t", phases)
+        print("Timing report stored to file:\t", timing_report_filename)
+        print("Dirac voltages:\t\t", Dirac)
+        print("Mean Dirac forward/reverse:\t", mean_dirac_forward_sweep, mean_dirac_reverse_sweep)
+        print("Dirac summary stored to file:\t", dirac_summary_filename)
         print("Raw Data stored to file:\t", raw_data_filename)
 
 
@@ -1162,207 +3215,613 @@ def update_sys_time():
 
 
 # ================================================================================
-# MAIN
+# BENCHMARK : SAMPLE-RATE CEILING AND SPI ROUND TRIPS PER ACQUISITION PATH
 # ================================================================================
-wifi_wait_counter = 1
-baseline_mean_dirac_forward_sweep = 0
-baseline_mean_dirac_reverse_sweep = 0
-sample_mean_dirac_forward_sweep = 0
-sample_mean_dirac_reverse_sweep = 0
+class spi_transaction_counter:
 
+    def __init__(self, spi_dev):
+        self.spi_dev = spi_dev
+        self.transactions = 0
 
-# =====================================================================
-# GET CALIB VALUES FROM FILE IF EXISTS, ELSE CREATE WITH DEFAULTS
-# =====================================================================
-
-#CHECK IF FILE EXISTS
-calib_filename = "calib.json"
-
-if(path.exists(calib_filename)):
-    print("Calib file exists.")
-else:
-    print("Calib file does not exists. Creating file with default values.")
-    data = {}
-    data['ADC_CALIB'] = []
-    data['ADC_CALIB'].append({
-
-        # =====================================================================
-        # DEFAULT VALUES TO ADD TO CALIB FILE IF IS DOESN'T EXISTS
-        # NB: THESE WILL NOT OVERWRITE EXISTING VALUES IN CALIB.JSON IF IT ALREADY EXISTS! 
-        # =====================================================================
-        "ADC_CALIBRATION_GAIN": 1.11262,
-        "ADC_CALIBRATION_OFFSET": -0.055756889,
-        "VOLTAGE_SCALE": 2.5,
-        "FULL_SCALE_RESOLUTION": 8388608.0,
-        "GATE_GAIN": (301 + 121)/301, #1.40199335548,
-        "CURRENT_GAIN": 4990,
-        "GATE_OFFSET": 0.019655897,
-        "TIA_GAIN_1": 0.1371184370,
-        "TIA_GAIN_2": -0.2656584491,
-        "TIA_GAIN_3": 1.1644372463,
-        "TIA_GAIN_4": -0.0359382272,
-        "DEVICE_ID": "PX_NA"
-    })
-
-    with open(calib_filename, 'w') as outfile:
-        json.dump(data, outfile)
-
-with open(calib_filename) as f:
-    data = json.load(f)
-
-#print(json.dumps(data, indent = 4, sort_keys=False))
+    def xfer2(self, msg):
+        self.transactions += 1
+        return self.spi_dev.xfer2(msg)
 
-# CALIBRATION GAINS FOR ADC
-ADC_CALIBRATION_GAIN = data["ADC_CALIB"][0]["ADC_CALIBRATION_GAIN"]
-ADC_CALIBRATION_OFFSET = data["ADC_CALIB"][0]["ADC_CALIBRATION_OFFSET"]
-VOLTAGE_SCALE = data["ADC_CALIB"][0]["VOLTAGE_SCALE"]
-FULL_SCALE_RESOLUTION = data["ADC_CALIB"][0]["FULL_SCALE_RESOLUTION"]
 
-# SCALING FACTORs TO TRANSLATE CALIBRATED ADC VOLTAGE TO GATE VOLTAGE
-GATE_GAIN = data["ADC_CALIB"][0]["GATE_GAIN"]
-CURRENT_GAIN = data["ADC_CALIB"][0]["CURRENT_GAIN"]
-GATE_OFFSET = data["ADC_CALIB"][0]["GATE_OFFSET"]
+def benchmark_acquisition_path(name, sample_function, n_samples):
 
-#CALIBRATION GAINS FOR TIA
-#y = 0.1371184370x3 - 0.2656584491x2 + 1.1644372463x - 0.0359382272
-TIA_GAIN_1 = data["ADC_CALIB"][0]["TIA_GAIN_1"]
-TIA_GAIN_2 = data["ADC_CALIB"][0]["TIA_GAIN_2"]
-TIA_GAIN_3 = data["ADC_CALIB"][0]["TIA_GAIN_3"]
-TIA_GAIN_4 = data["ADC_CALIB"][0]["TIA_GAIN_4"]
+    global spi
 
+    counter = spi_transaction_counter(spi)
+    spi_dev = spi
+    spi = counter
+    try:
+        t_start = time.perf_counter()
+        for i in range(n_samples):
+            sample_function()
+        t_total = time.perf_counter() - t_start
+    finally:
+        spi = spi_dev
+
+    result = {
+        "path": name,
+        "samples": n_samples,
+        "max_rate": n_samples / t_total,
+        "us_per_sample": t_total / n_samples * 1e6,
+        "spi_transactions_per_sample": counter.transactions / n_samples,
+    }
+    print(f"{name:<12} {result['max_rate']:10.1f} samples/s  {result['us_per_sample']:10.1f} us/sample  "
+          f"{result['spi_transactions_per_sample']:6.2f} SPI transactions/sample")
+    return result
+
+
+def benchmark_stream(n_samples):
+
+    global spi
+    global stream_rate
+
+    buffers = [arr.array("i", [0]*n_samples), arr.array("i", [0]*n_samples)] + \
+        [arr.array("d", [0]*n_samples) for i in range(4)]
+
+    rate = stream_rate
+    stream_rate = None  # BACK TO BACK SCAN CYCLES FOR THE CEILING
+    configure_acquisition_path(True, streaming=True)
+
+    counter = spi_transaction_counter(spi)
+    spi_dev = spi
+    spi = counter
+    try:
+        t_start = time.perf_counter()
+        n = acquire_stream(*buffers, n_samples=n_samples, duration=None)
+        t_total = time.perf_counter() - t_start
+    finally:
+        spi = spi_dev
+        stream_rate = rate
+
+    n = max(n, 1)
+    result = {
+        "path": "STREAM",
+        "samples": n,
+        "max_rate": n / t_total,
+        "us_per_sample": t_total / n * 1e6,
+        "spi_transactions_per_sample": counter.transactions / n,
+        "overruns": stream_overruns,
+    }
+    print(f"{'STREAM':<12} {result['max_rate']:10.1f} samples/s  {result['us_per_sample']:10.1f} us/sample  "
+          f"{result['spi_transactions_per_sample']:6.2f} SPI transactions/sample  {stream_overruns} overruns")
+    return result
+
+
+def benchmark_acquisition(n_samples=None):
+
+    if n_samples is None:
+        n_samples = BENCHMARK_SAMPLES
+    global ADC_FUSED_MUX_START
+
+    scan_mode = adc_scan_mode
+    streaming = conv_mode == CONV_MODE_CONTINIOUS
+    fused = ADC_FUSED_MUX_START
+    results = []
+
+    print("\n========================================================")
+    print(f"ACQUISITION BENCHMARK ({n_samples} unthrottled samples per path)")
+    print("========================================================")
+    try:
+        configure_acquisition_path(False)
+        # BEFORE: COMMANDS REBUILT EVERY CALL, SEPARATE STATUS POLLS
+        results.append(benchmark_acquisition_path("MUX", acquire_sample_mux, n_samples))
+        # AFTER: COMMAND TABLE, STATUS FROM THE DATA READ, WITH AND WITHOUT FUSED MUX + START
+        ADC_FUSED_MUX_START = False
+        results.append(benchmark_acquisition_path("MUX TABLE", acquire_sample_mux_table, n_samples))
+        ADC_FUSED_MUX_START = True
+        results.append(benchmark_acquisition_path("MUX FUSED", acquire_sample_mux_table, n_samples))
+        ADC_FUSED_MUX_START = fused
+
+        configure_acquisition_path(True)
+        results.append(benchmark_acquisition_path("SCAN", acquire_sample_scan, n_samples))
+
+        results.append(benchmark_stream(n_samples))
+    finally:
+        ADC_FUSED_MUX_START = fused
+        configure_acquisition_path(scan_mode, streaming)
+
+    return results
+
+
+def benchmark_raw_data_write(n_samples=None):
+
+    if n_samples is None:
+        n_samples = BENCHMARK_WRITE_SAMPLES
+    # SYNTHETIC RUN: FLOAT COLUMNS AS NUMPY / array.array, RAW CODES AND SLOPE/PEAK AS INTS
+    rng = np.random.default_rng(0)
+    t = np.arange(n_samples) / ADC_SAMPLING_RATE
+    columns = [arr.array("d", t), arr.array("d", rng.random(n_samples) * 1e-3),
+               arr.array("d", rng.random(n_samples) * 1e-3), arr.array("d", t),
+               rng.normal(0, 1, n_samples), rng.normal(0, 1e-4, n_samples),
+               arr.array("i", rng.integers(0, 1 << 24, n_samples).tolist()),
+               arr.array("i", rng.integers(0, 1 << 24, n_samples).tolist()),
+               rng.normal(0, 1, n_samples), rng.normal(0, 1, n_samples),
+               rng.choice(np.array([-1, 0, 1], dtype=np.intc), n_samples),
+               rng.choice(np.array([-1, 0, 1], dtype=np.intc), n_samples)]
+
+    print("\n========================================================")
+    print(f"RAW DATA WRITE BENCHMARK ({n_samples} rows)")
+    print("========================================================")
+    results = {}
+    for name, writer in (("ROWS", write_raw_data_csv_rows), ("BULK", write_raw_data_csv)):
+        filename = f"benchmark_{name.lower()}_RAW_DATA.csv"
+        t_start = time.perf_counter()
+        writer(filename, columns, n_samples)
+        results[name] = time.perf_counter() - t_start
+        print(f"{name:<12} {results[name]*1e3:10.1f} ms")
+
+    with open("benchmark_rows_RAW_DATA.csv", "rb") as f_rows, open("benchmark_bulk_RAW_DATA.csv", "rb") as f_bulk:
+        results["identical"] = f_rows.read() == f_bulk.read()
+    os.remove("benchmark_rows_RAW_DATA.csv")
+    os.remove("benchmark_bulk_RAW_DATA.csv")
+    print(f"Speed up: {results['ROWS'] / results['BULK']:.1f}x  identical files: {results['identical']}")
+
+    return results
 
 
+# ================================================================================
+# OSR TUNING : CONVERSION TIME, NOISE FLOOR AND SAMPLE-RATE CEILING PER OSR (python3 firmware.py TUNE [rate|MAX])
+# The noise floor is measured on the internal temperature diode (a quiet, slowly moving DC input) with the
+# first difference of consecutive codes, so temperature drift does not count as noise. The fastest OSR that
+# meets TUNE_NOISE_TARGET_UV at the requested rate is stored in calib.json and used by every later run.
+# ================================================================================
+def measure_osr_noise(n_conversions):
 
+    xfer2 = spi.xfer2
+    read_24 = cmd_table["read_24"]
+    codes = arr.array("i", [0]*n_conversions)
+    t_conversion = 0.0
 
+    xfer2(cmd_table["mux"][TUNE_MUX_SELECTION])
+    for i in range(n_conversions):
+        t_start = time.perf_counter()
+        xfer2(cmd_table["start"])
+        reply = xfer2(read_24)
+        while reply[0] & 0b00000100:
+            time.sleep(ADC_POLL_SLEEP)
+            reply = xfer2(read_24)
+        t_conversion += time.perf_counter() - t_start
+        codes[i] = (reply[1] << 16) + (reply[2] << 8) + reply[3]
 
-try:
-    os.system("echo 0 > /sys/class/gpio/gpio142/value")  # RED
-    os.system("echo 1 > /sys/class/gpio/gpio143/value")  # GREEN - WIFI CONNECTED AND TIME UPDATED
-    os.system("echo 0 > /sys/class/gpio/gpio146/value")  # AMBER
+    noise_lsb = float(np.std(np.diff(sign_extend_24(codes))) / np.sqrt(2))
+    return t_conversion / n_conversions, noise_lsb
 
-    os.system("echo 0 > /sys/class/gpio/gpio149/value")  # RGB RED
-    os.system("echo 0 > /sys/class/gpio/gpio148/value")  # RGB GREEN
-    os.system("echo 0 > /sys/class/gpio/gpio147/value")  # RGB BLUE
 
+# One row of the trade-off table: both measurements at one OSR, the ADC is left configured for it
 
-    # Write ADC config
-    write_init_config() #REQUIRED
-    read_config(True)
 
-    first_entry_in_data_collection_loop = True
+def measure_osr(osr, scan_mode, n_conversions=None, n_samples=None):
 
+    if n_conversions is None:
+        n_conversions = TUNE_CONVERSIONS
+    if n_samples is None:
+        n_samples = TUNE_SAMPLES
+    global CONFIG_OSR
 
-    #================================================================================
-    #HANDLING ARGUMENTS
-    #================================================================================
-    print(f"Arguments count: {len(sys.argv)}")
-    is_filename_set = False
-    use_default_filename = False
-    for i, arg in enumerate(sys.argv):
-        print(f"Argument {i:>6}: {arg}")
+    CONFIG_OSR = osr
+    configure_acquisition_path(False)
+    conversion_time, noise_lsb = measure_osr_noise(n_conversions)
 
-        if i == 1:
-            file_name = arg
-            is_filename_set = True
+    configure_acquisition_path(scan_mode)
+    t_start = time.perf_counter()
+    for i in range(n_samples):
+        acquire_sample()
+    max_rate = n_samples / (time.perf_counter() - t_start)
 
-        if i == 2:
-            data_collection_mode = arg # this is either "BASELINE" or "SAMPLING"
+    row = {
+        "osr": osr,
+        "conversion_us": conversion_time * 1e6,
+        "max_rate": max_rate,
+        "noise_lsb": noise_lsb,
+        "noise_uv": noise_lsb * VOLTAGE_SCALE / FULL_SCALE_RESOLUTION * 1e6,
+    }
+    print(f"{osr:>6} {row['conversion_us']:14.1f} {row['max_rate']:14.1f} {row['noise_lsb']:12.1f} {row['noise_uv']:12.2f}")
+    return row
 
-    if is_filename_set:
-        log("------------------------------")
-        log(f'Filename to be used: {file_name}')
-    else:
-        log("------------------------------")
-        log('No filename received - Using default time/date filename')
-        use_default_filename = True
-    print(f"Detected sample mode: {data_collection_mode}")
 
-    #RESET BOOLEAN FOR MANAGING THREADS
-    stop_data_collection_process = False
-    running = True
-    ready_for_data_collection = False
+# Measures the OSRs from fastest to slowest and picks one - returns (table, osr, rate), osr is None if
+# no OSR reaches the rate. rate None: as fast as possible with the noise target met (MAX)
 
-    # START BLUE LED THREAD
-    # SOURCE: https://www.tutorialspoint.com/python3/python_multithreading.htm
 
-    #DEFINES - MODE TO TOP SOMEWHERE
-    THREAD_DATA_COLLECTION_MODE_BASELINE = 1
-    THREAD_DATA_COLLECTION_MODE_SAMPLING = 2
-    THREAD_SAMPLING_MODE_WAIT_FOR_SAMPLE = 3
+def tune_osr(rate=None, noise_target_uv=None):
 
-    if data_collection_mode == "BASELINE":
-        data_collection_mode = THREAD_DATA_COLLECTION_MODE_BASELINE
-    elif data_collection_mode == "SAMPLING":
-        data_collection_mode = THREAD_DATA_COLLECTION_MODE_SAMPLING
+    if noise_target_uv is None:
+        noise_target_uv = TUNE_NOISE_TARGET_UV
+    global CONFIG_OSR
+
+    osr_before = CONFIG_OSR
+    scan_mode = adc_scan_mode
+    streaming = conv_mode == CONV_MODE_CONTINIOUS
+    rate_limit = NN / SEC  # THE RUN BUFFERS HOLD NN SAMPLES
+    required_rate = min(rate, rate_limit) * TUNE_RATE_HEADROOM if rate else TUNE_MIN_RATE
+
+    print("\n========================================================")
+    print(f"OSR TUNING (noise target {noise_target_uv} uV, rate {rate if rate else 'MAX'})")
+    print("========================================================")
+    print(f"{'OSR':>6} {'conversion us':>14} {'max samples/s':>14} {'noise LSB':>12} {'noise uV':>12}")
+
+    table = []
+    try:
+        for osr in OSR_VALUES:
+            row = measure_osr(osr, scan_mode)
+            table.append(row)
+            if row["max_rate"] < required_rate:
+                break  # EVERY HIGHER OSR IS SLOWER STILL
+            if rate is None and row["noise_uv"] <= noise_target_uv:
+                break  # THE FASTEST OSR MEETING THE TARGET IS FOUND
+    finally:
+        CONFIG_OSR = osr_before
+        configure_acquisition_path(scan_mode, streaming)
+
+    candidates = [row for row in table if row["max_rate"] >= required_rate]
+    if not candidates:
+        print(f"No OSR reaches {required_rate:.1f} samples/s - keeping OSR {osr_before}")
+        return table, None, rate
+
+    quiet = [row for row in candidates if row["noise_uv"] <= noise_target_uv]
+    if quiet:
+        chosen = quiet[0]
     else:
-        print(f"Warning: data_collection_mode {data_collection_mode} not recognized. Should be either 'BASELINE' or 'SAMPLING'.")
-        exit()
+        chosen = min(candidates, key=lambda row: row["noise_uv"])
+        print(f"Warning: no OSR meets the noise target at this rate, using the quietest one")
 
-    #FILE NAME FROM TIMESTAMP:
-    if (use_default_filename):
-        timestamp_filename = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    if rate is None:
+        rate = int(min(chosen["max_rate"] / TUNE_RATE_HEADROOM, rate_limit))
     else:
-        timestamp_filename = file_name
-    thread_data_collection = data_collection_thread(1, "Thread-Sampling", data_collection_mode, timestamp_filename)
+        rate = min(rate, int(rate_limit))
+
+    print(f"Selected OSR {chosen['osr']} at {rate} samples/s ({chosen['noise_uv']:.2f} uV noise)")
+    return table, chosen["osr"], rate
+
+
+# TUNE mode: measure, store the choice in calib.json and the table next to it, use it from now on
+
+
+def run_osr_tuning(rate=None):
+
+    table, osr, rate = tune_osr(rate)
+
+    report = {"device_id": DEVICE_ID, "noise_target_uv": TUNE_NOISE_TARGET_UV, "osr": osr,
+              "sample_rate": rate, "table": table}
+    with open(TUNE_REPORT_FILENAME, "w") as f:
+        json.dump(report, f, indent=4)
+    print("Tuning report stored to file:\t", TUNE_REPORT_FILENAME)
+
+    if osr is None:
+        return report
+
+    calibration = Calibration.load()
+    calibration.values["CONFIG_OSR"] = osr
+    calibration.values["ADC_SAMPLING_RATE"] = rate
+    calibration.save()
+    calibration.apply()
+    write_init_config()
+    print(f"OSR {osr} and sampling rate {rate} stored to {CALIB_FILENAME}")
+
+    return report
+
+
+# ================================================================================
+# RUN : SAMPLING, LED AND CANCEL THREADS FOR ONE BASELINE / SAMPLING / MONITOR RUN (CLI AND DAEMON)
+# ================================================================================
+THREAD_DATA_COLLECTION_MODES = {"BASELINE": THREAD_DATA_COLLECTION_MODE_BASELINE,
+                                "SAMPLING": THREAD_DATA_COLLECTION_MODE_SAMPLING,
+                                "MONITOR": THREAD_DATA_COLLECTION_MODE_MONITOR}
+
+
+def start_data_collection(filename_str, data_collection_mode, acquisition=None):
+
+    #RESET EVENTS FOR MANAGING THREADS
+    cancel_event.clear()
+    shutdown_event.clear()
+    sample_ready_event.clear()
+
+    # START BLUE LED THREAD
+    # SOURCE: https://www.tutorialspoint.com/python3/python_multithreading.htm
+    thread_data_collection = data_collection_thread(1, "Thread-Sampling", data_collection_mode, filename_str, acquisition)
     thread_led = led_thread(2, "Thread-LED", data_collection_mode)
     thread_cancel = cancel_thread(3, "Thread-Cancel")
 
-    log("FETCHING DATA...\n")
-    print("FETCHING DATA")
-
     log("Begin thread data collection") # this is either baseline or sampling depending on the command line arguments passed
     print("Begin thread data collection")
     thread_data_collection.start()
     thread_led.start()
-    if first_entry_in_data_collection_loop:
-        thread_cancel.start()
-        first_entry_in_data_collection_loop = False
-
-    print("Checking for cancel operation (there should be none)")
-    #CHECK FOR CANCEL OPERATION WHILE COLLECTING DATA
-    thread_running = thread_data_collection.is_alive()
-    while (thread_running):
-        if stop_data_collection_process:
-            running = False
-            print("CANCELLED TEST...\n")
-            break
-        thread_running = thread_data_collection.is_alive()
-        time.sleep(0.5)
-    log("End thread sampling for data")
-    print("End thread sampling for data")
+    thread_cancel.start()
+    return thread_data_collection, thread_led, thread_cancel
+
 
-    #WAIT FOR LED THREAD TO FINISH
-    thread_led.join(600)
+# Waits for the sampling thread, then stops the LED and cancel threads
 
-    raw_data_filename = f"{timestamp_filename}_{data_collection_mode}_RAW_DATA.csv"
 
-    file_check_wait = 10
+def finish_data_collection(threads):
 
-    print("Waiting for file")
-    wait_for_file = True
-    counter = 0
-    while wait_for_file: 
-        if(exists(raw_data_filename)):
-            wait_for_file = False
-            break
-        time.sleep(2)
-        counter += 1
-        if(counter > file_check_wait):
-            break
+    thread_data_collection, thread_led, thread_cancel = threads
 
-    print("End process. Joining threads...")
+    #THE CANCEL THREAD SETS cancel_event, THE SAMPLING THREAD STOPS AT ITS NEXT SAMPLE - NOTHING TO POLL HERE
+    thread_data_collection.join()
+    if cancel_event.is_set():
+        print("CANCELLED TEST...\n")
+    log("End thread sampling for data")
+    print("End thread sampling for data")
 
+    #LED AND CANCEL THREADS EXIT ON THIS
+    shutdown_event.set()
+    gpio.interrupt()  # WAKES THE CANCEL THREAD OUT OF ITS EDGE WAIT
     thread_led.join()
     thread_cancel.join()
-    print("Done.")
-finally:
-    # CLOSE SPI ACCESS
-    spi.close()
-
-    os.system("echo 0 > /sys/class/gpio/gpio142/value")  # RED
-    os.system("echo 0 > /sys/class/gpio/gpio143/value")  # GREEN
-    os.system("echo 0 > /sys/class/gpio/gpio146/value")  # AMBER
-
-    os.system("echo 0 > /sys/class/gpio/gpio149/value")  # RGB RED
-    os.system("echo 0 > /sys/class/gpio/gpio148/value")  # RGB GREEN
-    os.system("echo 0 > /sys/class/gpio/gpio147/value")  # RGB BLUE
+    return thread_data_collection
+
+
+# ================================================================================
+# DAEMON : SPI CONFIGURED AND MODULES LOADED ONCE, RUNS STARTED OVER A LOCAL SOCKET
+# One command per line, one JSON message per line back:
+#   BASELINE|SAMPLING <name> [CSV|BINARY|NONE] [NONE|GZIP]
+#                   -> started, progress (every DAEMON_PROGRESS_INTERVAL), done or error
+#   MONITOR <name>  -> same, runs until CANCEL (from another connection)
+#   CANCEL          -> cancelling (the run still ends with its done message, cancelled = true) - on another
+#                      connection, the one that started the run is not read again until the run is over
+#   STATUS          -> status
+#   SHUTDOWN        -> shutdown, then the daemon exits
+# ================================================================================
+class acquisition_daemon:
+
+    def __init__(self, device):
+        self.device = device
+        self.acquisition = new_acquisition()  # BUFFERS ALLOCATED ONCE FOR ALL RUNS
+        self.run_lock = threading.Lock()
+        self.thread = None
+        self.mode = None
+        self.t_start = None
+        self.runs = 0
+
+    def status(self):
+        running = self.run_lock.locked()
+        return {"event": "status", "state": "running" if running else "idle", "runs": self.runs,
+                "mode": self.mode if running else None,
+                "phase": self.thread.phase if running and self.thread is not None else None,
+                "elapsed": time.perf_counter() - self.t_start if running else None}
+
+    def cancel(self):
+        running = self.run_lock.locked()
+        if running:
+            cancel_event.set()
+        return {"event": "cancelling" if running else "idle"}
+
+    # Runs one BASELINE / SAMPLING / MONITOR command, send() gets the started, progress and done messages
+    def run(self, mode, filename_str, raw_data_format="CSV", compression="NONE", send=print):
+
+        global RAW_DATA_FORMAT
+        global RAW_DATA_COMPRESS
+
+        if raw_data_format not in RAW_DATA_FILE_EXTENSION and raw_data_format != "NONE":
+            send({"event": "error", "message": f"raw data format {raw_data_format} not recognized"})
+            return
+        if compression not in ("NONE", "GZIP"):
+            send({"event": "error", "message": f"raw data compression {compression} not recognized"})
+            return
+        if mode == "MONITOR" and monitor_unsupported() is not None:
+            send({"event": "error", "message": monitor_unsupported()})
+            return
+        if not self.run_lock.acquire(blocking=False):
+            send({"event": "error", "message": f"a {self.mode} run is already going"})
+            return
+
+        try:
+            self.t_start = time.perf_counter()
+            self.mode = mode
+            RAW_DATA_FORMAT = raw_data_format
+            RAW_DATA_COMPRESS = compression == "GZIP"
+            threads = start_data_collection(filename_str, THREAD_DATA_COLLECTION_MODES[mode], self.acquisition)
+            self.thread = threads[0]
+            send({"event": "started", "mode": mode, "name": filename_str,
+                  "start_latency": time.perf_counter() - self.t_start})
+
+            while self.thread.is_alive():
+                self.thread.join(DAEMON_PROGRESS_INTERVAL)
+                if self.thread.is_alive():
+                    send({"event": "progress", "phase": self.thread.phase, "elapsed": time.perf_counter() - self.t_start,
+                          "duration": MONITOR_MAX_SEC if mode == "MONITOR" else SEC})
+
+            thread = finish_data_collection(threads)
+            self.runs += 1
+            send(self.result(thread))
+        finally:
+            self.run_lock.release()
+
+    def result(self, thread):
+        cwd = os.getcwd()
+        filenames = {}
+        for key in ("result_filename", "dirac_summary_filename", "raw_data_filename", "timing_report_filename"):
+            filename = getattr(thread, key)
+            filenames[key] = os.path.join(cwd, filename) if filename is not None else None
+
+        result = {"event": "done", "mode": self.mode, "cancelled": cancel_event.is_set(),
+                  "run_time": time.perf_counter() - self.t_start, "dirac": None,
+                  "mean_dirac_forward_sweep": None, "mean_dirac_reverse_sweep": None, "scheduler": None}
+        result.update(filenames)
+        if thread.dirac_table is not None:
+            # SAME ROWS AS THE DIRAC SUMMARY FILE: Dirac Voltages, Sweep Type, Result, Min Ids Voltage
+            result["dirac"] = [[float(row["dirac"]), str(row["sweep_type"]), str(row["result"]), float(row["min_ids_vgate"])]
+                               for row in thread.dirac_table]
+            result["mean_dirac_forward_sweep"] = mean_dirac_forward_sweep
+            result["mean_dirac_reverse_sweep"] = mean_dirac_reverse_sweep
+        if thread.scheduler_report is not None:
+            result["scheduler"] = {key: float(value) for key, value in thread.scheduler_report.items()}
+        return result
+
+
+class daemon_request_handler (socketserver.StreamRequestHandler):
+
+    # A CLIENT THAT WENT AWAY DOES NOT STOP A RUN IT STARTED - THE RUN STILL FINISHES AND WRITES ITS FILES
+    def send(self, message):
+        try:
+            self.wfile.write((json.dumps(message) + "\n").encode())
+        except OSError:
+            pass
+
+    def handle(self):
+        daemon = self.server.acquisition_daemon
+        for line in self.rfile:
+            words = line.decode().split()
+            if not words:
+                continue
+            command = words[0].upper()
+            if command in THREAD_DATA_COLLECTION_MODES and len(words) >= 2:
+                daemon.run(command, *words[1:4], send=self.send)
+            elif command == "CANCEL":
+                self.send(daemon.cancel())
+            elif command == "STATUS":
+                self.send(daemon.status())
+            elif command == "SHUTDOWN":
+                cancel_event.set()
+                self.send({"event": "shutdown"})
+                # shutdown() WAITS FOR serve_forever() - CALL IT FROM ANOTHER THREAD
+                threading.Thread(target=self.server.shutdown).start()
+                return
+            else:
+                self.send({"event": "error", "message": f"unknown command {line.decode().strip()}"})
+
+
+class daemon_server (socketserver.ThreadingTCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def serve_daemon(device, host=None, port=None):
+
+    if host is None:
+        host = DAEMON_HOST
+    if port is None:
+        port = DAEMON_PORT
+    with daemon_server((host, port), daemon_request_handler) as server:
+        server.acquisition_daemon = acquisition_daemon(device)
+        print(f"Daemon listening on {host}:{port}")
+        server.serve_forever()
+    print("Daemon stopped.")
+
+
+# ================================================================================
+# MAIN
+# ================================================================================
+wifi_wait_counter = 1
+baseline_mean_dirac_forward_sweep = 0
+baseline_mean_dirac_reverse_sweep = 0
+sample_mean_dirac_forward_sweep = 0
+sample_mean_dirac_reverse_sweep = 0
+
+
+# CLI: python3 firmware.py <name> <BASELINE|SAMPLING|BENCHMARK> [CSV|BINARY|NONE] [NONE|GZIP]
+#      python3 firmware.py DAEMON
+
+
+def main(argv):
+
+    global RAW_DATA_FORMAT
+    global RAW_DATA_COMPRESS
+
+    Calibration.load().apply()
+    device = Device().open()
+    try:
+        device.leds_ready()
+        device.configure()
+
+        if len(argv) == 2 and argv[1] == "DAEMON":
+            serve_daemon(device)
+            return
+
+        if len(argv) in (2, 3) and argv[1] == "TUNE":
+            # OPTIONAL RATE: SAMPLES/S OR MAX, DEFAULT THE CURRENT ADC_SAMPLING_RATE
+            rate = argv[2] if len(argv) == 3 else ADC_SAMPLING_RATE
+            run_osr_tuning(None if rate == "MAX" else float(rate))
+            return
+
+        #================================================================================
+        #HANDLING ARGUMENTS
+        #================================================================================
+        print(f"Arguments count: {len(argv)}")
+        is_filename_set = False
+        use_default_filename = False
+        for i, arg in enumerate(argv):
+            print(f"Argument {i:>6}: {arg}")
+
+            if i == 1:
+                file_name = arg
+                is_filename_set = True
+
+            if i == 2:
+                data_collection_mode = arg # this is either "BASELINE" or "SAMPLING"
+
+            if i == 3:
+                RAW_DATA_FORMAT = arg # optional, either "CSV" (default), "BINARY" or "NONE" (Dirac summary only)
+
+            if i == 4:
+                RAW_DATA_COMPRESS = arg == "GZIP" # optional, either "NONE" (default) or "GZIP"
+
+        if is_filename_set:
+            log("------------------------------")
+            log(f'Filename to be used: {file_name}')
+        else:
+            log("------------------------------")
+            log('No filename received - Using default time/date filename')
+            use_default_filename = True
+        print(f"Detected sample mode: {data_collection_mode}")
+
+        if data_collection_mode == "BASELINE":
+            data_collection_mode = THREAD_DATA_COLLECTION_MODE_BASELINE
+        elif data_collection_mode == "SAMPLING":
+            data_collection_mode = THREAD_DATA_COLLECTION_MODE_SAMPLING
+        elif data_collection_mode == "MONITOR":
+            if monitor_unsupported() is not None:
+                print(f"Warning: {monitor_unsupported()}")
+                return
+            data_collection_mode = THREAD_DATA_COLLECTION_MODE_MONITOR # until cancelled, no raw data file
+        elif data_collection_mode == "BENCHMARK":
+            benchmark_acquisition()
+            benchmark_raw_data_write()
+            return
+        else:
+            print(f"Warning: data_collection_mode {data_collection_mode} not recognized. Should be either 'BASELINE', 'SAMPLING' or 'MONITOR'.")
+            return
+
+        if RAW_DATA_FORMAT not in RAW_DATA_FILE_EXTENSION and RAW_DATA_FORMAT != "NONE":
+            print(f"Warning: raw data format {RAW_DATA_FORMAT} not recognized. Should be either 'CSV', 'BINARY' or 'NONE'.")
+            return
+        if len(argv) > 4 and argv[4] not in ("NONE", "GZIP"):
+            print(f"Warning: raw data compression {argv[4]} not recognized. Should be either 'NONE' or 'GZIP'.")
+            return
+
+        #FILE NAME FROM TIMESTAMP:
+        if (use_default_filename):
+            timestamp_filename = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        else:
+            timestamp_filename = file_name
+
+        log("FETCHING DATA...\n")
+        print("FETCHING DATA")
+        wakeups.reset()
+        threads = start_data_collection(timestamp_filename, data_collection_mode)
+
+        print("Checking for cancel operation (there should be none)")
+        thread_data_collection = finish_data_collection(threads)
+        wakeups.tick("MainThread")
+
+        #THE SAMPLING THREAD HAS WRITTEN ITS FILES BEFORE IT ENDED
+        if thread_data_collection.result_filename is not None and exists(thread_data_collection.result_filename):
+            print(f"File written: {thread_data_collection.result_filename}")
+        else:
+            print("No file written")
+
+        print("Wake-ups per second:", wakeups.report())
+        print("Done.")
+    finally:
+        device.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -13,6 +13,7 @@ import json
 import matlab_helpers as matlab
 import helperfuncs as helpers
 import ssh_to_device
+import raw_data_format
 import constants as CONSTANTS
 
 class GUI:
@@ -46,6 +47,10 @@ class GUI:
         self.device_id = tkinter.StringVar()
         self.device_id.set("Device ID")
 
+        # fast result mode: only the Dirac summary computed on the device is downloaded
+        self.fast_result = tkinter.BooleanVar()
+        self.fast_result.set(False)
+
         # configuring text variables used by the Text widgets
         self.qc_score_str = "No Q/C Test run."
         self.abs_dirac_shift = "No dirac shift run."
@@ -103,6 +108,9 @@ class GUI:
         self.sampling_file_textbox.grid(row = 1, column = 2, sticky = "w", padx = 4, pady = 4)
         self.modify_Text(self.sampling_file_textbox, self.sampling_filename)
 
+        # fast result toggle
+        ttk.Checkbutton(self.frame_data, text = "Fast result (Dirac summary only)", variable = self.fast_result).grid(row = 2, column = 0, columnspan = 2, sticky = "w", padx = 4, pady = 4)
+
         # analytics controls
         ttk.Button(self.frame_analytics, text = "Q/C Test", command = self.qc_action, width = 20).grid(row = 0, column = 0, sticky = "w", padx = 4, pady = 4)
         ttk.Label(self.frame_analytics, text = "Q/C Results: ", width = 20).grid(row = 0, column = 1, sticky = "w", padx = 4, pady = 4)
@@ -122,6 +130,8 @@ class GUI:
         # strings for firmware file locations
         self.local_firmware = os.path.join(os.path.dirname(os.path.realpath(__file__)), CONSTANTS.LOCAL_FIRMWARE_FILE_NAME)
         self.remote_firmware = CONSTANTS.REMOTE_FIRMWARE_PATH
+        self.local_raw_data_format = os.path.join(os.path.dirname(os.path.realpath(__file__)), CONSTANTS.LOCAL_RAW_DATA_FORMAT_FILE_NAME)
+        self.remote_raw_data_format = CONSTANTS.REMOTE_RAW_DATA_FORMAT_PATH
 
         # analytics variables
         self.fx = None
@@ -236,21 +246,26 @@ class GUI:
     def read_raw_data(self, file):
         helpers.print_debug(f"Opening file {file}")
         self.fx_filename = file
-        Base = []
-        with open(file) as csvfile:
-            csvbuffer = csv.reader(csvfile, delimiter=',', quotechar='"')
-            for row in csvbuffer: # filter out only the fifth and sixth columns
-                Base += [row[4:6]]
-        """format of Base, assuming CSV is proper. will be formatted like JSON
-        [
-            ['Gate Voltage', 'Ids'],
-            ['-0.12345', '6.789e-05'],
-            ['0.2468', '-1.3579e-02'],
-            ...
-        ]
-        """
-        # need to convert all read data to numeric
-        Base = [[float(row[0]), float(row[1])] for row in Base[1:]] # filter out first row which is headers
+        if raw_data_format.is_binary(file):
+            # columns are memory mapped, only Gate Voltage and Ids are read
+            header, columns = raw_data_format.read_binary(file)
+            Base = np.column_stack((columns["Gate Voltage"], columns["Ids"])).tolist()
+        else:
+            Base = []
+            with open(file) as csvfile:
+                csvbuffer = csv.reader(csvfile, delimiter=',', quotechar='"')
+                for row in csvbuffer: # filter out only the fifth and sixth columns
+                    Base += [row[4:6]]
+            """format of Base, assuming CSV is proper. will be formatted like JSON
+            [
+                ['Gate Voltage', 'Ids'],
+                ['-0.12345', '6.789e-05'],
+                ['0.2468', '-1.3579e-02'],
+                ...
+            ]
+            """
+            # need to convert all read data to numeric
+            Base = [[float(row[0]), float(row[1])] for row in Base[1:]] # filter out first row which is headers
         helpers.print_debug(f"{len(Base)} rows read.")
 
         helpers.print_debug("Running splitz_new_opt")
@@ -272,9 +287,14 @@ class GUI:
             print_stuff(f"Could not connect to {IP}.")
             return
         print_stuff(f"Connected to {IP}. Uploading firmware to device...")
+        if CONSTANTS.USE_DAEMON:
+            self.ssh_client.stop_daemon() # a daemon left running would keep the previous firmware
         if not self.ssh_client.upload_firmware(self.local_firmware, self.remote_firmware):
             print_stuff("Could not upload firmware.")
             return
+        if not self.ssh_client.upload_firmware(self.local_raw_data_format, self.remote_raw_data_format):
+            print_stuff("Could not upload raw_data_format.py.")
+            return
         print_stuff(f"Collecting the Device ID")
         if not self.ssh_client.get_device_id():
             print_stuff("Could not get device ID")
@@ -309,15 +329,34 @@ class GUI:
         if filename == "":
             self.feedback_str.set("Cannot run baseline using empty file name.")
             return
-        self.ssh_client.collect_data(self.remote_firmware, filename, mode)
-        local_baseline_raw_data_file = f"{self.download_dir}/{filename}_{device_name}_{mode}_RAW_DATA.csv"
+        if self.fast_result.get():
+            dirac, local_baseline_summary_file = self.collect_dirac_summary(filename, mode, device_name)
+            if dirac is None:
+                self.feedback_str.set("Baseline Dirac summary not downloaded. Stopping")
+                return
+            self.baseline_fx = None
+            self.baseline_dirac = dirac
+            self.baseline_filename = local_baseline_summary_file
+            self.modify_Text(self.baseline_file_textbox, self.baseline_filename)
+            self.feedback_str.set(f"Baseline Dirac voltage: {1000*dirac['mean']}mV (fast result)")
+            return
+        done = self.start_run(filename, mode, CONSTANTS.RAW_DATA_FORMAT, CONSTANTS.RAW_DATA_COMPRESS)
+        if done is not None and (done["event"] != "done" or done["cancelled"]):
+            self.feedback_str.set(f"Baseline run failed on the device: {done.get('message', 'cancelled')}")
+            return
+        extension = raw_data_format.EXTENSIONS[CONSTANTS.RAW_DATA_FORMAT]
+        local_baseline_raw_data_file = f"{self.download_dir}/{filename}_{device_name}_{mode}_RAW_DATA{extension}"
         self.feedback_str.set(f"Using file {local_baseline_raw_data_file}")
         downloaded, time_elapsed, start_time = False, 0, time.time()
-        remote_baseline_raw_data_file = f"/home/root/{filename}_{device_name}_{mode}_RAW_DATA.csv"
+        remote_baseline_raw_data_file = f"/home/root/{filename}_{device_name}_{mode}_RAW_DATA{extension}"
+        if CONSTANTS.RAW_DATA_COMPRESS:
+            remote_baseline_raw_data_file += raw_data_format.COMPRESSED_EXTENSION
+        if done is not None: # the daemon only answers once the file is written
+            downloaded = self.ssh_client.download_file(remote_baseline_raw_data_file, local_baseline_raw_data_file, CONSTANTS.RAW_DATA_COMPRESS)
         while not downloaded and time_elapsed < CONSTANTS.MAX_DOWNLOAD_WAIT_TIME:
             helpers.print_debug(f"Waiting for baseline data file from device ({time_elapsed} seconds elapsed)...")
             time.sleep(CONSTANTS.DOWNLOAD_DELAY - (time.time() - start_time) % CONSTANTS.DOWNLOAD_DELAY)
-            downloaded = self.ssh_client.download_file(remote_baseline_raw_data_file, local_baseline_raw_data_file)
+            downloaded = self.ssh_client.download_file(remote_baseline_raw_data_file, local_baseline_raw_data_file, CONSTANTS.RAW_DATA_COMPRESS)
             time_elapsed += CONSTANTS.DOWNLOAD_DELAY
         if not downloaded:
             helpers.print_debug(f"Maximum wait time {CONSTANTS.MAX_DOWNLOAD_WAIT_TIME} reached. Baseline data file was not downloaded.")
@@ -327,7 +366,7 @@ class GUI:
         if not self.ssh_client.delete_file(remote_baseline_raw_data_file):
             helpers.print_debug(f"Warning: file {remote_baseline_raw_data_file} was not removed from device.")
         helpers.print_debug(f"Ending process from device...")
-        if not self.ssh_client.kill_script():
+        if done is None and not self.ssh_client.kill_script():
             helpers.print_debug("Warning: process not ended.")
         if not downloaded:
             self.feedback_str.set("Baseline file not downloaded. Stopping")
@@ -354,15 +393,34 @@ class GUI:
         if filename == "":
             self.feedback_str.set("Cannot run sampling using empty file name.")
             return
-        self.ssh_client.collect_data(self.remote_firmware, filename, mode)
-        local_sampling_raw_data_file = f"{self.download_dir}/{filename}_{device_name}_{mode}_RAW_DATA.csv"
+        if self.fast_result.get():
+            dirac, local_sampling_summary_file = self.collect_dirac_summary(filename, mode, device_name)
+            if dirac is None:
+                self.feedback_str.set("Sampling Dirac summary not downloaded. Stopping")
+                return
+            self.sampling_fx = None
+            self.sampling_dirac = dirac
+            self.sampling_filename = local_sampling_summary_file
+            self.modify_Text(self.sampling_file_textbox, self.sampling_filename)
+            self.feedback_str.set(f"Sampling Dirac voltage: {1000*dirac['mean']}mV (fast result)")
+            return
+        done = self.start_run(filename, mode, CONSTANTS.RAW_DATA_FORMAT, CONSTANTS.RAW_DATA_COMPRESS)
+        if done is not None and (done["event"] != "done" or done["cancelled"]):
+            self.feedback_str.set(f"Sampling run failed on the device: {done.get('message', 'cancelled')}")
+            return
+        extension = raw_data_format.EXTENSIONS[CONSTANTS.RAW_DATA_FORMAT]
+        local_sampling_raw_data_file = f"{self.download_dir}/{filename}_{device_name}_{mode}_RAW_DATA{extension}"
         self.feedback_str.set(f"Using file {local_sampling_raw_data_file}")
         downloaded, time_elapsed, start_time = False, 0, time.time()
-        remote_sampling_raw_data_file = f"/home/root/{filename}_{device_name}_{mode}_RAW_DATA.csv"
+        remote_sampling_raw_data_file = f"/home/root/{filename}_{device_name}_{mode}_RAW_DATA{extension}"
+        if CONSTANTS.RAW_DATA_COMPRESS:
+            remote_sampling_raw_data_file += raw_data_format.COMPRESSED_EXTENSION
+        if done is not None: # the daemon only answers once the file is written
+            downloaded = self.ssh_client.download_file(remote_sampling_raw_data_file, local_sampling_raw_data_file, CONSTANTS.RAW_DATA_COMPRESS)
         while not downloaded and time_elapsed < CONSTANTS.MAX_DOWNLOAD_WAIT_TIME:
             helpers.print_debug(f"Waiting for sampling data file from device ({time_elapsed} seconds elapsed)...")
             time.sleep(CONSTANTS.DOWNLOAD_DELAY - (time.time() - start_time) % CONSTANTS.DOWNLOAD_DELAY)
-            downloaded = self.ssh_client.download_file(remote_sampling_raw_data_file, local_sampling_raw_data_file)
+            downloaded = self.ssh_client.download_file(remote_sampling_raw_data_file, local_sampling_raw_data_file, CONSTANTS.RAW_DATA_COMPRESS)
             time_elapsed += CONSTANTS.DOWNLOAD_DELAY
         if not downloaded:
             helpers.print_debug(f"Maximum wait time {CONSTANTS.MAX_DOWNLOAD_WAIT_TIME} reached. Sampling data file was not downloaded.")
@@ -372,7 +430,7 @@ class GUI:
         if not self.ssh_client.delete_file(remote_sampling_raw_data_file):
             helpers.print_debug(f"Warning: file {remote_sampling_raw_data_file} was not removed from device.")
         helpers.print_debug("Ending process from device...")
-        if not self.ssh_client.kill_script():
+        if done is None and not self.ssh_client.kill_script():
             helpers.print_debug("Warning: process not ended.")
         if not downloaded:
             self.feedback_str.set("Sampling file not downloaded. Stopping")
@@ -384,6 +442,86 @@ class GUI:
         self.sampling_filename = local_sampling_raw_data_file
         self.modify_Text(self.sampling_file_textbox, self.sampling_filename)
 
+    def start_run(self, filename, mode, raw_data_format = "CSV", compress = False):
+        """
+        Starts a run on the device. With CONSTANTS.USE_DAEMON the run goes through the firmware daemon
+        and the daemon's last message is returned once the run is over and its files are written.
+        If the daemon can't be reached the firmware is run over SSH as before and None is returned -
+        the caller then waits for the file to show up.
+        """
+        if CONSTANTS.USE_DAEMON:
+            on_message = helpers.print_debug
+            if CONSTANTS.RAW_DATA_CHUNK_FILE:
+                on_message = self.follow_chunk_file(filename, mode)
+            message = self.ssh_client.daemon_run(self.remote_firmware, filename, mode, raw_data_format, compress,
+                                                 on_message = on_message)
+            if message is not None:
+                return message
+            helpers.print_debug("Firmware daemon not available, running the firmware directly.")
+        self.ssh_client.collect_data(self.remote_firmware, filename, mode, raw_data_format, compress)
+        return None
+
+    def follow_chunk_file(self, filename, mode):
+        """
+        Returns an on_message callback for daemon_run that, on every progress message, appends what the
+        chunk file on the device has gained to a local copy in the download directory and parses it. The
+        raw codes are on the host while the run is still going, and a run that dies part way keeps them.
+        """
+        chunk_name = f"{filename}_{self.device_id.get()}_{mode}{raw_data_format.CHUNK_SUFFIX}"
+        remote_chunk_file = f"/home/root/{chunk_name}"
+        local_chunk_file = f"{self.download_dir}/{chunk_name}"
+        if os.path.exists(local_chunk_file):
+            os.remove(local_chunk_file) # left from an earlier run with the same name
+
+        def on_message(message):
+            helpers.print_debug(message)
+            if message["event"] not in ("progress", "done"):
+                return
+            if self.ssh_client.download_appended(remote_chunk_file, local_chunk_file) <= 0:
+                return
+            try:
+                header, columns, complete = raw_data_format.read_chunk_file(local_chunk_file)
+            except ValueError:
+                return # header not complete yet
+            helpers.print_debug(f"Chunk file: {len(columns['Time'])} samples on the host" + (", complete" if complete else ""))
+        return on_message
+
+    def collect_dirac_summary(self, filename, mode, device_name):
+        """
+        Runs the firmware without a raw data file and downloads only the per sweep Dirac summary
+        it writes. Returns (dirac, local summary file) where dirac has the same fields as sweepmean
+        gives for a full download, or (None, None) if the summary never showed up.
+        """
+        done = self.start_run(filename, mode, "NONE")
+        if done is not None and (done["event"] != "done" or done["cancelled"]):
+            helpers.print_debug(f"Run failed on the device: {done.get('message', 'cancelled')}")
+            return None, None
+        summary_name = f"{filename}_{device_name}_{mode}{CONSTANTS.DIRAC_SUMMARY_FILE_SUFFIX}"
+        local_summary_file = f"{self.download_dir}/{summary_name}"
+        remote_summary_file = f"/home/root/{summary_name}"
+        downloaded, time_elapsed, start_time = False, 0, time.time()
+        if done is not None: # the daemon only answers once the summary is written
+            downloaded = self.ssh_client.download_file(remote_summary_file, local_summary_file)
+        while not downloaded and time_elapsed < CONSTANTS.MAX_DOWNLOAD_WAIT_TIME:
+            helpers.print_debug(f"Waiting for Dirac summary from device ({time_elapsed} seconds elapsed)...")
+            time.sleep(CONSTANTS.DOWNLOAD_DELAY - (time.time() - start_time) % CONSTANTS.DOWNLOAD_DELAY)
+            downloaded = self.ssh_client.download_file(remote_summary_file, local_summary_file)
+            time_elapsed += CONSTANTS.DOWNLOAD_DELAY
+        if downloaded:
+            helpers.print_debug(f"Downloaded Dirac summary in {time.time() - start_time} seconds.")
+        if not self.ssh_client.delete_file(remote_summary_file):
+            helpers.print_debug(f"Warning: file {remote_summary_file} was not removed from device.")
+        if done is None and not self.ssh_client.kill_script():
+            helpers.print_debug("Warning: process not ended.")
+        if not downloaded:
+            return None, None
+        try:
+            mina, mins, jmin = helpers.read_dirac_summary(local_summary_file)
+        except ValueError as e:
+            helpers.print_debug(f"Dirac summary not usable: {e}")
+            return None, None
+        return {"mean": mina, "std": mins, "data": jmin}, local_summary_file
+
     def baseline_from_file_action(self):
         self.feedback_str.set("Selecting file...")
         local_baseline_raw_data_file = self.select_file()
@@ -586,12 +724,13 @@ class GUI:
         dirac_shift = abs(self.baseline_dirac["mean"] - self.sampling_dirac["mean"])
         dirac_shift = str(dirac_shift * 1000) + " mV"
         sweep_num = 1 # run QC test on the second sweep
-        x_baseline = [obj[0] * 1000    for obj in self.baseline_fx[sweep_num]] # voltage converted to millivolts
-        y_baseline = [obj[1] * 1000000 for obj in self.baseline_fx[sweep_num]] # amps converted to microamps
-        x_sampling = [obj[0] * 1000    for obj in self.sampling_fx[sweep_num]] # millivolts!
-        y_sampling = [obj[1] * 1000000 for obj in self.sampling_fx[sweep_num]] # microamps!
-        self.feedback_str.set("Plotting absolute dirac voltage shift to new window")
-        self.plot_dirac_voltage(x_baseline, y_baseline, x_sampling, y_sampling, dirac_shift)
+        if self.baseline_fx is not None and self.sampling_fx is not None: # no sweeps to plot for fast results
+            x_baseline = [obj[0] * 1000    for obj in self.baseline_fx[sweep_num]] # voltage converted to millivolts
+            y_baseline = [obj[1] * 1000000 for obj in self.baseline_fx[sweep_num]] # amps converted to microamps
+            x_sampling = [obj[0] * 1000    for obj in self.sampling_fx[sweep_num]] # millivolts!
+            y_sampling = [obj[1] * 1000000 for obj in self.sampling_fx[sweep_num]] # microamps!
+            self.feedback_str.set("Plotting absolute dirac voltage shift to new window")
+            self.plot_dirac_voltage(x_baseline, y_baseline, x_sampling, y_sampling, dirac_shift)
 
         output_dirac_shift = {
             "data used": {
@@ -1,6 +1,7 @@
 import time
 import numpy as np
 import json
+import csv
 
 # helper function for logging timestamps
 def get_time():
@@ -136,6 +137,26 @@ def sweepmean(s): # needs testing
     return mina, mins, jmin  # call this function with fx/bx, then display/save the mina and mins somewhere
 
 
+def read_dirac_summary(file):
+    """reads the *_DIRAC_SUMMARY.csv the firmware writes (Dirac Voltages, Sweep Type, Result, Min Ids Voltage
+    per sweep) and returns the same (mina, mins, jmin) as sweepmean, with the same estimator: the gate
+    voltage at the Ids minimum of every forward sweep (Min Ids Voltage), not the on-device parabola vertex
+    (Dirac Voltages). Raises ValueError for summaries without that column (older firmware)
+    """
+    jmin = []
+    with open(file) as csvfile:
+        reader = csv.DictReader(csvfile)
+        if "Min Ids Voltage" not in reader.fieldnames:
+            raise ValueError(f"{file} has no Min Ids Voltage column - written by an older firmware")
+        for row in reader:
+            if row["Sweep Type"] == "FORWARD":
+                jmin += [float(row["Min Ids Voltage"])]
+    mina = np.mean(jmin) if jmin else float("nan")
+    mins = np.std(jmin) if jmin else float("nan")
+    print(f"dirac summary average minimum voltage: {1000*mina}mV with stdev {1000*mins}mV over {len(jmin)} forward sweeps")
+    return mina, mins, jmin
+
+
 # validation functions
 def validate_ip(ip):
     parts = ip.split(".")
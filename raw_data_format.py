@@ -0,0 +1,218 @@
+"""
+Raw data file formats - the one definition used by firmware.py on the device (uploaded next to it by
+the GUI) and by the host to read the downloaded files.
+
+Layout:
+    MAGIC | uint32 little endian header length | JSON header | zero padding to ALIGN | columns
+
+The JSON header holds device_id, sample_rate, achieved_rate, calibration (the calib.json values used for
+the run), n_samples and columns: a list of {"name", "dtype", "offset"} in raw_data_file_header order.
+Column offsets are relative to the start of the data section and each column is n_samples contiguous
+values of its dtype, so every column can be memory mapped directly.
+"""
+
+import csv
+import gzip
+import json
+import struct
+import numpy as np
+
+MAGIC = b"GFETRAW1"
+ALIGN = 8
+CSV_EXTENSION = ".csv"
+BINARY_EXTENSION = ".bin"
+EXTENSIONS = {"CSV": CSV_EXTENSION, "BINARY": BINARY_EXTENSION}
+COMPRESSED_EXTENSION = ".gz" # added on the device when the raw data is gzipped for transfer
+GZIP_LEVEL = 3
+
+# raw data file columns and their types in the binary file (little endian)
+COLUMNS = ['Time', 'd_time', 's_time', 'fs_time', 'Gate Voltage', 'Ids',
+           'raw_adc_binary_ch1', 'raw_adc_binary_ch2', 'raw_adc_voltage_ch1', 'raw_adc_voltage_ch2', 'Slope', 'Peak']
+DTYPES = ['<f8', '<f8', '<f8', '<f8', '<f8', '<f8',
+          '<i4', '<i4', '<f8', '<f8', '<i1', '<i1']
+
+
+# plain or gzip file for the writers (mode "w" or "wb")
+def open_file(file, mode, compress=False, level=GZIP_LEVEL):
+    if compress:
+        return gzip.open(file, mode if "b" in mode else mode + "t", compresslevel=level)
+    return open(file, mode)
+
+
+# helper function for checking whether a file is in the binary format (by magic, not by extension)
+def is_binary(file):
+    with open(file, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+# returns (header, data_offset) of a binary raw data file
+def read_header(file):
+    with open(file, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{file} is not a binary raw data file")
+        header_length, = struct.unpack("<I", f.read(4))
+        header = json.loads(f.read(header_length))
+    header_end = len(MAGIC) + 4 + header_length
+    return header, header_end + (-header_end % ALIGN)
+
+
+def read_binary(file):
+    """
+    Returns (header, columns) where columns maps each column name to a read-only numpy.memmap
+    of length header["n_samples"] - nothing is read or copied until the values are used.
+    """
+    header, data_offset = read_header(file)
+    n_samples = header["n_samples"]
+    columns = {}
+    for column in header["columns"]:
+        if n_samples == 0:
+            columns[column["name"]] = np.empty(0, dtype=column["dtype"])
+            continue
+        columns[column["name"]] = np.memmap(file, dtype=column["dtype"], mode="r",
+                                            offset=data_offset + column["offset"], shape=(n_samples,))
+    return header, columns
+
+
+def write_binary(file, columns, n_samples, info, compress=False, level=GZIP_LEVEL):
+    """
+    Writes columns (in COLUMNS order, array.array or numpy arrays) to a binary raw data file, gzipped
+    if compress. info is stored in the header (device_id, sample_rate, achieved_rate, calibration).
+    """
+    header = dict(info)
+    header["version"] = 1
+    header["n_samples"] = n_samples
+    header["columns"] = []
+    offset = 0
+    for name, dtype in zip(COLUMNS, DTYPES):
+        header["columns"].append({"name": name, "dtype": dtype, "offset": offset})
+        offset += -(-n_samples * np.dtype(dtype).itemsize // ALIGN) * ALIGN
+
+    header_bytes = json.dumps(header).encode()
+    header_end = len(MAGIC) + 4 + len(header_bytes)
+    with open_file(file, "wb", compress, level) as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(header_bytes)))
+        f.write(header_bytes)
+        f.write(bytes(-header_end % ALIGN))
+        for column, dtype in zip(columns, DTYPES):
+            data = np.asarray(column[:n_samples], dtype=dtype).tobytes()
+            f.write(data)
+            f.write(bytes(-len(data) % ALIGN))
+
+
+# reads a legacy RAW_DATA csv into a list of typed numpy arrays in COLUMNS order
+def read_csv_columns(file):
+    with open(file) as csvfile:
+        header = next(csv.reader(csvfile, delimiter=',', quotechar='"'))
+    if header != COLUMNS:
+        raise ValueError(f"{file} does not have the raw data columns {COLUMNS}")
+    data = np.loadtxt(file, delimiter=",", skiprows=1, dtype=np.float64, ndmin=2)
+    return [data[:, i].astype(dtype) for i, dtype in enumerate(DTYPES)]
+
+
+# writes columns as a RAW_DATA csv, a chunk of rows per write() from whole column slices - same bytes
+# as csv.writer (repr floats, \r\n line endings)
+def write_csv(file, columns, n_samples, chunk=4096, compress=False, level=GZIP_LEVEL):
+    with open_file(file, "w", compress, level) as csvfile:
+        csv.writer(csvfile, delimiter=',').writerow(COLUMNS)
+        for chunk_start in range(0, n_samples, chunk):
+            chunk_end = min(chunk_start + chunk, n_samples)
+            text = [map(str, column[chunk_start:chunk_end].tolist()) for column in columns]
+            csvfile.write("".join([",".join(row) + "\r\n" for row in zip(*text)]))
+
+
+def csv_to_binary(csv_file, binary_file, info=None):
+    """
+    Converts a legacy RAW_DATA csv to the binary format. Legacy files carry no calibration or rate,
+    pass them in info (same keys as the firmware header) if they are known.
+    """
+    columns = read_csv_columns(csv_file)
+    write_binary(binary_file, columns, len(columns[0]), info or {})
+
+
+def binary_to_csv(binary_file, csv_file):
+    header, columns = read_binary(binary_file)
+    write_csv(csv_file, [columns[name] for name in COLUMNS], header["n_samples"])
+
+
+# Chunk file appended by firmware.py while it samples (raw_chunk_writer, RAW_DATA_CHUNK_FILE = True):
+#     CHUNK_MAGIC | uint32 header length | JSON header | records
+# each record is uint32 first sample, uint32 n, then n values of every header column in order.
+# A record with n = 0 is written when the run ends.
+CHUNK_MAGIC = b"GFETCHK1"
+CHUNK_SUFFIX = "_RAW_CHUNKS.bin"
+CHUNK_COLUMNS = ['Time', 'd_time', 's_time', 'fs_time', 'raw_adc_binary_ch1', 'raw_adc_binary_ch2']
+CHUNK_DTYPES = [DTYPES[COLUMNS.index(name)] for name in CHUNK_COLUMNS]
+
+
+# magic and header of a chunk file, info is stored in the header like in the binary file
+def write_chunk_header(f, info, chunk_samples):
+    header = dict(info)
+    header["version"] = 1
+    header["chunk_samples"] = chunk_samples
+    header["columns"] = [{"name": name, "dtype": dtype} for name, dtype in zip(CHUNK_COLUMNS, CHUNK_DTYPES)]
+    header_bytes = json.dumps(header).encode()
+    f.write(CHUNK_MAGIC)
+    f.write(struct.pack("<I", len(header_bytes)))
+    f.write(header_bytes)
+
+
+# one record with samples first..end-1 of columns (in CHUNK_COLUMNS order), end = first marks the file complete
+def write_chunk_record(f, columns, first, end):
+    record = [struct.pack("<II", first, end - first)]
+    for column, dtype in zip(columns, CHUNK_DTYPES):
+        record.append(np.asarray(column[first:end], dtype=dtype).tobytes())
+    f.write(b"".join(record))
+
+
+def read_chunk_file(file):
+    """
+    Returns (header, columns, complete) for a chunk file - columns maps the raw column names
+    (Time, d_time, s_time, fs_time, raw_adc_binary_ch1, raw_adc_binary_ch2) to numpy arrays.
+    The file may still be growing or be cut short (partial download, crash on the device): only
+    complete records are returned and complete is False until the end record has been seen.
+    """
+    with open(file, "rb") as f:
+        data = f.read()
+    if data[:len(CHUNK_MAGIC)] != CHUNK_MAGIC:
+        raise ValueError(f"{file} is not a raw data chunk file")
+    position = len(CHUNK_MAGIC)
+    if position + 4 > len(data) or position + 4 + struct.unpack_from("<I", data, position)[0] > len(data):
+        raise ValueError(f"{file} ends inside the chunk file header")
+    header_length, = struct.unpack_from("<I", data, position)
+    position += 4
+    header = json.loads(data[position:position + header_length])
+    position += header_length
+
+    dtypes = [np.dtype(column["dtype"]) for column in header["columns"]]
+    row_size = sum(dtype.itemsize for dtype in dtypes)
+    chunks = [[] for dtype in dtypes]
+    complete = False
+    while position + 8 <= len(data):
+        first, n = struct.unpack_from("<II", data, position)
+        if n == 0:
+            complete = True
+            break
+        if position + 8 + n * row_size > len(data):
+            break # record still being written / cut short
+        position += 8
+        for i, dtype in enumerate(dtypes):
+            chunks[i].append(np.frombuffer(data, dtype=dtype, count=n, offset=position))
+            position += n * dtype.itemsize
+
+    columns = {}
+    for column, dtype, parts in zip(header["columns"], dtypes, chunks):
+        columns[column["name"]] = np.concatenate(parts) if parts else np.empty(0, dtype=dtype)
+    return header, columns, complete
+
+
+# converts in the direction given by the input file: python raw_data_format.py <input> <output>
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) != 3:
+        print("usage: python raw_data_format.py <input RAW_DATA file> <output RAW_DATA file>")
+        sys.exit(1)
+    if is_binary(sys.argv[1]):
+        binary_to_csv(sys.argv[1], sys.argv[2])
+    else:
+        csv_to_binary(sys.argv[1], sys.argv[2])
@@ -1,5 +1,14 @@
 import paramiko
 import json
+import os
+import time
+import zlib
+
+DOWNLOAD_CHUNK_SIZE = 65536 # bytes read from the SFTP stream per decompression step
+DAEMON_PORT = 5025 # same as DAEMON_PORT in firmware.py, only reachable from the device itself
+DAEMON_START_ATTEMPTS = 20 # connection attempts after starting the daemon
+DAEMON_START_DELAY = 0.5 # seconds between those attempts
+DAEMON_FINAL_EVENTS = ("done", "error", "status", "cancelling", "idle", "shutdown") # last message of a command
 
 class ssh_to_device:
     """
@@ -41,12 +50,80 @@ class ssh_to_device:
         stdin, stdout, stderr = self.client.exec_command(command)
         return stdout
 
-    def collect_data(self, firmware_file, file_name = "", mode = "BASELINE"):
-        cmd = f"sudo nice -n 1 python3 {firmware_file} {file_name} {mode}"
+    def collect_data(self, firmware_file, file_name = "", mode = "BASELINE", raw_data_format = "CSV", compress = False):
+        compression = "GZIP" if compress else "NONE"
+        cmd = f"sudo nice -n 1 python3 {firmware_file} {file_name} {mode} {raw_data_format} {compression}"
         self.cmd = cmd
         print(f"RUNNING COMMAND: `{cmd}`")
         resp = self.execute(cmd)
 
+    def start_daemon(self, firmware_file):
+        """
+        Starts firmware_file in DAEMON mode in the background, unless it is already running.
+        """
+        # BRACKETED FIRST CHARACTER: THE PATTERN NO LONGER MATCHES THE SHELL RUNNING THIS COMMAND
+        pattern = f"[{firmware_file[0]}]{firmware_file[1:]} DAEMON"
+        cmd = f"pgrep -f '{pattern}' > /dev/null || " \
+              f"(sudo nohup nice -n 1 python3 {firmware_file} DAEMON > firmware_daemon.log 2>&1 &)"
+        print(f"RUNNING COMMAND: `{cmd}`")
+        resp = self.execute(cmd)
+        if resp is not None:
+            resp.channel.recv_exit_status()
+
+    def daemon_command(self, command, on_message = None, port = DAEMON_PORT):
+        """
+        Sends one command line (BASELINE/SAMPLING <name> [format] [compression], CANCEL, STATUS, SHUTDOWN)
+        to the firmware daemon through the SSH connection. Every JSON message the daemon sends back is
+        passed to on_message as it arrives; the last one (done, error, status, ...) is returned.
+        Returns None if the daemon can't be reached.
+        A run command blocks until the run is over: the daemon answers it on the same connection and
+        reads nothing else from it until then. CANCEL has to be sent from a second daemon_command
+        call (another thread), which opens its own connection.
+        """
+        if not self.client:
+            print("Client is not connected. Need to connect first.")
+            return None
+        try:
+            channel = self.client.get_transport().open_channel("direct-tcpip", ("127.0.0.1", port), ("127.0.0.1", 0))
+        except Exception as e:
+            print(f"Could not reach the firmware daemon on port {port}")
+            print(f"Reason: {e}")
+            return None
+        message = None
+        try:
+            channel.sendall((command + "\n").encode())
+            with channel.makefile("r") as stream:
+                for line in stream:
+                    message = json.loads(line)
+                    if on_message is not None:
+                        on_message(message)
+                    if message["event"] in DAEMON_FINAL_EVENTS:
+                        break
+        finally:
+            channel.close()
+        return message
+
+    def daemon_run(self, firmware_file, file_name, mode = "BASELINE", raw_data_format = "CSV", compress = False, on_message = None):
+        """
+        Same run as collect_data, through the firmware daemon: blocks until the run is over and returns
+        the daemon's done message (files written, Dirac voltages, ...), or None if the daemon could
+        not be started. The daemon is started on first use and stays up between runs.
+        """
+        compression = "GZIP" if compress else "NONE"
+        command = f"{mode} {file_name} {raw_data_format} {compression}"
+        message = self.daemon_command(command, on_message)
+        if message is None:
+            self.start_daemon(firmware_file)
+            for attempt in range(DAEMON_START_ATTEMPTS):
+                time.sleep(DAEMON_START_DELAY)
+                message = self.daemon_command(command, on_message)
+                if message is not None:
+                    break
+        return message
+
+    def stop_daemon(self):
+        return self.daemon_command("SHUTDOWN") is not None
+
     def upload_firmware(self, local_firmware, remote_firmware):
         if not self.client:
             print("Client is not connected. Need to connect first.")
@@ -75,13 +152,20 @@ class ssh_to_device:
             print(f"Reason: {e}")
             return False
 
-    def download_file(self, file, dest):
+    def download_file(self, file, dest, compressed = False):
+        """
+        Downloads file to dest. With compressed = True the remote file is gzip and is decompressed
+        while it streams in, so dest holds the plain file and only the compressed bytes cross the network.
+        """
         if not self.client:
             print("Client is not connected. Need to connect first.")
             return False
         try:
             ftp_client = self.client.open_sftp()
-            ftp_client.get(file, dest)
+            if compressed:
+                self.download_decompressed(ftp_client, file, dest)
+            else:
+                ftp_client.get(file, dest)
             ftp_client.close()
             return True
         except Exception as e:
@@ -89,6 +173,53 @@ class ssh_to_device:
             print(f"Reason: {e}")
             return False
 
+    def download_decompressed(self, ftp_client, file, dest):
+        partial = dest + ".part"
+        decompressor = zlib.decompressobj(wbits = 16 + zlib.MAX_WBITS) # gzip framing
+        received = 0
+        with ftp_client.open(file, "rb") as remote_file, open(partial, "wb") as local_file:
+            remote_file.prefetch()
+            while True:
+                chunk = remote_file.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                received += len(chunk)
+                local_file.write(decompressor.decompress(chunk))
+            local_file.write(decompressor.flush())
+        if not decompressor.eof:
+            os.remove(partial)
+            raise EOFError(f"compressed file {file} is truncated")
+        os.replace(partial, dest)
+        print(f"Downloaded {received} compressed bytes to {os.path.getsize(dest)} bytes")
+
+    def download_appended(self, file, dest):
+        """
+        Appends to dest whatever file on the device has gained since the last call (dest's size is the
+        offset), for files the firmware is still appending to such as the *_RAW_CHUNKS.bin chunk file.
+        Returns the number of new bytes, or -1 on failure.
+        """
+        if not self.client:
+            print("Client is not connected. Need to connect first.")
+            return -1
+        try:
+            offset = os.path.getsize(dest) if os.path.exists(dest) else 0
+            ftp_client = self.client.open_sftp()
+            received = 0
+            with ftp_client.open(file, "rb") as remote_file, open(dest, "ab") as local_file:
+                remote_file.seek(offset)
+                while True:
+                    chunk = remote_file.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    local_file.write(chunk)
+                    received += len(chunk)
+            ftp_client.close()
+            return received
+        except Exception as e:
+            print(f"Could not download new data of file {file} from device")
+            print(f"Reason: {e}")
+            return -1
+
     def delete_file(self, file):
         if not self.client:
             print("Client is not connected. Need to connect first.")
@@ -105,6 +236,8 @@ class ssh_to_device:
         if not self.client:
             print("Client is not connected. Need to connect first.")
             return False
+        if not self.cmd:
+            return True # nothing started with collect_data - an empty pattern would match every process
         try:
             stdin, stdout, stderr = self.client.exec_command(f'pkill -f "{self.cmd}"')
             return True
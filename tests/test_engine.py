@@ -0,0 +1,202 @@
+import csv
+import threading
+
+import numpy as np
+import pytest
+
+import firmware
+import helperfuncs
+import raw_data_format
+
+
+# Acquisition filled with synthetic raw codes, no SPI: a gate triangle on CH2 and a CH1 code
+# parabola with its minimum at raw_B = dirac_code, so the Dirac voltage is known in advance
+def synthetic_acquisition(n=6000, half_period=600, dirac_code=300000):
+    phase = np.arange(n) % (2 * half_period)
+    triangle = np.where(phase < half_period, phase, 2 * half_period - phase) / half_period
+    raw_B = ((2 * triangle - 1) * 2000000).astype(np.int64)
+    raw_A = (2.5e-7 * (raw_B - dirac_code) ** 2 + 100000).astype(np.int64)
+
+    acquisition = firmware.Acquisition(n_max=n)
+    acquisition.adc_A[:] = firmware.arr.array("i", (raw_A & 0xFFFFFF).tolist())
+    acquisition.adc_B[:] = firmware.arr.array("i", (raw_B & 0xFFFFFF).tolist())
+    acquisition.time[:] = firmware.arr.array("d", (np.arange(n) / 250).tolist())
+    acquisition.n = n
+    return acquisition
+
+
+def test_post_processor(monkeypatch):
+    monkeypatch.setattr(firmware, "MIN_SWEEP_SAMPLES", 100)
+    monkeypatch.setattr(firmware, "secs", 3)
+    post_processor = firmware.PostProcessor(synthetic_acquisition())
+    table = post_processor.run()
+
+    g1, g0 = firmware.fold_calibration_coefficients()["Vgate"]
+    assert len(table) == 5  # 3 + 3 SWEEPS, THE LAST ONE UNUSED
+    assert (table["result"] == "PASS").all()
+    for mean in post_processor.mean_dirac():
+        assert mean == pytest.approx(g1 * 300000 + g0, abs=1e-4)
+
+
+@pytest.mark.parametrize("raw_data_format_name", ["CSV", "BINARY"])
+def test_raw_data_file(tmp_path, monkeypatch, raw_data_format_name):
+    monkeypatch.setattr(firmware, "MIN_SWEEP_SAMPLES", 100)
+    acquisition = synthetic_acquisition()
+    post_processor = firmware.PostProcessor(acquisition)
+    post_processor.run()
+    columns = post_processor.raw_data_columns()
+
+    file = tmp_path / ("run_RAW_DATA" + raw_data_format.EXTENSIONS[raw_data_format_name])
+    if raw_data_format_name == "BINARY":
+        firmware.write_raw_data_binary(str(file), columns, acquisition.n, firmware.raw_data_file_info("SIM", 250, 250))
+        header, read = raw_data_format.read_binary(file)
+        read = [read[name] for name in raw_data_format.COLUMNS]
+        assert header["device_id"] == "SIM"
+    else:
+        firmware.write_raw_data_csv(str(file), columns, acquisition.n)
+        read = raw_data_format.read_csv_columns(file)
+    for column, read_column in zip(columns, read):
+        assert np.array_equal(np.asarray(column[:acquisition.n]), read_column)
+
+
+# Short run on the simulated ADC: a 1 s gate triangle so a few sweeps fit into 4 s
+@pytest.fixture
+def device(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(firmware, "GPIO_PATH", str(tmp_path / "gpio"))
+    monkeypatch.setattr(firmware, "MIN_SWEEP_SAMPLES", 50)
+    monkeypatch.setattr(firmware, "secs", 3)
+    firmware.Calibration.load().apply()
+    device = firmware.Device(spi_backend=firmware.simulated_mcp3561(sweep_period=1.0, seed=1)).open()
+    device.configure(do_print=False)
+    yield device
+    device.close()
+
+
+def test_simulated_run(device, tmp_path):
+    acquisition = firmware.Acquisition(n_max=2000)
+    chunk_writer = firmware.raw_chunk_writer(str(tmp_path / "run_RAW_CHUNKS.bin"), acquisition.raw_columns(),
+                                             firmware.raw_data_file_info("SIM", 250, 250))
+    chunk_writer.start()
+    try:
+        assert acquisition.run(chunk_writer=chunk_writer, duration=4)
+    finally:
+        chunk_writer.close(acquisition.n)
+
+    post_processor = firmware.PostProcessor(acquisition)
+    table = post_processor.run()
+    assert len(table) >= 4
+    assert (table["result"] == "PASS").all()
+    forward, reverse = post_processor.mean_dirac()
+    assert forward == pytest.approx(0.2, abs=0.02)
+    assert reverse == pytest.approx(0.18, abs=0.02)
+
+    # THE CHUNK FILE HAS THE SAME RAW CODES AS THE RAW DATA FILE
+    header, chunks, complete = raw_data_format.read_chunk_file(tmp_path / "run_RAW_CHUNKS.bin")
+    assert complete
+    assert np.array_equal(chunks["raw_adc_binary_ch2"], post_processor.raw_data_columns()[7][:acquisition.n])
+    assert np.array_equal(chunks["Time"], np.asarray(acquisition.time[:acquisition.n]))
+
+
+# The adaptive stop's spread is the one the host computes from the Dirac summary of the same run
+def test_adaptive_stop_matches_dirac_summary(device, tmp_path, monkeypatch):
+    monkeypatch.setattr(firmware, "ADAPTIVE_STOP", True)
+    monkeypatch.setattr(firmware, "ADAPTIVE_MIN_SWEEPS", 3)
+    monkeypatch.setattr(firmware, "ADAPTIVE_MIN_SEC", 0)
+    monkeypatch.setattr(firmware, "ADAPTIVE_SEM_TARGET", 1)  # STOP AS SOON AS ADAPTIVE_MIN_SWEEPS ARE IN
+    monkeypatch.setattr(firmware, "secs", 100)
+    acquisition = firmware.Acquisition(n_max=2000)
+    assert acquisition.run(duration=6)
+    assert acquisition.stop_reason == "adaptive"
+
+    post_processor = firmware.PostProcessor(acquisition)
+    firmware.write_dirac_summary(str(tmp_path / "run_DIRAC_SUMMARY.csv"), post_processor.run())
+    mina, mins, jmin = helperfuncs.read_dirac_summary(tmp_path / "run_DIRAC_SUMMARY.csv")
+    assert acquisition.stop_rule.min_ids_vgate == pytest.approx(jmin)
+    assert acquisition.stop_rule.std == pytest.approx(mins)
+
+
+def test_monitor(device, tmp_path):
+    monitor = firmware.Monitor(str(tmp_path / "run_MONITOR.csv"), size=1024)
+    monitor.run(duration=4)
+
+    rows = list(csv.DictReader(open(tmp_path / "run_MONITOR.csv")))
+    assert monitor.sweeps == len(rows) >= 4
+    forward = [row for row in rows if row["Sweep Type"] == "FORWARD"]
+    assert float(forward[-1]["Rolling Mean"]) == pytest.approx(0.2, abs=0.02)
+
+
+@pytest.mark.parametrize("setting", ["ADC_STREAMING_MODE", "ACQUISITION_PROCESS"])
+def test_monitor_refuses_unsupported_modes(device, tmp_path, monkeypatch, setting):
+    monkeypatch.setattr(firmware, setting, True)
+    with pytest.raises(RuntimeError, match=setting):
+        firmware.Monitor(str(tmp_path / "run_MONITOR.csv")).run(duration=1)
+    assert not (tmp_path / "run_MONITOR.csv").exists()
+
+
+# ADC_STREAMING_MODE is read when the device is configured, not when firmware.py is imported
+def test_streaming_mode_set_after_import(device, monkeypatch):
+    monkeypatch.setattr(firmware, "ADC_STREAMING_MODE", True)
+    device.configure(do_print=False)
+    assert firmware.adc_scan_mode
+    assert firmware.conv_mode == firmware.CONV_MODE_CONTINIOUS
+    assert firmware.adc_output_size == firmware.ADC_OUTPUT_32bit
+
+    acquisition = firmware.Acquisition(n_max=2000)
+    assert acquisition.run(duration=4)
+    post_processor = firmware.PostProcessor(acquisition)
+    assert len(post_processor.run()) >= 4
+    forward, reverse = post_processor.mean_dirac()
+    assert forward == pytest.approx(0.2, abs=0.02)
+
+    monkeypatch.setattr(firmware, "ADC_STREAMING_MODE", False)
+    device.configure(do_print=False)
+    assert not firmware.adc_scan_mode
+    assert firmware.conv_mode == firmware.CONV_MODE_ONE_SHOT_STANDBY
+    assert firmware.adc_output_size == firmware.ADC_OUTPUT_24bit
+
+
+# SPI whose every reply has the data ready bit high (no new data): an ADC that stopped converting
+class stalled_spi:
+
+    def __init__(self):
+        self.sent = []
+
+    def xfer2(self, msg):
+        self.sent.append(list(msg))
+        return [0b00000100] + [0] * (len(msg) - 1)
+
+
+def stream_buffers(n=100):
+    return [firmware.arr.array("i", [0]*n), firmware.arr.array("i", [0]*n)] + \
+        [firmware.arr.array("d", [0]*n) for i in range(4)]
+
+
+@pytest.fixture
+def stalled(device, monkeypatch):
+    spi = stalled_spi()
+    monkeypatch.setattr(firmware, "spi", spi)
+    yield spi
+    firmware.cancel_event.clear()
+    assert spi.sent[-1] == list(firmware.cmd_table["standby"])  # THE ADC IS STOPPED HOWEVER THE STREAM ENDS
+
+
+def test_acquire_stream_stall_raises(stalled, monkeypatch):
+    monkeypatch.setattr(firmware, "ADC_SCAN_TIMEOUT", 0.05)
+    with pytest.raises(RuntimeError, match="stalled"):
+        firmware.acquire_stream(*stream_buffers(), duration=None)
+
+
+def test_acquire_stream_stall_ends_at_duration(stalled, monkeypatch):
+    monkeypatch.setattr(firmware, "ADC_SCAN_TIMEOUT", 10)
+    t_start = firmware.time.perf_counter()
+    assert firmware.acquire_stream(*stream_buffers(), duration=0.1) == 0
+    assert firmware.time.perf_counter() - t_start < 1
+
+
+def test_acquire_stream_stall_cancel(stalled, monkeypatch):
+    monkeypatch.setattr(firmware, "ADC_SCAN_TIMEOUT", 10)
+    timer = threading.Timer(0.05, firmware.cancel_event.set)
+    timer.start()
+    assert firmware.acquire_stream(*stream_buffers(), duration=None) == -1
+    timer.join()
@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+import firmware
+
+CHANNELS = [firmware.GPIO_CHAN_NUM_BUTTON2, firmware.GPIO_CHAN_NUM_BUTTON3, firmware.GPIO_CHAN_NUM_LED_GREEN]
+
+
+# sysfs GPIO directory on a temp root: gpioN/value files holding "1"
+@pytest.fixture
+def gpio_root(tmp_path):
+    for chan in CHANNELS:
+        (tmp_path / ("gpio" + chan)).mkdir()
+        (tmp_path / ("gpio" + chan) / "value").write_text("1")
+    return str(tmp_path)
+
+
+def open_fds():
+    return set(os.listdir("/proc/self/fd"))
+
+
+def test_write_read(gpio_root):
+    gpio = firmware.gpio_bank(gpio_root)
+    gpio.write(firmware.GPIO_CHAN_NUM_LED_GREEN, firmware.GPIO_VAL_LO)
+    gpio.write("999", firmware.GPIO_VAL_HI)  # NO SUCH CHANNEL: REPORTED, NOT RAISED
+    assert gpio.read(firmware.GPIO_CHAN_NUM_LED_GREEN) == firmware.GPIO_VAL_LO
+    assert gpio.read(firmware.GPIO_CHAN_NUM_BUTTON3) == "1"
+    gpio.close()
+
+
+def test_interrupt_wakes_wait_for_edge(gpio_root):
+    gpio = firmware.gpio_bank(gpio_root)
+    poller = gpio.poller([])
+    assert not gpio.wait_for_edge(poller, 0)
+    gpio.interrupt()
+    assert gpio.wait_for_edge(poller, 1)
+    assert not gpio.wait_for_edge(poller, 0)  # THE WAKE-UP WAS CONSUMED
+    gpio.close()
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="needs /proc/self/fd")
+def test_close_leaves_no_fds_open(gpio_root):
+    before = open_fds()
+    gpio = firmware.gpio_bank(gpio_root)
+    for chan in CHANNELS:
+        gpio.read(chan)
+    gpio.poller(CHANNELS)
+    gpio.interrupt()
+    assert len(open_fds() - before) == len(CHANNELS) + 2  # VALUE FILES AND THE SELF-PIPE
+
+    gpio.close()
+    assert open_fds() == before
+    gpio.close()  # SECOND CLOSE IS A NO-OP
+    gpio.interrupt()
+    assert open_fds() == before
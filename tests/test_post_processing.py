@@ -0,0 +1,193 @@
+import numpy as np
+import pytest
+
+import firmware
+
+LAG = 25
+
+
+# noisy triangle on the CH2 codes: half_period samples per sweep, starting at a rising edge
+def triangle_codes(n, half_period=300, amplitude=1000000, noise=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    phase = np.arange(n) % (2 * half_period)
+    triangle = np.where(phase < half_period, phase, 2 * half_period - phase) / half_period
+    codes = (2 * triangle - 1) * amplitude + rng.normal(0, noise, n)
+    return codes.astype(np.int64)
+
+
+# the per sample slope / peak loop firmware.py had before detect_slope_peak
+def baseline_slope_peak(voltage_B, slope_range):
+    n = len(voltage_B)
+    _slope = [0] * n
+    _peak = [0] * n
+    for i in range(n):
+        if(i > slope_range):
+            if (voltage_B[i-slope_range] - voltage_B[i]) / slope_range > 0:
+                _slope[i] = -1
+            else:
+                _slope[i] = 1
+        else:
+            _slope[i] = 0
+
+        if(i > slope_range):
+            if((_slope[i] != _slope[i-1])):
+                if(_slope[i] == 1):
+                    _peak[i] = -1
+                else:
+                    _peak[i] = 1
+            else:
+                _peak[i] = 0
+        else:
+            _peak[i] = 0
+    return _slope, _peak
+
+
+# the sweep loop firmware.py had before segment_sweeps, returns [(start, end, sweep_type)]
+def baseline_sweeps(_slope, _peak, NN, slope_range, secs, min_samples):
+    start, end, sweep_type = [], [], []
+    section_index_forward = section_index_reverse = 0
+    for i in range(NN):
+        if(i > slope_range+1):
+            if(_peak[i] == 1):
+                i += 1
+                start.append(i)
+                sweep_type.append('REVERSE')
+                while _slope[i] == -1:
+                    i += 1
+                    if(i == NN):
+                        break
+                end.append(i)
+                section_index_reverse += 1
+                if(i == NN):
+                    break
+                if(section_index_reverse == secs and section_index_forward == secs):
+                    break
+
+            elif(_peak[i] == -1):
+                i += 1
+                start.append(i)
+                sweep_type.append('FORWARD')
+                while _slope[i] == 1:
+                    i += 1
+                    if(i == NN):
+                        break
+                end.append(i)
+                section_index_forward += 1
+                if(i == NN):
+                    break
+                if(section_index_forward == secs and section_index_reverse == secs):
+                    break
+
+    start.pop(len(start)-1)
+    end.pop(len(end)-1)
+    sweep_type.pop(len(sweep_type)-1)
+
+    c = 0
+    for i in range(len(start)-1-c):
+        if (end[i-c] - start[i-c]) < min_samples:
+            start.pop(i-c)
+            end.pop(i-c)
+            sweep_type.pop(i-c)
+            c += 1
+    return list(zip(start, end, sweep_type))
+
+
+def as_list(table):
+    return [(int(start), int(end), str(sweep_type)) for start, end, sweep_type in table]
+
+
+@pytest.mark.parametrize("noise", [0, 2000, 40000])
+def test_detect_slope_peak_matches_baseline_loop(noise):
+    voltage_B = triangle_codes(5000, noise=noise) * 1e-6
+    slope, peak = firmware.detect_slope_peak(voltage_B, LAG)
+    baseline_slope, baseline_peak = baseline_slope_peak(voltage_B.tolist(), LAG)
+    assert slope.tolist() == baseline_slope
+    assert peak.tolist() == baseline_peak
+
+
+def test_detect_slope_peak_short_input():
+    slope, peak = firmware.detect_slope_peak(np.arange(LAG + 1, dtype=float), LAG)
+    assert not slope.any() and not peak.any()
+
+
+# noise 20000 gives extra flips around the turning points, so short sweeps to drop
+@pytest.mark.parametrize("noise", [2000, 20000])
+@pytest.mark.parametrize("max_sweeps", [3, 100])
+def test_segment_sweeps_matches_baseline_loop(noise, max_sweeps):
+    voltage_B = triangle_codes(6000, noise=noise, seed=1) * 1e-6
+    slope, peak = baseline_slope_peak(voltage_B.tolist(), LAG)
+    table = firmware.segment_sweeps(np.array(peak), len(peak), LAG, max_sweeps, 100)
+    expected = baseline_sweeps(slope, peak, len(peak), LAG, max_sweeps, 100)
+    # THE BASELINE NEVER CHECKED ITS LAST SWEEP AGAINST min_samples (ITS range() IS ONE SHORT)
+    expected = [sweep for sweep in expected if sweep[1] - sweep[0] >= 100]
+    assert len(expected) >= 2
+    assert as_list(table) == expected
+
+
+# the online segmenter gets the raw 24 bit codes (as read from the ADC) in uneven blocks
+@pytest.mark.parametrize("max_sweeps", [3, 100])
+def test_sweep_segmenter_matches_segment_sweeps(max_sweeps):
+    codes = triangle_codes(6000, noise=20000, seed=1)
+    voltage_B = codes * 2.5e-7 + 0.1  # ANY POSITIVE GAIN KEEPS THE SLOPE SIGNS
+    slope, peak = firmware.detect_slope_peak(voltage_B, LAG)
+    expected = firmware.segment_sweeps(peak, len(peak), LAG, max_sweeps, 100)
+
+    adc_B = firmware.arr.array("i", (codes & 0xFFFFFF).tolist())
+    segmenter = firmware.sweep_segmenter(adc_B, len(adc_B), LAG, max_sweeps, 100)
+    rng = np.random.default_rng(2)
+    n = 0
+    while n < len(adc_B):
+        n = min(n + int(rng.integers(1, 400)), len(adc_B))
+        segmenter.update(n)
+
+    assert as_list(segmenter.table()) == as_list(expected)
+    assert segmenter.complete == (max_sweeps == 3)
+    assert list(segmenter.slope) == slope.tolist()
+    assert list(segmenter.peak) == peak.tolist()
+
+
+# Ids parabola around dirac on every sweep of a gate triangle
+def sweep_data(dirac=0.2, half_period=400, n_sweeps=6, noise=2e-8, seed=3):
+    rng = np.random.default_rng(seed)
+    n = half_period * n_sweeps
+    phase = np.arange(n) % (2 * half_period)
+    Vgate = np.where(phase < half_period, phase, 2 * half_period - phase) / half_period - 0.4
+    Ids = 3e-5 * (Vgate - dirac) ** 2 + 4e-5 + rng.normal(0, noise, n)
+    starts = np.arange(0, n, half_period)
+    sweeps = np.array([(start, start + half_period, "FORWARD" if k % 2 == 0 else "REVERSE")
+                       for k, start in enumerate(starts)], dtype=firmware.SWEEP_TABLE_DTYPE)
+    return Vgate, Ids, sweeps
+
+
+def test_estimate_dirac_matches_polyfit():
+    Vgate, Ids, sweeps = sweep_data()
+    table = firmware.estimate_dirac(Vgate, Ids, sweeps)
+
+    assert (table["result"] == "PASS").all()
+    assert (table["sweep_type"] == sweeps["sweep_type"]).all()
+    for row, (start, end, sweep_type) in zip(table, sweeps):
+        Vgate_prime, Ids_prime = Vgate[start:end], Ids[start:end]
+        min_idx = np.argmin(Ids_prime)
+        Vgate_range = Vgate_prime.max() - Vgate_prime.min()
+        idx_low = np.abs(Vgate_prime - (Vgate_prime[min_idx] - firmware.DIRAC_FIT_WINDOW*Vgate_range)).argmin()
+        idx_high = np.abs(Vgate_prime - (Vgate_prime[min_idx] + firmware.DIRAC_FIT_WINDOW*Vgate_range)).argmin()
+        lo, hi = min(idx_low, idx_high), max(idx_low, idx_high) + 1
+        a, b, c = np.polyfit(Vgate_prime[lo:hi], Ids_prime[lo:hi], 2)
+        assert row["dirac"] == pytest.approx(-b / (2*a), abs=1e-9)
+        assert row["min_ids_vgate"] == Vgate_prime[min_idx]
+        assert row["dirac"] == pytest.approx(0.2, abs=0.01)
+
+
+def test_estimate_dirac_fails_without_a_minimum():
+    Vgate, Ids, sweeps = sweep_data()
+    table = firmware.estimate_dirac(Vgate, -Ids, sweeps)  # OPENS DOWNWARDS
+
+    assert (table["result"] == "FAIL").all()
+    for row, (start, end, sweep_type) in zip(table, sweeps):
+        assert row["dirac"] == Vgate[start + np.argmin(-Ids[start:end])]  # Vgate OF THE Ids MINIMUM
+        assert row["min_ids_vgate"] == row["dirac"]
+
+
+def test_estimate_dirac_no_sweeps():
+    table = firmware.estimate_dirac(np.zeros(10), np.zeros(10), np.zeros(0, dtype=firmware.SWEEP_TABLE_DTYPE))
+    assert len(table) == 0
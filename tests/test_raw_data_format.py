@@ -0,0 +1,120 @@
+import gzip
+import struct
+
+import numpy as np
+import pytest
+
+import firmware
+import raw_data_format
+
+INFO = {"device_id": "TEST", "sample_rate": 250, "achieved_rate": 249.9, "calibration": {"GATE_GAIN": 1.5}}
+
+
+def random_columns(n, seed=0):
+    rng = np.random.default_rng(seed)
+    columns = []
+    for dtype in raw_data_format.DTYPES:
+        if dtype.startswith("<f"):
+            columns.append(rng.normal(size=n))
+        else:
+            columns.append(rng.integers(-100, 100, size=n).astype(dtype))
+    return columns
+
+
+@pytest.mark.parametrize("n", [0, 1, 1001])
+def test_binary_round_trip(tmp_path, n):
+    columns = random_columns(n)
+    file = tmp_path / "raw.bin"
+    raw_data_format.write_binary(file, columns, n, INFO)
+
+    assert raw_data_format.is_binary(file)
+    header, read = raw_data_format.read_binary(file)
+    assert header["n_samples"] == n
+    assert header["device_id"] == "TEST"
+    assert header["calibration"] == INFO["calibration"]
+    for name, dtype, column in zip(raw_data_format.COLUMNS, raw_data_format.DTYPES, columns):
+        assert read[name].dtype == np.dtype(dtype)
+        assert np.array_equal(read[name], column)
+
+
+def test_csv_round_trip(tmp_path):
+    columns = random_columns(1001)
+    file = tmp_path / "raw.csv"
+    raw_data_format.write_csv(file, columns, 1001, chunk=100)
+
+    assert not raw_data_format.is_binary(file)
+    for column, read in zip(columns, raw_data_format.read_csv_columns(file)):
+        assert np.array_equal(read, column)
+
+
+def test_conversions_keep_the_csv_bytes(tmp_path):
+    columns = random_columns(500)
+    raw_data_format.write_csv(tmp_path / "raw.csv", columns, 500)
+    raw_data_format.csv_to_binary(tmp_path / "raw.csv", tmp_path / "raw.bin", INFO)
+    raw_data_format.binary_to_csv(tmp_path / "raw.bin", tmp_path / "back.csv")
+
+    assert (tmp_path / "raw.csv").read_bytes() == (tmp_path / "back.csv").read_bytes()
+
+
+def test_compressed_writers(tmp_path):
+    columns = random_columns(300)
+    raw_data_format.write_csv(tmp_path / "raw.csv", columns, 300)
+    raw_data_format.write_csv(tmp_path / "raw.csv.gz", columns, 300, compress=True)
+    raw_data_format.write_binary(tmp_path / "raw.bin", columns, 300, INFO)
+    raw_data_format.write_binary(tmp_path / "raw.bin.gz", columns, 300, INFO, compress=True)
+
+    for name in ("raw.csv", "raw.bin"):
+        with gzip.open(tmp_path / (name + raw_data_format.COMPRESSED_EXTENSION)) as f:
+            assert f.read() == (tmp_path / name).read_bytes()
+
+
+# chunk file as the firmware's writer thread appends it, records of 100, 100 and 50 samples
+def write_chunk_file(file, columns, ends):
+    chunk_writer = firmware.raw_chunk_writer(str(file), columns, INFO)
+    chunk_writer.start()
+    for end in ends[:-1]:
+        chunk_writer.submit(end)
+    chunk_writer.close(ends[-1])
+
+
+def chunk_columns(n):
+    columns = random_columns(n)
+    return [columns[raw_data_format.COLUMNS.index(name)] for name in firmware.raw_chunk_file_header]
+
+
+def test_chunk_file_round_trip(tmp_path):
+    columns = chunk_columns(250)
+    write_chunk_file(tmp_path / "chunks.bin", columns, [100, 200, 250])
+
+    header, read, complete = raw_data_format.read_chunk_file(tmp_path / "chunks.bin")
+    assert complete
+    assert header["device_id"] == "TEST"
+    for name, column in zip(firmware.raw_chunk_file_header, columns):
+        assert np.array_equal(read[name], column)
+
+
+def test_chunk_file_truncated(tmp_path):
+    columns = chunk_columns(250)
+    write_chunk_file(tmp_path / "chunks.bin", columns, [100, 200, 250])
+    data = (tmp_path / "chunks.bin").read_bytes()[:-8]  # WITHOUT THE END RECORD
+    truncated = tmp_path / "truncated.bin"
+
+    # CUT INSIDE THE LAST RECORD: ONLY THE FIRST TWO RECORDS COME BACK
+    truncated.write_bytes(data[:-10])
+    header, read, complete = raw_data_format.read_chunk_file(truncated)
+    assert not complete
+    for name, column in zip(firmware.raw_chunk_file_header, columns):
+        assert np.array_equal(read[name], column[:200])
+
+    # ALL RECORDS, NO END RECORD: THE RUN IS STILL GOING
+    truncated.write_bytes(data)
+    header, read, complete = raw_data_format.read_chunk_file(truncated)
+    assert not complete
+    assert len(read["Time"]) == 250
+
+    # CUT INSIDE THE HEADER
+    header_end = len(raw_data_format.CHUNK_MAGIC) + 4 + struct.unpack_from("<I", data, len(raw_data_format.CHUNK_MAGIC))[0]
+    for end in (len(raw_data_format.CHUNK_MAGIC) + 2, header_end - 1):
+        truncated.write_bytes(data[:end])
+        with pytest.raises(ValueError):
+            raw_data_format.read_chunk_file(truncated)